@@ -1,5 +1,7 @@
 import os
+import asyncio
 from typing import IO
+from typing import Optional
 from uuid import uuid4
 import shutil
 from datetime import datetime
@@ -7,18 +9,68 @@ from tempfile import NamedTemporaryFile
 from contextlib import asynccontextmanager
 
 
-from fastapi import FastAPI, status, UploadFile
+from fastapi import FastAPI, status, UploadFile, Request, Response
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from redis import asyncio as aioredis
 
 # from redis_package import redis_wrapper as rw # on docker
 from redis_package import redis_wrapper as rw
+from redis_package import scheduler
+from redis_package import admission
+from redis_package import analytics
+from redis_package import backends
+from redis_package import connections
+from redis_package import export
 
 # from ..src import dataclasses as dc
 from src import dataclasses as dc
+from src import io
+from src import matching
+from src import result_cache
 
 
+# embedded mode runs queue, job store and worker inside the api process,
+# no redis needed, for single user local installs
+EMBEDDED = os.getenv("BUOY_EMBEDDED", "0").lower() in ("1", "true", "yes")
+
 db_connections = {}
+depth_cache = admission.QueueDepthCache()
+skill_index = matching.SkillIndex()
+completed_results = result_cache.ResultCache()
+# status codes of jobs whose result can no longer change, failed jobs are
+# retried so only completed ones
+TERMINAL_STATUS_CODES = {200}
+
+
+async def follow_completed(db: aioredis.Redis, last_id: str = "0") -> None:
+    """
+    Keeps skill_index up to date with jobs completed by the workers, jobs
+    older than the completed retention are dropped as their documents expire
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        last_id (str): stream id to follow from
+
+    Returns:
+        None
+    """
+    retention = rw.RETENTION_SECONDS["completed"]
+    while True:
+        # 0 keeps completed jobs forever
+        cutoff = datetime.now().timestamp() - retention if retention else 0.0
+        skill_index.expire(cutoff)
+        try:
+            last_id, entries = await rw.read_completed(db, last_id, block=5000)
+        except aioredis.RedisError as e:
+            print(f"Unable to read completed jobs due to:\n{e}")
+            await asyncio.sleep(1)
+            continue
+        for entry in entries:
+            if entry["ts"] < cutoff:
+                # replayed from the stream, its document is already gone
+                continue
+            skill_index.add(entry["uid"], entry["task"], entry["skills"], entry["ts"])
 
 
 @asynccontextmanager
@@ -31,80 +83,188 @@ async def lifespan(app: FastAPI):
     Returns:
         None
     """
-    db_connections["redis_db"] = await rw.redis_db_async("redis_db", 6380)
-    db_connections["redis_queue"] = await rw.redis_db_async("redis", 6379)
+    background_tasks = []
+    if EMBEDDED:
+        # the worker pipeline is only imported when it runs in process
+        from worker import processor
+
+        db_connections["redis_db"] = backends.MemoryJobStore()
+        db_connections["redis_queue"] = backends.MemoryQueue()
+        background_tasks.append(
+            asyncio.create_task(
+                processor.run_embedded(
+                    db_connections["redis_queue"], db_connections["redis_db"]
+                )
+            )
+        )
+    else:
+        db_connections["redis_db"] = await rw.job_store_async()
+        db_connections["redis_queue"] = await rw.redis_db_async(
+            rw.REDIS_QUEUE_HOST, rw.REDIS_QUEUE_PORT
+        )
+        for client in rw.store_clients(db_connections["redis_db"]):
+            await rw.ensure_jobs_index(client)
+    background_tasks.append(
+        asyncio.create_task(follow_completed(db_connections["redis_db"]))
+    )
     yield  # Yield control back to FastAPI. The app is now running.
     # Clean up when app is shutting down
-    await db_connections.clear()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    db_connections.clear()
+    await connections.manager.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+async def admit(request: Request, lane: str) -> None:
+    """
+    Admission control, rate limits the client and sheds load when the lane
+    the job would join is already over capacity
+
+    Args:
+        request (Request): incoming request, used to identify the client
+        lane (str): lane the job would be queued on
+
+    Raises:
+        HTTPException: 429 when client is over its rate limit,
+                       503 when the lane is full or redis is unreachable
+    """
+    client_id = admission.client_key(
+        request.client.host if request.client else None,
+        request.headers.get("x-client-id"),
+    )
+    try:
+        # capacity first, a request shed for overload keeps the client's token
+        depths = await depth_cache.get(db_connections["redis_queue"])
+        if not admission.lane_has_capacity(depths, lane):
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is over capacity, try again later",
+                headers={"Retry-After": str(admission.OVERLOAD_RETRY_AFTER)},
+            )
+        allowed, retry_after = await admission.take_token(
+            db_connections["redis_queue"], client_id
+        )
+    except aioredis.RedisError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Queue unavailable: {e}",
+            headers={"Retry-After": str(admission.OVERLOAD_RETRY_AFTER)},
+        )
+    if not allowed:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(max(1, retry_after))},
+        )
+
+
+async def submit_job(
+    uid: str,
+    data: str,
+    time: str,
+    task_name: dc.Task,
+    lane: str,
+    cost: int,
+) -> None:
+    """
+    Saves the document of a job, then queues it, so a worker never picks up
+    a job whose document does not exist yet
+
+    Args:
+        uid (str): uuid4 of the job
+        data (str): either file_path or text_chunk
+        time (str): isoformat time the job was submitted
+        task_name (dc.Task): resume_upload or job_ad_upload
+        lane (str): lane to queue the job on
+        cost (int): estimated cost of the job
+
+    Raises:
+        aioredis.RedisError: when the job could not be saved or queued, a
+                             saved document is removed again
+    """
+    await rw.redis_save_to_db(
+        db=db_connections["redis_db"],
+        uid=uid,
+        data=data,
+        time=time,
+        task=task_name,
+        status_code=202,
+        status_name="Queued",
+        final_result=None,
+    )
+    try:
+        await rw.update_message(
+            db=db_connections["redis_queue"],
+            uid=uid,
+            data=data,
+            time=time,
+            queue_name=lane,
+            task=task_name,
+            cost=cost,
+        )
+    except aioredis.RedisError:
+        # the client retries with a new job, no document may stay behind
+        try:
+            await rw.delete_job(db_connections["redis_db"], uid)
+        except aioredis.RedisError as e:
+            print(f"Unable to remove unqueued {uid} due to:\n{e}")
+        raise
+    depth_cache.note_enqueued(lane)
+
+
 @app.post("/text_chunk/")
-async def text_chunk(selected_span: dc.JobChunkText) -> str:
+async def text_chunk(
+    selected_span: dc.JobChunkText, request: Request, response: Response
+) -> str:
     """
-    function for parsing selected texts over job portals
+    function for parsing selected texts over job portals, the uid of the
+    queued job is returned in the X-Job-Uid header
 
     Args:
         selected_span (dc.JobChunkText): selected parts of job portal
+        request (Request): incoming request
+        response (Response): outgoing response
 
     Returns:
         str: cleaned_text
     """
     # TODO: add in the resume parser rather than just cleaning
     task_name = dc.Task(task="job_ad_upload")
+    cost = scheduler.estimate_cost(task_name.task, selected_span.text_chunk)
+    lane = scheduler.choose_lane(task_name.task, cost)
+    await admit(request, lane)
     uid = str(uuid4())
     time = datetime.utcnow().isoformat()
-    status_code = 202
-    status_name = "Queued"
     try:
-        await rw.update_message(
-            db=db_connections["redis_queue"],
-            uid=uid,
-            data=selected_span.text_chunk,
-            time=time,
-            queue_name="worker_queue",
-            task=task_name,
-        )
-        await rw.redis_save_to_db(
-            db=db_connections["redis_db"],
-            uid=uid,
-            data=selected_span.text_chunk,
-            time=time,
-            task=task_name,
-            status_code=status_code,
-            status_name=status_name,
-            final_result=None,
+        await submit_job(uid, selected_span.text_chunk, time, task_name, lane, cost)
+    except aioredis.RedisError as e:
+        print(f"Unable to queue {uid} due to:\n{e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Unable to queue job, try again later",
+            headers={"Retry-After": str(admission.OVERLOAD_RETRY_AFTER)},
         )
-    except Exception as e:
-        print(e)
+    response.headers["X-Job-Uid"] = uid
     return selected_span.text_chunk
 
 
 @app.post("/resume/")
-async def resume_submission(resume: UploadFile):
+async def resume_submission(resume: UploadFile, request: Request):
     """
     function for accepting resume file uploads
 
     Args:
         resume (UploadFile): files
+        request (Request): incoming request
 
     Returns:
         None
     """
-    allowed_types = [
-        "text/xml",
-        "text/html",
-        "application/pdf",
-        "application/msword",
-        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-    ]
-    if resume.content_type not in allowed_types:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Only PDF, DOCX, HTML allowed",
-        )
+    await admit(request, scheduler.RESUME_LANE)
     file_name = resume.filename
     current_dir = os.path.dirname(__file__)
     list_of_folders = current_dir.split("api")
@@ -128,6 +288,13 @@ async def resume_submission(resume: UploadFile):
             )
         temp.write(chunk)
     temp.close()
+    # the type comes from the content, a mislabelled file is never queued
+    if io.detect_file_type(temp.name) is None:
+        os.remove(temp.name)
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Only PDF, DOCX, DOC, HTML allowed",
+        )
     if os.path.isdir(target_dir) and "resume_loc" in target_dir:
         final_file_dest = os.path.join(target_dir, file_name)
         shutil.move(temp.name, final_file_dest)
@@ -137,32 +304,58 @@ async def resume_submission(resume: UploadFile):
         task_name = dc.Task(task="resume_upload")
         uid = str(uuid4())
         time = datetime.utcnow().isoformat()
-        status_code = 202
-        status_name = "Queued"
-        await rw.update_message(
-            # db,uid,data,time,queue_name,task
-            db=db_connections["redis_queue"],
-            uid=uid,
-            data=final_file_dest,
-            time=time,
-            queue_name="worker_queue",
-            task=task_name,
+        await submit_job(
+            uid,
+            final_file_dest,
+            time,
+            task_name,
+            scheduler.RESUME_LANE,
+            scheduler.estimate_cost(
+                task_name.task, final_file_dest, file_size=real_file_size
+            ),
         )
-        await rw.redis_save_to_db(
-            db=db_connections["redis_db"],
-            uid=uid,
-            data=final_file_dest,
-            time=time,
-            task=task_name,
-            status_code=status_code,
-            status_name=status_name,
-            final_result=None,
+        return JSONResponse(
+            content={"message": "File uploaded successfully", "uid": uid},
+            status_code=200,
+            headers={"X-Job-Uid": uid},
         )
+    except aioredis.RedisError as e:
         return JSONResponse(
-            content={"message": "File uploaded successfully"}, status_code=200
+            content={"message": f"Errors:\n{e}"},
+            status_code=503,
+            headers={"Retry-After": str(admission.OVERLOAD_RETRY_AFTER)},
         )
-    except HTTPException as e:
-        return JSONResponse(content={"message": f"Errors:\n{e}"}, status_code=500)
+
+
+@app.get("/health")
+async def health():
+    """
+    function for checking redis and the utilization of its connection pools
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    reachable = {}
+    for name, db in db_connections.items():
+        # a sharded job store is reachable when every shard is
+        reachable[name] = True
+        for client in rw.store_clients(db):
+            if not isinstance(client, aioredis.Redis):
+                continue
+            try:
+                reachable[name] = reachable[name] and await client.ping()
+            except aioredis.RedisError:
+                reachable[name] = False
+    content_dict = {
+        "redis": reachable,
+        "pools": connections.manager.metrics(),
+        "result_cache": completed_results.stats(),
+    }
+    status_code = 200 if all(reachable.values()) else 503
+    return JSONResponse(content=content_dict, status_code=status_code)
 
 
 @app.get("/jobs/")
@@ -180,25 +373,280 @@ async def item_lists():
     return JSONResponse(content={"uids": uids_list}, status_code=200)
 
 
+def encoded_response(request: Request, body: result_cache.EncodedBody) -> Response:
+    """
+    Sends a body gzipped when the client accepts it, or 304 when the client
+    already holds it
+
+    Args:
+        request (Request): incoming request
+        body (result_cache.EncodedBody): serialized body
+
+    Returns:
+        Response: 200 with the body or 304 without
+    """
+    content, etag, gzipped = body.encoded(request.headers.get("accept-encoding"))
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if body.matches(request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        content=content,
+        status_code=200,
+        media_type="application/json",
+        headers=headers,
+    )
+
+
 @app.get("/jobs/{job_uid}")
-async def read_item(job_uid: str):
+async def read_item(job_uid: str, request: Request):
     """
-    function for getting job_status
+    function for getting job_status, completed jobs are answered from
+    memory, with an ETag honoured in If-None-Match
 
     Args:
         job_uid (str): string uid of job
+        request (Request): incoming request
 
     Returns:
         None
     """
-    status_name, status_code, final_result = await rw.get_job_status(
-        db_connections["redis_db"], job_uid
-    )
+    body = completed_results.get(job_uid)
+    if body is None:
+        status_name, status_code, final_result = await rw.get_job_status(
+            db_connections["redis_db"], job_uid
+        )
+        content_dict = {
+            "uid": job_uid,
+            "status_code_of_internal_process": status_code,
+            "job_status": status_name,
+            "result": final_result,
+        }
+        body = result_cache.EncodedBody(content_dict)
+        if status_code in TERMINAL_STATUS_CODES:
+            completed_results.put(job_uid, body)
+    return encoded_response(request, body)
+
+
+@app.get("/match/{resume_uid}")
+async def match_resume(resume_uid: str, top_k: int = 10, metric: str = "jaccard"):
+    """
+    function for ranking stored job ads against the skills of a resume
+
+    Args:
+        resume_uid (str): string uid of a processed resume
+        top_k (int): number of job ads to return
+        metric (str): jaccard or coverage, see matching.SkillIndex.query
+
+    Returns:
+        None
+    """
+    if metric not in matching.METRICS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"metric must be one of {matching.METRICS}",
+        )
+    skills = skill_index.skills_of(resume_uid)
+    if skills is None:
+        status_name, status_code, final_result = await rw.get_job_status(
+            db_connections["redis_db"], resume_uid
+        )
+        if status_code != 200:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"{resume_uid} has no completed result, status: {status_name}",
+            )
+        skills = matching.skills_from_result(final_result)
+    matches = skill_index.query(skills, top_k=top_k, metric=metric)
     content_dict = {
-        "uid": job_uid,
-        "status_code_of_internal_process": status_code,
-        "job_status": status_name,
-        "result": final_result,
+        "uid": resume_uid,
+        "skills": skills,
+        "matches": [
+            {"uid": uid, "score": score, "overlap": overlap}
+            for uid, score, overlap in matches
+        ],
     }
-
     return JSONResponse(content=content_dict, status_code=200)
+
+
+def epoch_or_none(time: Optional[datetime]) -> Optional[float]:
+    """
+    Converts an optional query parameter datetime to epoch seconds
+
+    Args:
+        time (Optional[datetime]): datetime, naive ones are taken as utc
+
+    Returns:
+        Optional[float]: seconds since epoch or None
+    """
+    if time is None:
+        return None
+    return rw.to_epoch(time.isoformat())
+
+
+@app.get("/skills/top")
+async def skills_top(
+    k: int = 50,
+    task: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """
+    function for getting the most mentioned skills over completed jobs
+
+    Args:
+        k (int): number of skills to return
+        task (Optional[str]): only jobs of this task
+        since (Optional[datetime]): only jobs submitted at or after
+        until (Optional[datetime]): only jobs submitted at or before
+
+    Returns:
+        None
+    """
+    skills = await analytics.top_skills(
+        db_connections["redis_db"], k, task, epoch_or_none(since), epoch_or_none(until)
+    )
+    return JSONResponse(content={"skills": skills}, status_code=200)
+
+
+@app.get("/skills/{skill}/jobs")
+async def skill_jobs(
+    skill: str,
+    task: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    offset: int = 0,
+    limit: int = 50,
+):
+    """
+    function for getting completed jobs which mention a skill
+
+    Args:
+        skill (str): skill or technology
+        task (Optional[str]): only jobs of this task
+        since (Optional[datetime]): only jobs submitted at or after
+        until (Optional[datetime]): only jobs submitted at or before
+        offset (int): number of matching jobs to skip
+        limit (int): most jobs to return
+
+    Returns:
+        None
+    """
+    jobs = await analytics.jobs_with_skill(
+        db_connections["redis_db"],
+        skill,
+        task,
+        epoch_or_none(since),
+        epoch_or_none(until),
+        offset,
+        limit,
+    )
+    return JSONResponse(content={"skill": skill, **jobs}, status_code=200)
+
+
+@app.get("/skills/{skill}/cooccurrence")
+async def skill_cooccurrence(
+    skill: str,
+    k: int = 20,
+    task: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """
+    function for getting skills most often mentioned together with a skill
+
+    Args:
+        skill (str): skill or technology
+        k (int): number of skills to return
+        task (Optional[str]): only jobs of this task
+        since (Optional[datetime]): only jobs submitted at or after
+        until (Optional[datetime]): only jobs submitted at or before
+
+    Returns:
+        None
+    """
+    skills = await analytics.skill_cooccurrence(
+        db_connections["redis_db"],
+        skill,
+        k,
+        task,
+        epoch_or_none(since),
+        epoch_or_none(until),
+    )
+    return JSONResponse(content={"skill": skill, "skills": skills}, status_code=200)
+
+
+@app.get("/skills/{skill}/counts")
+async def skill_counts(
+    skill: str,
+    bucket: str = "day",
+    task: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """
+    function for getting the number of jobs mentioning a skill over time
+
+    Args:
+        skill (str): skill or technology
+        bucket (str): hour, day or week
+        task (Optional[str]): only jobs of this task
+        since (Optional[datetime]): only jobs submitted at or after
+        until (Optional[datetime]): only jobs submitted at or before
+
+    Returns:
+        None
+    """
+    if bucket not in analytics.BUCKET_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"bucket must be one of {list(analytics.BUCKET_SECONDS)}",
+        )
+    counts = await analytics.skill_counts_over_time(
+        db_connections["redis_db"],
+        skill,
+        bucket,
+        task,
+        epoch_or_none(since),
+        epoch_or_none(until),
+    )
+    return JSONResponse(content={"skill": skill, "counts": counts}, status_code=200)
+
+
+@app.get("/export")
+async def export_jobs(
+    task: Optional[str] = None,
+    status_code: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    compress: bool = False,
+):
+    """
+    function for streaming every matching job as ndjson, read from redis in
+    bounded batches
+
+    Args:
+        task (Optional[str]): only jobs of this task
+        status_code (Optional[int]): only jobs with this status code
+        since (Optional[datetime]): only jobs submitted at or after
+        until (Optional[datetime]): only jobs submitted at or before
+        compress (bool): gzip the stream
+
+    Returns:
+        None
+    """
+    chunks = export.export_ndjson(
+        db_connections["redis_db"],
+        compress,
+        task,
+        status_code,
+        epoch_or_none(since),
+        epoch_or_none(until),
+    )
+    file_name = "jobs.ndjson.gz" if compress else "jobs.ndjson"
+    return StreamingResponse(
+        chunks,
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
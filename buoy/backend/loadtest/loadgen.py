@@ -0,0 +1,428 @@
+"""
+Open-loop load generator for the buoy backend.
+
+Starts the api (uvicorn) and a number of workers against local Redis
+instances, replays a mix of /text_chunk/ and /resume/ submissions at a fixed
+Poisson arrival rate, polls /jobs/{uid} until every job finishes and reports
+latency percentiles, throughput, queue depth over time and error rates.
+
+Run from the backend folder, with a redis on 6379 and a redis-stack on 6380:
+
+    python -m loadtest.loadgen --rate 5 --duration 60 --workers 1,2,4
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+from uuid import uuid4
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+from redis import asyncio as aioredis
+
+from redis_package import scheduler
+
+
+TERMINAL_STATUS_CODES = [200, 500]
+LANES = list(scheduler.LANE_WEIGHTS) + [scheduler.LEGACY_QUEUE]
+
+SKILLS = [
+    "Python",
+    "Kubernetes",
+    "PySpark",
+    "SQL",
+    "Docker",
+    "Terraform",
+    "React",
+    "stakeholder management",
+    "machine learning",
+    "AWS",
+]
+FILLER = [
+    "You will join a friendly team building data products for our customers",
+    "We offer flexible working hours and a generous learning budget",
+    "The role reports to the head of engineering",
+    "We are an equal opportunity employer and value diversity",
+    "Our office is located in the city centre close to public transport",
+]
+
+
+def fake_sentence(rng: random.Random) -> str:
+    if rng.random() < 0.5:
+        return rng.choice(FILLER) + "."
+    skills = rng.sample(SKILLS, k=rng.randint(1, 3))
+    return f"Experience with {' and '.join(skills)} is required."
+
+
+def fake_text(rng: random.Random, min_chars: int, max_chars: int) -> str:
+    """
+    Builds a synthetic job ad of roughly min_chars to max_chars characters
+
+    Args:
+        rng (random.Random): seeded random generator
+        min_chars (int): lower bound of the text length
+        max_chars (int): upper bound of the text length
+
+    Returns:
+        str: job ad text
+    """
+    target = rng.randint(min_chars, max_chars)
+    sentences = []
+    while sum(len(sentence) + 1 for sentence in sentences) < target:
+        sentences.append(fake_sentence(rng))
+    return " ".join(sentences)
+
+
+def fake_resume_html(rng: random.Random) -> bytes:
+    body = "".join(f"<p>{fake_sentence(rng)}</p>" for _ in range(rng.randint(10, 40)))
+    return f"<html><body><h1>Resume</h1>{body}</body></html>".encode()
+
+
+def stub_mega_job(text: str, ms_per_kchar: float) -> dict:
+    """
+    Stand-in for txt_parse_w_spacy_mnli.mega_job with a cost proportional to
+    the text length, returns a result of the same structure
+
+    Args:
+        text (str): cleaned text of the job
+        ms_per_kchar (float): busy time per 1000 characters
+
+    Returns:
+        Dict[str, list]: structured result
+    """
+    deadline = time.perf_counter() + len(text) / 1000 * ms_per_kchar / 1000
+    # busy wait, a worker running inference holds the cpu
+    while time.perf_counter() < deadline:
+        pass
+    entities = []
+    lowered = text.lower()
+    for skill in SKILLS:
+        start = lowered.find(skill.lower())
+        if start >= 0:
+            entities.append(
+                {
+                    "text": skill,
+                    "label": "technology",
+                    "score": 1.0,
+                    "start": start,
+                    "end": start + len(skill),
+                    "sent": 0,
+                }
+            )
+    return {"sentences": [text[:200]], "entities": entities}
+
+
+def run_worker(engine: str, ms_per_kchar: float) -> None:
+    """
+    Entry point of a worker process started by the harness
+
+    Args:
+        engine (str): stub or real
+        ms_per_kchar (float): busy time per 1000 characters of the stub
+    """
+    from worker import processor
+
+    if engine == "stub":
+        processor.tpt_spacy.mega_job = lambda text: stub_mega_job(text, ms_per_kchar)
+    asyncio.run(processor.main())
+
+
+class Stats:
+    """
+    Collects the outcome of every submission of one run
+    """
+
+    def __init__(self):
+        self.submitted = 0
+        self.submit_codes = Counter()
+        self.submit_latencies: List[float] = []
+        self.result_latencies: Dict[str, List[float]] = {"text": [], "resume": []}
+        self.job_status = Counter()
+        self.errors = Counter()
+        self.polls = 0
+        self.queue_depth: List[dict] = []
+        self.elapsed = 0.0
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 4)
+
+    return {
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(values[-1], 4),
+    }
+
+
+async def submit_and_wait(
+    client: httpx.AsyncClient,
+    kind: str,
+    rng: random.Random,
+    stats: Stats,
+    args: argparse.Namespace,
+) -> None:
+    started = time.perf_counter()
+    stats.submitted += 1
+    # one rate limit bucket per simulated client
+    headers = {"X-Client-Id": f"loadtest-{rng.randrange(args.clients)}"}
+    try:
+        if kind == "text":
+            if rng.random() < args.long_text_share:
+                text = fake_text(rng, 6000, 20000)
+            else:
+                text = fake_text(rng, 200, 2000)
+            response = await client.post(
+                "/text_chunk/", json={"text_chunk": text}, headers=headers
+            )
+        else:
+            # the api saves uploads under their filename, a shared name would
+            # let concurrent resume jobs read each other's files
+            filename = f"resume-{uuid4().hex}.html"
+            files = {"resume": (filename, fake_resume_html(rng), "text/html")}
+            response = await client.post("/resume/", files=files, headers=headers)
+    except httpx.HTTPError as e:
+        stats.errors[type(e).__name__] += 1
+        return
+    stats.submit_latencies.append(time.perf_counter() - started)
+    stats.submit_codes[response.status_code] += 1
+    uid = response.headers.get("x-job-uid")
+    if response.status_code != 200 or not uid:
+        return
+    deadline = started + args.job_timeout
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(args.poll_interval)
+        stats.polls += 1
+        try:
+            poll = await client.get(f"/jobs/{uid}")
+            body = poll.json()
+        except (httpx.HTTPError, ValueError) as e:
+            stats.errors[f"poll {type(e).__name__}"] += 1
+            continue
+        if body.get("status_code_of_internal_process") in TERMINAL_STATUS_CODES:
+            stats.job_status[body["status_code_of_internal_process"]] += 1
+            stats.result_latencies[kind].append(time.perf_counter() - started)
+            return
+    stats.job_status["timeout"] += 1
+
+
+async def sample_queue_depth(queue: aioredis.Redis, stats: Stats, started: float):
+    while True:
+        async with queue.pipeline(transaction=False) as pipe:
+            for lane in LANES:
+                pipe.llen(lane)
+            depths = await pipe.execute()
+        stats.queue_depth.append(
+            {"t": round(time.perf_counter() - started, 1), **dict(zip(LANES, depths))}
+        )
+        await asyncio.sleep(1)
+
+
+async def drive(args: argparse.Namespace, base_url: str, seed: int) -> Stats:
+    """
+    Replays open-loop traffic, arrivals do not wait for earlier responses
+
+    Args:
+        args (argparse.Namespace): parsed command line
+        base_url (str): url of the api
+        seed (int): seed of the traffic mix
+
+    Returns:
+        Stats: outcome of the run
+    """
+    rng = random.Random(seed)
+    stats = Stats()
+    queue = aioredis.Redis(host=args.queue_host, port=args.queue_port)
+    limits = httpx.Limits(max_connections=args.max_connections)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+        started = time.perf_counter()
+        sampler = asyncio.create_task(sample_queue_depth(queue, stats, started))
+        jobs = []
+        next_arrival = started
+        while next_arrival - started < args.duration:
+            kind = "resume" if rng.random() < args.resume_share else "text"
+            jobs.append(
+                asyncio.create_task(submit_and_wait(client, kind, rng, stats, args))
+            )
+            next_arrival += rng.expovariate(args.rate)
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+        await asyncio.gather(*jobs)
+        stats.elapsed = time.perf_counter() - started
+        sampler.cancel()
+    await queue.close()
+    return stats
+
+
+def report(stats: Stats, workers: int) -> dict:
+    completed = sum(
+        count for status, count in stats.job_status.items() if status == 200
+    )
+    failed_submits = sum(
+        count for code, count in stats.submit_codes.items() if code != 200
+    )
+    return {
+        "workers": workers,
+        "submitted": stats.submitted,
+        "elapsed_s": round(stats.elapsed, 2),
+        "throughput_jobs_per_s": round(completed / max(stats.elapsed, 1e-9), 3),
+        "submit_status_codes": dict(stats.submit_codes),
+        "job_status": {str(k): v for k, v in stats.job_status.items()},
+        "submit_error_rate": round(
+            (failed_submits + sum(stats.errors.values())) / max(1, stats.submitted), 4
+        ),
+        "errors": dict(stats.errors),
+        "polls": stats.polls,
+        "submit_latency_s": percentiles(stats.submit_latencies),
+        "result_latency_s": {
+            kind: percentiles(values)
+            for kind, values in stats.result_latencies.items()
+        },
+        "max_queue_depth": {
+            lane: max((sample[lane] for sample in stats.queue_depth), default=0)
+            for lane in LANES
+        },
+        "queue_depth": stats.queue_depth,
+    }
+
+
+def start_api(args: argparse.Namespace, env: dict) -> subprocess.Popen:
+    api = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "api.main:app",
+            "--port",
+            str(args.api_port),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{args.api_port}/docs", timeout=1)
+            return api
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    api.terminate()
+    raise RuntimeError("api did not start within 30s")
+
+
+async def flush(args: argparse.Namespace) -> None:
+    for host, port in [
+        (args.queue_host, args.queue_port),
+        (args.db_host, args.db_port),
+    ]:
+        db = aioredis.Redis(host=host, port=port)
+        await db.flushdb()
+        await db.close()
+
+
+def run_config(args: argparse.Namespace, workers: int, env: dict) -> dict:
+    if args.flush:
+        asyncio.run(flush(args))
+    os.environ.update(env)
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args.engine, args.stub_ms_per_kchar))
+        for _ in range(workers)
+    ]
+    api = None if args.base_url else start_api(args, env)
+    try:
+        for process in processes:
+            process.start()
+        base_url = args.base_url or f"http://127.0.0.1:{args.api_port}"
+        stats = asyncio.run(drive(args, base_url, args.seed))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=30)
+        if api is not None:
+            api.terminate()
+            api.wait(timeout=30)
+    return report(stats, workers)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=float, default=5.0, help="submissions/s")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument(
+        "--workers", default="1", help="comma separated worker counts to sweep"
+    )
+    parser.add_argument("--resume-share", type=float, default=0.1)
+    parser.add_argument(
+        "--long-text-share",
+        type=float,
+        default=0.1,
+        help="share of text chunks long enough for the bulk lane",
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--job-timeout", type=float, default=600.0)
+    parser.add_argument("--engine", choices=["stub", "real"], default="stub")
+    parser.add_argument("--stub-ms-per-kchar", type=float, default=50.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=1,
+        help="distinct X-Client-Id values, spreads the per client rate limit",
+    )
+    parser.add_argument(
+        "--base-url", help="drive an already running api instead of starting one"
+    )
+    parser.add_argument("--api-port", type=int, default=8800)
+    parser.add_argument("--queue-host", default="localhost")
+    parser.add_argument("--queue-port", type=int, default=6379)
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", type=int, default=6380)
+    parser.add_argument(
+        "--flush", action="store_true", help="FLUSHDB both redis before each run"
+    )
+    parser.add_argument("--out", help="write the full report as json to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    env = dict(
+        os.environ,
+        BUOY_REDIS_QUEUE_HOST=args.queue_host,
+        BUOY_REDIS_QUEUE_PORT=str(args.queue_port),
+        BUOY_REDIS_DB_HOST=args.db_host,
+        BUOY_REDIS_DB_PORT=str(args.db_port),
+        # the api only honours X-Client-Id from trusted proxies
+        BUOY_TRUSTED_PROXIES="127.0.0.1",
+    )
+    reports = []
+    for workers in [int(count) for count in args.workers.split(",")]:
+        print(f"running {args.duration}s at {args.rate} req/s with {workers} workers")
+        result = run_config(args, workers, env)
+        reports.append(result)
+        summary = {k: v for k, v in result.items() if k != "queue_depth"}
+        print(json.dumps(summary, indent=2))
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,8 @@
 from . import redis_wrapper
+from . import scheduler
+from . import admission
+from . import analytics
+from . import backends
+from . import connections
+from . import sharding
+from . import export
@@ -0,0 +1,219 @@
+import os
+import math
+import time
+from typing import Dict, Optional, Tuple, Union
+
+from redis import asyncio as aioredis
+
+from . import scheduler
+from .backends import QueueBackend
+from .redis_wrapper import as_queue
+
+
+# most jobs a lane may hold before new work for it is turned away, keeps the
+# wait of every accepted job bounded instead of growing with the backlog
+MAX_LANE_DEPTH = {
+    scheduler.INTERACTIVE_LANE: int(os.getenv("BUOY_MAX_DEPTH_INTERACTIVE", 200)),
+    scheduler.BULK_LANE: int(os.getenv("BUOY_MAX_DEPTH_BULK", 100)),
+    scheduler.RESUME_LANE: int(os.getenv("BUOY_MAX_DEPTH_RESUME", 50)),
+}
+DEPTH_CACHE_SECONDS = float(os.getenv("BUOY_DEPTH_CACHE_SECONDS", 1.0))
+OVERLOAD_RETRY_AFTER = int(os.getenv("BUOY_OVERLOAD_RETRY_AFTER", 10))
+
+# per client token bucket, RATE tokens refilled per second up to BURST
+RATE_LIMIT_RATE = float(os.getenv("BUOY_RATE_LIMIT_RATE", 2.0))
+RATE_LIMIT_BURST = int(os.getenv("BUOY_RATE_LIMIT_BURST", 10))
+RATE_LIMIT_PREFIX = "ratelimit:"
+# addresses of reverse proxies allowed to name the client in X-Client-Id,
+# comma separated, any other caller is limited by its own address
+TRUSTED_PROXIES = {
+    host.strip()
+    for host in os.getenv("BUOY_TRUSTED_PROXIES", "").split(",")
+    if host.strip()
+}
+
+# KEYS[1] bucket key, ARGV rate, burst, cost
+# refill and take in one script so concurrent api workers never race
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class QueueDepthCache:
+    """
+    Caches LLEN of every lane so admission checks cost at most one pipelined
+    round trip per DEPTH_CACHE_SECONDS instead of one per request.
+    """
+
+    def __init__(self, ttl: float = DEPTH_CACHE_SECONDS):
+        self.ttl = ttl
+        self.depths: Dict[str, int] = {}
+        self.fetched_at = 0.0
+
+    async def get(self, db: Union[aioredis.Redis, QueueBackend]) -> Dict[str, int]:
+        """
+        Returns depth of every lane, refreshing from the queue when stale
+
+        Args:
+            db (Union[aioredis.Redis, QueueBackend]): redis queue or backend
+
+        Returns:
+            Dict[str, int]: lane name to number of queued jobs
+        """
+        now = time.monotonic()
+        if now - self.fetched_at > self.ttl:
+            lanes = list(MAX_LANE_DEPTH)
+            lengths = await as_queue(db).depths(lanes)
+            self.depths = dict(zip(lanes, lengths))
+            self.fetched_at = now
+        return self.depths
+
+    def note_enqueued(self, lane: str) -> None:
+        """
+        Counts a job queued since the last refresh so bursts within one
+        cache window cannot overshoot the lane limit
+
+        Args:
+            lane (str): lane the job was queued on
+        """
+        self.depths[lane] = self.depths.get(lane, 0) + 1
+
+
+def client_key(host: Optional[str], client_id: Optional[str]) -> str:
+    """
+    Picks the identity a client is rate limited by, the X-Client-Id header
+    only counts when sent by a trusted proxy, as any caller could send a new
+    one with every request
+
+    Args:
+        host (Optional[str]): address of the caller
+        client_id (Optional[str]): X-Client-Id header
+
+    Returns:
+        str: key of the client's token bucket
+    """
+    if client_id and host in TRUSTED_PROXIES:
+        return client_id
+    return host or "anonymous"
+
+
+# buckets of the embedded mode, where there is no redis to hold them
+local_buckets: Dict[str, Tuple[float, float]] = {}
+# monotonic time local_buckets was last pruned
+local_pruned_at = 0.0
+
+
+def prune_local_buckets(rate: float, burst: int) -> None:
+    """
+    Forgets buckets idle long enough to have refilled, as redis expires them,
+    so the embedded mode keeps one bucket per active client
+
+    Args:
+        rate (float): tokens refilled per second
+        burst (int): bucket capacity
+    """
+    global local_pruned_at
+    now = time.monotonic()
+    refill_seconds = burst / rate
+    if now - local_pruned_at < refill_seconds:
+        return
+    local_pruned_at = now
+    for client_id, (_, ts) in list(local_buckets.items()):
+        if now - ts >= refill_seconds:
+            del local_buckets[client_id]
+
+
+def take_local_token(
+    client_id: str, rate: float, burst: int, cost: int
+) -> Tuple[bool, int]:
+    """
+    Same token bucket as TOKEN_BUCKET_LUA, kept in process memory
+
+    Args:
+        client_id (str): identifier of the calling client
+        rate (float): tokens refilled per second
+        burst (int): bucket capacity
+        cost (int): tokens this request takes
+
+    Returns:
+        tuple: (allowed, retry_after) where retry_after is in whole seconds
+    """
+    prune_local_buckets(rate, burst)
+    now = time.monotonic()
+    tokens, ts = local_buckets.get(client_id, (burst, now))
+    tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+    allowed, wait = False, 0.0
+    if tokens >= cost:
+        tokens -= cost
+        allowed = True
+    else:
+        wait = (cost - tokens) / rate
+    local_buckets[client_id] = (tokens, now)
+    return allowed, math.ceil(wait)
+
+
+async def take_token(
+    db: Union[aioredis.Redis, QueueBackend],
+    client_id: str,
+    rate: float = RATE_LIMIT_RATE,
+    burst: int = RATE_LIMIT_BURST,
+    cost: int = 1,
+) -> Tuple[bool, int]:
+    """
+    Takes tokens from the client's bucket stored in Redis, or in process
+    memory when db is an in-process backend
+
+    Args:
+        db (Union[aioredis.Redis, QueueBackend]): redis instance holding the
+            buckets
+        client_id (str): identifier of the calling client
+        rate (float): tokens refilled per second
+        burst (int): bucket capacity
+        cost (int): tokens this request takes
+
+    Returns:
+        tuple: (allowed, retry_after) where retry_after is in whole seconds
+    """
+    if not isinstance(db, aioredis.Redis):
+        return take_local_token(client_id, rate, burst, cost)
+    script = db.register_script(TOKEN_BUCKET_LUA)
+    allowed, wait = await script(
+        keys=[f"{RATE_LIMIT_PREFIX}{client_id}"], args=[rate, burst, cost]
+    )
+    return bool(int(allowed)), math.ceil(float(wait))
+
+
+def lane_has_capacity(depths: Dict[str, int], lane: str) -> bool:
+    """
+    Checks a lane against its configured maximum depth
+
+    Args:
+        depths (Dict[str, int]): lane depths from QueueDepthCache
+        lane (str): lane the job would be queued on
+
+    Returns:
+        bool: True when the job may be queued
+    """
+    limit = MAX_LANE_DEPTH.get(lane)
+    if limit is None:
+        return True
+    return depths.get(lane, 0) < limit
@@ -0,0 +1,327 @@
+import re
+import math
+import asyncio
+from collections import Counter
+from itertools import chain
+from typing import List, Optional
+
+from redis import asyncio as aioredis
+from redis.commands.search import reducers
+from redis.commands.search.aggregation import AggregateRequest, Asc, Desc
+from redis.commands.search.query import Query
+
+from .backends import MemoryJobStore
+from .redis_wrapper import JOBS_INDEX, store_clients
+
+
+# rows fetched per FT.CURSOR READ, keeps every reply small so long
+# aggregations never block redis_db for live traffic
+CURSOR_COUNT = 1000
+BUCKET_SECONDS = {"hour": 60 * 60, "day": 24 * 60 * 60, "week": 7 * 24 * 60 * 60}
+
+TAG_SPECIAL_CHARS = re.compile(r"([,.<>{}\[\]\"':;!@#$%^&*()\-+=~|/\\\s])")
+
+
+def escape_tag(value: str) -> str:
+    """
+    Escapes a value for use inside a TAG query, e.g. @skills:{value}
+
+    Args:
+        value (str): raw tag value
+
+    Returns:
+        str: escaped tag value
+    """
+    return TAG_SPECIAL_CHARS.sub(r"\\\1", value.strip().lower())
+
+
+def build_query(
+    skill: Optional[str] = None,
+    task: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> str:
+    """
+    Builds the search query over completed jobs
+
+    Args:
+        skill (Optional[str]): only jobs mentioning this skill or technology
+        task (Optional[str]): only jobs of this task
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+
+    Returns:
+        str: RediSearch query string
+    """
+    parts = ["@status_code:[200 200]"]
+    if skill:
+        tag = escape_tag(skill)
+        parts.append(f"(@skills:{{{tag}}} | @technologies:{{{tag}}})")
+    if task:
+        parts.append(f"@task:{{{escape_tag(task)}}}")
+    if since is not None or until is not None:
+        low = "-inf" if since is None else since
+        high = "+inf" if until is None else until
+        parts.append(f"@ts:[{low} {high}]")
+    return " ".join(parts)
+
+
+def _memory_search(
+    db: MemoryJobStore,
+    skill: Optional[str],
+    task: Optional[str],
+    since: Optional[float],
+    until: Optional[float],
+) -> List[dict]:
+    # embedded mode, the same filters as build_query over the in-process index
+    tag = skill.strip().lower() if skill else None
+    return db.search(tag, task, since, until)
+
+
+def _top(counts: Counter, k: int) -> List[dict]:
+    return [{"skill": skill, "count": count} for skill, count in counts.most_common(k)]
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def aggregate_all(db: aioredis.Redis, request: AggregateRequest) -> List[dict]:
+    """
+    Runs an aggregation with a cursor and reads every batch
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        request (AggregateRequest): aggregation, a cursor is added to it
+
+    Returns:
+        List[dict]: one dict per result row
+    """
+    rows = []
+    result = await db.ft(JOBS_INDEX).aggregate(request.cursor(count=CURSOR_COUNT))
+    while True:
+        for row in result.rows:
+            row = [_decode(value) for value in row]
+            rows.append(dict(zip(row[::2], row[1::2])))
+        if result.cursor is None or not result.cursor.cid:
+            return rows
+        result = await db.ft(JOBS_INDEX).aggregate(result.cursor)
+
+
+async def aggregate_shards(db, request: AggregateRequest) -> List[List[dict]]:
+    """
+    Runs an aggregation on every shard of the job store concurrently
+
+    Args:
+        db: redis_db instance of aioredis or sharded job store
+        request (AggregateRequest): aggregation, a cursor is added to it
+
+    Returns:
+        List[List[dict]]: rows of each shard
+    """
+    return await asyncio.gather(
+        *(aggregate_all(client, request) for client in store_clients(db))
+    )
+
+
+def _merge_counts(shard_rows: List[List[dict]], key: str) -> Counter:
+    counts = Counter()
+    for rows in shard_rows:
+        for row in rows:
+            counts[row[key]] += int(row["count"])
+    return counts
+
+
+def _skill_counts_request(query: str, k: int) -> AggregateRequest:
+    request = (
+        AggregateRequest(query)
+        .load("$.message.skills_csv", "AS", "skills_csv")
+        .filter("@skills_csv != ''")
+        .apply(skill="split(@skills_csv)")
+        .group_by("@skill", reducers.count().alias("count"))
+    )
+    # k of 0 returns every skill unsorted, a skill outside the top k of each
+    # shard can still be in the top k overall
+    if k:
+        request = request.sort_by(Desc("@count"), max=k)
+    return request
+
+
+def _shard_k(db, k: int) -> int:
+    return k if len(store_clients(db)) == 1 else 0
+
+
+async def top_skills(
+    db: aioredis.Redis,
+    k: int = 50,
+    task: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> List[dict]:
+    """
+    Most mentioned skills and technologies over completed jobs
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        k (int): number of skills to return
+        task (Optional[str]): only jobs of this task
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+
+    Returns:
+        List[dict]: {"skill": str, "count": int} most mentioned first
+    """
+    if isinstance(db, MemoryJobStore):
+        messages = _memory_search(db, None, task, since, until)
+        return _top(db.tag_counts(messages), k)
+    request = _skill_counts_request(
+        build_query(None, task, since, until), _shard_k(db, k)
+    )
+    return _top(_merge_counts(await aggregate_shards(db, request), "skill"), k)
+
+
+async def skill_cooccurrence(
+    db: aioredis.Redis,
+    skill: str,
+    k: int = 20,
+    task: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> List[dict]:
+    """
+    Skills and technologies most often mentioned in the same jobs as skill
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        skill (str): skill or technology to find co-occurrences of
+        k (int): number of skills to return
+        task (Optional[str]): only jobs of this task
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+
+    Returns:
+        List[dict]: {"skill": str, "count": int} most co-occurring first
+    """
+    # one extra row as skill itself co-occurs with every job it is in
+    if isinstance(db, MemoryJobStore):
+        messages = _memory_search(db, skill, task, since, until)
+        rows = _top(db.tag_counts(messages), k + 1)
+    else:
+        request = _skill_counts_request(
+            build_query(skill, task, since, until), _shard_k(db, k + 1)
+        )
+        rows = _top(_merge_counts(await aggregate_shards(db, request), "skill"), k + 1)
+    skill = skill.strip().lower()
+    return [
+        {"skill": row["skill"], "count": int(row["count"])}
+        for row in rows
+        if row["skill"] != skill
+    ][:k]
+
+
+async def skill_counts_over_time(
+    db: aioredis.Redis,
+    skill: str,
+    bucket: str = "day",
+    task: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> List[dict]:
+    """
+    Number of completed jobs mentioning skill per time bucket
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        skill (str): skill or technology to count
+        bucket (str): hour, day or week
+        task (Optional[str]): only jobs of this task
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+
+    Returns:
+        List[dict]: {"bucket": epoch seconds, "count": int} oldest first
+    """
+    seconds = BUCKET_SECONDS[bucket]
+    if isinstance(db, MemoryJobStore):
+        counts = Counter(
+            math.floor(message["ts_epoch"] / seconds) * seconds
+            for message in _memory_search(db, skill, task, since, until)
+        )
+        return [
+            {"bucket": float(bucket), "count": count}
+            for bucket, count in sorted(counts.items())
+        ]
+    request = (
+        AggregateRequest(build_query(skill, task, since, until))
+        .apply(bucket=f"floor(@ts / {seconds}) * {seconds}")
+        .group_by("@bucket", reducers.count().alias("count"))
+        .sort_by(Asc("@bucket"))
+    )
+    counts = _merge_counts(await aggregate_shards(db, request), "bucket")
+    return [
+        {"bucket": float(bucket), "count": count}
+        for bucket, count in sorted(counts.items(), key=lambda item: float(item[0]))
+    ]
+
+
+async def jobs_with_skill(
+    db: aioredis.Redis,
+    skill: str,
+    task: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    offset: int = 0,
+    limit: int = 50,
+) -> dict:
+    """
+    Completed jobs mentioning skill, newest first
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        skill (str): skill or technology to look for
+        task (Optional[str]): only jobs of this task
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+        offset (int): number of matching jobs to skip
+        limit (int): most jobs to return
+
+    Returns:
+        dict: "total" number of matching jobs and "uids" of this page
+    """
+    if isinstance(db, MemoryJobStore):
+        messages = _memory_search(db, skill, task, since, until)
+        messages.sort(key=lambda message: message["ts_epoch"], reverse=True)
+        return {
+            "total": len(messages),
+            "uids": [message["uid"] for message in messages[offset : offset + limit]],
+        }
+    clients = store_clients(db)
+    if len(clients) == 1:
+        query = (
+            Query(build_query(skill, task, since, until))
+            .return_fields("uid")
+            .sort_by("ts", asc=False)
+            .paging(offset, limit)
+        )
+        result = await db.ft(JOBS_INDEX).search(query)
+        return {"total": result.total, "uids": [doc.uid for doc in result.docs]}
+    # the page can come from any shard, each returns its first offset + limit
+    # jobs which are merged by time
+    query = (
+        Query(build_query(skill, task, since, until))
+        .return_fields("uid", "ts")
+        .sort_by("ts", asc=False)
+        .paging(0, offset + limit)
+    )
+    results = await asyncio.gather(
+        *(client.ft(JOBS_INDEX).search(query) for client in clients)
+    )
+    docs = sorted(
+        chain.from_iterable(result.docs for result in results),
+        key=lambda doc: float(doc.ts),
+        reverse=True,
+    )
+    return {
+        "total": sum(result.total for result in results),
+        "uids": [doc.uid for doc in docs[offset : offset + limit]],
+    }
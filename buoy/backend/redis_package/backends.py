@@ -0,0 +1,378 @@
+import time
+import heapq
+import asyncio
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict, deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class QueueBackend(ABC):
+    """
+    Lists the api pushes messages onto and workers pop them from
+    """
+
+    @abstractmethod
+    async def push(self, queue_name: str, message_json: str) -> None:
+        """
+        Pushes a message to the top of a queue
+        """
+
+    @abstractmethod
+    async def push_front(self, queue_name: str, message_json: str) -> None:
+        """
+        Pushes a message to the bottom of a queue, the end pop takes from
+        """
+
+    @abstractmethod
+    async def pop(
+        self, queue_names: List[str], timeout: int = 1
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Pops the bottom message of the first non-empty queue, waiting up to
+        timeout seconds, returns (None, None) when every queue stayed empty
+        """
+
+    @abstractmethod
+    async def depths(self, queue_names: List[str]) -> List[int]:
+        """
+        Returns the number of messages in each queue
+        """
+
+    async def close(self) -> None:
+        """
+        Releases the connections of the backend
+        """
+
+
+class JobStoreBackend(ABC):
+    """
+    Job documents, the {"message": {...}} dicts written by redis_save_to_db,
+    and the stream of completed jobs
+    """
+
+    @abstractmethod
+    async def save_job(self, uid: str, message: dict, ttl: int) -> None:
+        """
+        Writes a whole job document which expires after ttl seconds, 0 never
+        """
+
+    @abstractmethod
+    async def update_job(self, uid: str, fields: dict, ttl: int) -> None:
+        """
+        Sets fields of the message of a job document and resets its expiry
+        """
+
+    @abstractmethod
+    async def get_job(self, uid: str, fields: List[str]) -> List:
+        """
+        Returns the given message fields of a job, None for a missing job
+        """
+
+    @abstractmethod
+    async def delete_job(self, uid: str) -> None:
+        """
+        Removes a job document, a no-op for a missing job
+        """
+
+    @abstractmethod
+    async def list_uids(self) -> List[str]:
+        """
+        Returns the uid of every stored job
+        """
+
+    @abstractmethod
+    async def publish_completed(self, entry: Dict[str, str], maxlen: int) -> None:
+        """
+        Appends an entry to the completed stream, keeping about maxlen entries
+        """
+
+    @abstractmethod
+    async def read_completed(
+        self, last_id: str, count: int, block: Optional[int]
+    ) -> List[Tuple[str, Dict[str, str]]]:
+        """
+        Returns (entry id, entry) of up to count entries after last_id,
+        waiting up to block milliseconds when there are none
+        """
+
+    @abstractmethod
+    async def append_capped(self, key: str, value: str, maxlen: int) -> None:
+        """
+        Appends a value to a list which keeps its newest maxlen values
+        """
+
+    @abstractmethod
+    async def read_capped(self, key: str) -> List[str]:
+        """
+        Returns the values of a capped list, newest first
+        """
+
+    async def close(self) -> None:
+        """
+        Releases the connections of the backend
+        """
+
+
+class MemoryQueue(QueueBackend):
+    """
+    In-process stand-in for the redis queue, lists of an asyncio application
+    """
+
+    def __init__(self):
+        self.lists: Dict[str, deque] = defaultdict(deque)
+        self.changed = asyncio.Condition()
+
+    async def push(self, queue_name: str, message_json: str) -> None:
+        async with self.changed:
+            self.lists[queue_name].appendleft(message_json)
+            self.changed.notify()
+
+    async def push_front(self, queue_name: str, message_json: str) -> None:
+        async with self.changed:
+            self.lists[queue_name].append(message_json)
+            self.changed.notify()
+
+    async def pop(
+        self, queue_names: List[str], timeout: int = 1
+    ) -> Tuple[Optional[str], Optional[str]]:
+        async with self.changed:
+            for _ in range(2):
+                for queue_name in queue_names:
+                    if self.lists[queue_name]:
+                        return queue_name, self.lists[queue_name].pop()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+        return None, None
+
+    async def depths(self, queue_names: List[str]) -> List[int]:
+        return [len(self.lists[queue_name]) for queue_name in queue_names]
+
+
+class MemoryJobStore(JobStoreBackend, MemoryQueue):
+    """
+    In-process stand-in for redis_db.
+
+    Job documents live in a dict with a tag index of skills and technologies
+    to uids, which the analytics queries use in place of RediSearch. Expiry
+    times are kept in a heap swept on every access, so jobs that are never
+    read again are freed as in redis. Like redis_db it also holds plain lists,
+    which messages of corrupt jobs are parked on.
+    """
+
+    TAG_FIELDS = ["skills", "technologies"]
+
+    def __init__(self):
+        MemoryQueue.__init__(self)
+        self.jobs: Dict[str, dict] = {}
+        self.expires_at: Dict[str, float] = {}
+        # (expires_at, uid), entries outdated by a later ttl are skipped
+        self.expiry_heap: List[Tuple[float, str]] = []
+        self.tags: Dict[str, set] = defaultdict(set)
+        self.stream: deque = deque()
+        self.stream_seq = 0
+        self.stream_changed = asyncio.Condition()
+
+    def _expire(self, uid: str) -> None:
+        expires_at = self.expires_at.get(uid)
+        if expires_at is not None and expires_at <= time.time():
+            self._unindex(uid)
+            del self.jobs[uid]
+            del self.expires_at[uid]
+
+    def sweep(self) -> int:
+        """
+        Deletes every job past its expiry
+
+        Returns:
+            int: number of jobs deleted
+        """
+        now = time.time()
+        deleted = 0
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, uid = heapq.heappop(self.expiry_heap)
+            if self.expires_at.get(uid) == expires_at:
+                self._unindex(uid)
+                del self.jobs[uid]
+                del self.expires_at[uid]
+                deleted += 1
+        return deleted
+
+    def _unindex(self, uid: str) -> None:
+        message = self.jobs[uid]["message"]
+        for field in self.TAG_FIELDS:
+            for tag in message.get(field) or []:
+                uids = self.tags.get(tag)
+                if uids is not None:
+                    uids.discard(uid)
+                    if not uids:
+                        del self.tags[tag]
+
+    def _index(self, uid: str) -> None:
+        message = self.jobs[uid]["message"]
+        for field in self.TAG_FIELDS:
+            for tag in message.get(field) or []:
+                self.tags[tag].add(uid)
+
+    def _set_ttl(self, uid: str, ttl: int) -> None:
+        if ttl:
+            self.expires_at[uid] = time.time() + ttl
+            heapq.heappush(self.expiry_heap, (self.expires_at[uid], uid))
+        else:
+            self.expires_at.pop(uid, None)
+
+    async def save_job(self, uid: str, message: dict, ttl: int) -> None:
+        self.sweep()
+        if uid in self.jobs:
+            self._unindex(uid)
+        self.jobs[uid] = message
+        self._index(uid)
+        self._set_ttl(uid, ttl)
+
+    async def update_job(self, uid: str, fields: dict, ttl: int) -> None:
+        self.sweep()
+        if uid not in self.jobs:
+            raise KeyError(f"job {uid} does not exist")
+        self._unindex(uid)
+        self.jobs[uid]["message"].update(fields)
+        self._index(uid)
+        self._set_ttl(uid, ttl)
+
+    async def get_job(self, uid: str, fields: List[str]) -> List:
+        self.sweep()
+        message = self.jobs.get(uid, {}).get("message", {})
+        return [message.get(field) for field in fields]
+
+    async def delete_job(self, uid: str) -> None:
+        if uid in self.jobs:
+            self._unindex(uid)
+            del self.jobs[uid]
+            self.expires_at.pop(uid, None)
+
+    async def list_uids(self) -> List[str]:
+        self.sweep()
+        return list(self.jobs)
+
+    def search(
+        self,
+        tag: Optional[str] = None,
+        task: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> List[dict]:
+        """
+        Completed job messages filtered like analytics.build_query
+
+        Args:
+            tag (Optional[str]): only jobs with this skill or technology
+            task (Optional[str]): only jobs of this task
+            since (Optional[float]): only jobs submitted at or after
+            until (Optional[float]): only jobs submitted at or before
+
+        Returns:
+            List[dict]: messages of the matching jobs
+        """
+        uids = list(self.tags.get(tag, ())) if tag else list(self.jobs)
+        messages = []
+        for uid in uids:
+            self._expire(uid)
+            message = self.jobs.get(uid, {}).get("message")
+            if (
+                message is None
+                or message.get("status_code") != 200
+                or (task and message.get("task") != task)
+                or (since is not None and message["ts_epoch"] < since)
+                or (until is not None and message["ts_epoch"] > until)
+            ):
+                continue
+            messages.append(message)
+        return messages
+
+    def iter_messages(
+        self,
+        task: Optional[str] = None,
+        status_code: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Iterator[dict]:
+        """
+        Job messages of any state, filtered like export.export_query
+
+        Args:
+            task (Optional[str]): only jobs of this task
+            status_code (Optional[int]): only jobs with this status code
+            since (Optional[float]): only jobs submitted at or after
+            until (Optional[float]): only jobs submitted at or before
+
+        Returns:
+            Iterator[dict]: messages of the matching jobs
+        """
+        for uid in list(self.jobs):
+            self._expire(uid)
+            message = self.jobs.get(uid, {}).get("message")
+            if (
+                message is None
+                or (task and message.get("task") != task)
+                or (status_code is not None and message["status_code"] != status_code)
+                or (since is not None and message["ts_epoch"] < since)
+                or (until is not None and message["ts_epoch"] > until)
+            ):
+                continue
+            yield message
+
+    def tag_counts(self, messages: List[dict]) -> Counter:
+        """
+        Counts the skills and technologies over job messages
+
+        Args:
+            messages (List[dict]): output of search
+
+        Returns:
+            Counter: tag to the number of jobs mentioning it
+        """
+        counts = Counter()
+        for message in messages:
+            counts.update(
+                {tag for field in self.TAG_FIELDS for tag in message.get(field) or []}
+            )
+        return counts
+
+    async def append_capped(self, key: str, value: str, maxlen: int) -> None:
+        values = self.lists[key]
+        values.appendleft(value)
+        while len(values) > maxlen:
+            values.pop()
+
+    async def read_capped(self, key: str) -> List[str]:
+        return list(self.lists[key])
+
+    async def publish_completed(self, entry: Dict[str, str], maxlen: int) -> None:
+        async with self.stream_changed:
+            self.stream_seq += 1
+            self.stream.append((f"{self.stream_seq}-0", entry))
+            while len(self.stream) > maxlen:
+                self.stream.popleft()
+            self.stream_changed.notify_all()
+
+    async def read_completed(
+        self, last_id: str, count: int, block: Optional[int]
+    ) -> List[Tuple[str, Dict[str, str]]]:
+        last_seq = int(last_id.split("-")[0])
+
+        def newer():
+            return [
+                (entry_id, entry)
+                for entry_id, entry in self.stream
+                if int(entry_id.split("-")[0]) > last_seq
+            ][:count]
+
+        async with self.stream_changed:
+            entries = newer()
+            if not entries and block:
+                try:
+                    await asyncio.wait_for(self.stream_changed.wait(), block / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                entries = newer()
+        return entries
@@ -0,0 +1,197 @@
+import os
+import random
+import asyncio
+from typing import Dict, Optional, Tuple, Union
+
+from redis import asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import EqualJitterBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+
+
+# connections per pool, one pool is shared by every client of a redis instance
+POOL_MAX_CONNECTIONS = int(os.getenv("BUOY_REDIS_MAX_CONNECTIONS", 50))
+# seconds a command waits for a free connection before failing
+POOL_TIMEOUT = float(os.getenv("BUOY_REDIS_POOL_TIMEOUT", 5))
+SOCKET_TIMEOUT = float(os.getenv("BUOY_REDIS_SOCKET_TIMEOUT", 10))
+CONNECT_TIMEOUT = float(os.getenv("BUOY_REDIS_CONNECT_TIMEOUT", 5))
+# idle connections are pinged before reuse after this many seconds
+HEALTH_CHECK_INTERVAL = int(os.getenv("BUOY_REDIS_HEALTH_CHECK_INTERVAL", 30))
+# retries of a command that lost its connection, with jittered backoff
+RETRY_ATTEMPTS = int(os.getenv("BUOY_REDIS_RETRY_ATTEMPTS", 3))
+BACKOFF_BASE_SECONDS = float(os.getenv("BUOY_REDIS_BACKOFF_BASE_SECONDS", 0.1))
+BACKOFF_MAX_SECONDS = float(os.getenv("BUOY_REDIS_BACKOFF_MAX_SECONDS", 10))
+# attempts of the first ping before a client is handed out regardless
+CONNECT_ATTEMPTS = int(os.getenv("BUOY_REDIS_CONNECT_ATTEMPTS", 5))
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with jitter
+
+    Args:
+        attempt (int): number of consecutive failures, from 1
+
+    Returns:
+        float: seconds to wait before the next attempt
+    """
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class ConnectionManager:
+    """
+    Owns one blocking connection pool per redis instance.
+
+    Clients of the same instance share its pool, so the api and worker never
+    open more than max_connections connections to it, and a command waits up
+    to pool_timeout for a free connection instead of failing at once. Commands
+    which lose their connection, e.g. while redis restarts, reconnect and are
+    retried with exponential backoff and jitter.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = POOL_MAX_CONNECTIONS,
+        pool_timeout: float = POOL_TIMEOUT,
+        socket_timeout: float = SOCKET_TIMEOUT,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        health_check_interval: int = HEALTH_CHECK_INTERVAL,
+        retry_attempts: int = RETRY_ATTEMPTS,
+    ):
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.health_check_interval = health_check_interval
+        self.retry_attempts = retry_attempts
+        self.pools: Dict[Tuple[str, int], aioredis.BlockingConnectionPool] = {}
+        self.reconnects: Dict[Tuple[str, int], int] = {}
+
+    def pool(
+        self, host_name: Union[float, str], port: int, password: Optional[str] = None
+    ) -> aioredis.BlockingConnectionPool:
+        """
+        Returns the pool of a redis instance, creating it on first use
+
+        Args:
+            host_name (Union[float, str]): name or IP of redis container
+            port (int): exposed port of redis container
+            password (Optional[str]): optional password for protected db
+
+        Returns:
+            BlockingConnectionPool: pool shared by clients of the instance
+        """
+        key = (str(host_name), int(port))
+        if key not in self.pools:
+            self.pools[key] = aioredis.BlockingConnectionPool(
+                host=key[0],
+                port=key[1],
+                password=password,
+                max_connections=self.max_connections,
+                timeout=self.pool_timeout,
+                socket_timeout=self.socket_timeout,
+                socket_connect_timeout=self.connect_timeout,
+                socket_keepalive=True,
+                health_check_interval=self.health_check_interval,
+                retry=Retry(
+                    EqualJitterBackoff(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS),
+                    self.retry_attempts,
+                ),
+                retry_on_error=[ConnectionError, TimeoutError],
+            )
+            self.reconnects[key] = 0
+        return self.pools[key]
+
+    async def client(
+        self,
+        host_name: Union[float, str],
+        port: int,
+        password: Optional[str] = None,
+        attempts: int = CONNECT_ATTEMPTS,
+    ) -> aioredis.Redis:
+        """
+        Returns a client on the shared pool of a redis instance, pinging it
+        with backoff until it answers or attempts run out
+
+        Args:
+            host_name (Union[float, str]): name or IP of redis container
+            port (int): exposed port of redis container
+            password (Optional[str]): optional password for protected db
+            attempts (int): pings before giving up on the instance for now
+
+        Returns:
+            Redis: an instance of aioredis.Redis
+        """
+        redis = aioredis.Redis(connection_pool=self.pool(host_name, port, password))
+        for attempt in range(1, attempts + 1):
+            try:
+                await redis.ping()
+                print(f"Connected to Redis at {host_name}:{port}")
+                break
+            except (ConnectionError, TimeoutError) as e:
+                delay = backoff_delay(attempt)
+                print(
+                    f"Failed to connect to Redis at {host_name}:{port} "
+                    f"({attempt}/{attempts}), retrying in {delay:.1f}s: {e}"
+                )
+                if attempt < attempts:
+                    await asyncio.sleep(delay)
+        # commands reconnect by themselves once redis is back
+        return redis
+
+    async def wait_until_healthy(self, redis: aioredis.Redis) -> None:
+        """
+        Blocks until redis answers a ping, for loops which lost it
+
+        Args:
+            redis (Redis): client whose instance is down
+        """
+        attempt = 0
+        kwargs = redis.connection_pool.connection_kwargs
+        key = (kwargs.get("host"), kwargs.get("port"))
+        while True:
+            attempt += 1
+            try:
+                await redis.ping()
+                print(f"Reconnected to Redis at {key[0]}:{key[1]}")
+                self.reconnects[key] = self.reconnects.get(key, 0) + 1
+                return
+            except (ConnectionError, TimeoutError) as e:
+                delay = backoff_delay(attempt)
+                print(f"Redis at {key[0]}:{key[1]} down, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    def metrics(self) -> Dict[str, dict]:
+        """
+        Utilization of every pool
+
+        Returns:
+            Dict[str, dict]: "host:port" to max, created, in use and idle
+                             connections and reconnects after an outage
+        """
+        stats = {}
+        for (host, port), pool in self.pools.items():
+            in_use = len(getattr(pool, "_in_use_connections", ()))
+            idle = len(getattr(pool, "_available_connections", ()))
+            stats[f"{host}:{port}"] = {
+                "max_connections": pool.max_connections,
+                "created": in_use + idle,
+                "in_use": in_use,
+                "idle": idle,
+                "utilization": round(in_use / pool.max_connections, 3),
+                "reconnects": self.reconnects.get((host, port), 0),
+            }
+        return stats
+
+    async def close(self) -> None:
+        """
+        Disconnects every pool, in use connections included
+        """
+        for pool in self.pools.values():
+            await pool.disconnect(inuse_connections=True)
+        self.pools.clear()
+
+
+# shared by every client of this process
+manager = ConnectionManager()
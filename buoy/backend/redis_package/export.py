@@ -0,0 +1,232 @@
+import os
+import sys
+import zlib
+import asyncio
+import argparse
+from json import dumps
+from typing import AsyncIterator, List, Optional
+
+from redis import asyncio as aioredis
+from redis.commands.search.aggregation import AggregateRequest
+
+from . import connections
+from .backends import MemoryJobStore
+from .analytics import escape_tag
+from .redis_wrapper import (
+    JOBS_INDEX,
+    decode_result,
+    job_store_async,
+    store_clients,
+    to_epoch,
+)
+
+
+# jobs read per cursor read and JSON.MGET, each command stays small so an
+# export never blocks redis_db for live traffic
+EXPORT_BATCH = int(os.getenv("BUOY_EXPORT_BATCH", 500))
+# seconds an export cursor survives without being read, e.g. behind a slow
+# client, before redis frees it
+CURSOR_MAX_IDLE_SECONDS = float(os.getenv("BUOY_EXPORT_CURSOR_IDLE_SECONDS", 300))
+# fields of the job document only kept for the index
+INDEX_ONLY_FIELDS = ["skills_csv"]
+
+
+def export_query(
+    task: Optional[str] = None,
+    status_code: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> str:
+    """
+    Builds the search query over jobs of any state
+
+    Args:
+        task (Optional[str]): only jobs of this task
+        status_code (Optional[int]): only jobs with this status code
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+
+    Returns:
+        str: RediSearch query string, * for every job
+    """
+    parts = []
+    if status_code is not None:
+        parts.append(f"@status_code:[{status_code} {status_code}]")
+    if task:
+        parts.append(f"@task:{{{escape_tag(task)}}}")
+    if since is not None or until is not None:
+        low = "-inf" if since is None else since
+        high = "+inf" if until is None else until
+        parts.append(f"@ts:[{low} {high}]")
+    return " ".join(parts) or "*"
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _record(message: dict) -> dict:
+    record = {k: v for k, v in message.items() if k not in INDEX_ONLY_FIELDS}
+    record["final_result"] = decode_result(message.get("final_result"))
+    return record
+
+
+async def _key_batches(
+    client: aioredis.Redis, query: str, batch: int
+) -> AsyncIterator[List[str]]:
+    # FT.AGGREGATE WITHCURSOR only loads the keys, batch at a time
+    request = (
+        AggregateRequest(query)
+        .load("@__key")
+        .cursor(count=batch, max_idle=CURSOR_MAX_IDLE_SECONDS)
+    )
+    result = await client.ft(JOBS_INDEX).aggregate(request)
+    try:
+        while True:
+            keys = []
+            for row in result.rows:
+                row = [_decode(value) for value in row]
+                keys.append(dict(zip(row[::2], row[1::2]))["__key"])
+            if keys:
+                yield keys
+            if result.cursor is None or not result.cursor.cid:
+                return
+            result = await client.ft(JOBS_INDEX).aggregate(result.cursor)
+    finally:
+        # an export abandoned half way, e.g. by a disconnected client
+        if result.cursor is not None and result.cursor.cid:
+            await client.execute_command(
+                "FT.CURSOR", "DEL", JOBS_INDEX, result.cursor.cid
+            )
+
+
+async def iter_jobs(
+    db,
+    task: Optional[str] = None,
+    status_code: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    batch: int = EXPORT_BATCH,
+) -> AsyncIterator[dict]:
+    """
+    Streams the documents of every matching job, shard after shard, holding
+    one batch in memory at a time
+
+    Args:
+        db: redis_db instance of aioredis or job store backend
+        task (Optional[str]): only jobs of this task
+        status_code (Optional[int]): only jobs with this status code
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+        batch (int): jobs read per round trip
+
+    Returns:
+        AsyncIterator[dict]: job messages with their final_result decoded
+    """
+    if isinstance(db, MemoryJobStore):
+        for count, message in enumerate(
+            db.iter_messages(task, status_code, since, until), 1
+        ):
+            yield _record(message)
+            if count % batch == 0:
+                # lets the embedded api and worker run between batches
+                await asyncio.sleep(0)
+        return
+    query = export_query(task, status_code, since, until)
+    for client in store_clients(db):
+        async for keys in _key_batches(client, query, batch):
+            for found in await client.json().mget(keys, "$.message"):
+                # None when the job expired after its key was read
+                if found:
+                    yield _record(found[0])
+
+
+async def export_ndjson(
+    db,
+    compress: bool = False,
+    task: Optional[str] = None,
+    status_code: Optional[int] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    batch: int = EXPORT_BATCH,
+) -> AsyncIterator[bytes]:
+    """
+    Streams matching jobs as newline delimited json, one chunk per batch
+
+    Args:
+        db: redis_db instance of aioredis or job store backend
+        compress (bool): gzip the stream
+        task (Optional[str]): only jobs of this task
+        status_code (Optional[int]): only jobs with this status code
+        since (Optional[float]): only jobs submitted at or after, epoch seconds
+        until (Optional[float]): only jobs submitted at or before, epoch seconds
+        batch (int): jobs read per round trip and written per chunk
+
+    Returns:
+        AsyncIterator[bytes]: chunks of the ndjson, or of its gzip stream
+    """
+    # wbits of 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def encode(lines: List[str]) -> bytes:
+        data = "".join(lines).encode("utf-8")
+        return compressor.compress(data) if compressor else data
+
+    lines = []
+    async for record in iter_jobs(db, task, status_code, since, until, batch):
+        lines.append(dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if len(lines) >= batch:
+            chunk = encode(lines)
+            lines = []
+            if chunk:
+                yield chunk
+    chunk = encode(lines)
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="export buoy jobs as ndjson")
+    parser.add_argument("--out", help="file to write, stdout when not given")
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="gzip the output, implied by an --out ending in .gz",
+    )
+    parser.add_argument("--task", help="only jobs of this task")
+    parser.add_argument("--status", type=int, help="only jobs with this status code")
+    parser.add_argument("--since", help="only jobs submitted at or after, isoformat")
+    parser.add_argument("--until", help="only jobs submitted at or before, isoformat")
+    parser.add_argument("--batch", type=int, default=EXPORT_BATCH)
+    return parser.parse_args(argv)
+
+
+async def main(argv=None) -> None:
+    args = parse_args(argv)
+    compress = args.gzip or bool(args.out and args.out.endswith(".gz"))
+    db = await job_store_async()
+    output = open(args.out, "wb") if args.out else sys.stdout.buffer
+    written = 0
+    try:
+        async for chunk in export_ndjson(
+            db,
+            compress,
+            args.task,
+            args.status,
+            to_epoch(args.since) if args.since else None,
+            to_epoch(args.until) if args.until else None,
+            args.batch,
+        ):
+            output.write(chunk)
+            written += len(chunk)
+    finally:
+        if args.out:
+            output.close()
+        await connections.manager.close()
+    print(f"wrote {written} bytes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
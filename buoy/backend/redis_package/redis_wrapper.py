@@ -1,6 +1,9 @@
 # import asyncio
-from typing import Union, Optional
-from datetime import datetime
+import os
+import zlib
+import base64
+from typing import Union, Optional, List, Tuple, Dict
+from datetime import datetime, timezone
 from json import dumps, loads
 
 from redis.commands.json.path import Path
@@ -11,6 +14,327 @@ from redis.commands.search.query import Query
 
 # from ..src import dataclasses as dc
 from src import dataclasses as dc
+from . import scheduler
+from . import connections
+from . import sharding
+from .backends import QueueBackend, JobStoreBackend
+
+
+# where the queue and job store live, the compose service names by default
+REDIS_QUEUE_HOST = os.getenv("BUOY_REDIS_QUEUE_HOST", "redis")
+REDIS_QUEUE_PORT = int(os.getenv("BUOY_REDIS_QUEUE_PORT", 6379))
+REDIS_DB_HOST = os.getenv("BUOY_REDIS_DB_HOST", "redis_db")
+REDIS_DB_PORT = int(os.getenv("BUOY_REDIS_DB_PORT", 6380))
+# job store nodes as "host:port,host:port", job documents are spread over them
+# by uid, empty keeps every document on REDIS_DB_HOST:REDIS_DB_PORT
+REDIS_DB_NODES = os.getenv("BUOY_REDIS_DB_NODES", "")
+
+# results are indexed under a named index, the default "idx" of older
+# deployments indexed final_result as TEXT which structured results break,
+# v3 indexes the extracted skills and technologies as TAG fields
+JOBS_INDEX = "idx:jobs:v3"
+JOBS_SCHEMA = (
+    TagField("$.message.uid", as_name="uid"),
+    NumericField("$.message.ts_epoch", as_name="ts", sortable=True),
+    TagField("$.message.task", as_name="task"),
+    NumericField("$.message.status_code", as_name="status_code"),
+    TextField("$.message.status_name", as_name="status_name"),
+    TagField("$.message.skills[*]", as_name="skills"),
+    TagField("$.message.technologies[*]", as_name="technologies"),
+)
+# labels of structured results which are indexed, to their document field
+TAG_LABELS = {"skillset": "skills", "technology": "technologies"}
+indexed_dbs = set()
+
+# results whose json is larger than this are stored zlib compressed
+COMPRESS_MIN_BYTES = int(os.getenv("BUOY_COMPRESS_MIN_BYTES", 4096))
+COMPRESSED_ENCODING = "zlib+b64"
+
+# stream of completed jobs and their skills, followed by the api to keep its
+# in-memory matching index up to date
+COMPLETED_STREAM = "stream:completed"
+COMPLETED_STREAM_MAXLEN = int(os.getenv("BUOY_COMPLETED_STREAM_MAXLEN", 200000))
+# samples of shadow evaluation runs, see worker/shadow.py
+SHADOW_SAMPLES = "shadow:samples"
+SHADOW_SAMPLES_MAXLEN = int(os.getenv("BUOY_SHADOW_SAMPLES_MAXLEN", 10000))
+
+# seconds a job document is kept for, by job state, 0 keeps it forever
+DAY = 24 * 60 * 60
+RETENTION_SECONDS = {
+    "queued": int(float(os.getenv("BUOY_TTL_QUEUED_DAYS", 14)) * DAY),
+    "completed": int(float(os.getenv("BUOY_TTL_COMPLETED_DAYS", 7)) * DAY),
+    "failed": int(float(os.getenv("BUOY_TTL_FAILED_DAYS", 2)) * DAY),
+}
+
+
+def retention_for(status_code: int) -> int:
+    """
+    Maps a job status code to the retention of its state
+
+    Args:
+        status_code (int): http status code of the job
+
+    Returns:
+        int: seconds to keep the job document for, 0 to keep forever
+    """
+    if status_code == 202:
+        return RETENTION_SECONDS["queued"]
+    if status_code >= 400:
+        return RETENTION_SECONDS["failed"]
+    return RETENTION_SECONDS["completed"]
+
+
+def encode_result(final_result: Optional[dict]) -> Optional[dict]:
+    """
+    Compresses a structured result when it is large
+
+    Args:
+        final_result (Optional[dict]): structured result of mega_job
+
+    Returns:
+        Optional[dict]: the result unchanged when small, otherwise
+                        {"encoding": "zlib+b64", "payload": str}
+    """
+    if final_result is None:
+        return None
+    raw = dumps(final_result, separators=(",", ":")).encode()
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return final_result
+    payload = base64.b64encode(zlib.compress(raw)).decode()
+    return {"encoding": COMPRESSED_ENCODING, "payload": payload}
+
+
+def decode_result(stored_result):
+    """
+    Reverses encode_result
+
+    Args:
+        stored_result: result as stored in redis_db
+
+    Returns:
+        the structured result, None or a legacy <sep> joined string as stored
+    """
+    if (
+        isinstance(stored_result, dict)
+        and stored_result.get("encoding") == COMPRESSED_ENCODING
+    ):
+        raw = zlib.decompress(base64.b64decode(stored_result["payload"]))
+        return loads(raw)
+    return stored_result
+
+
+def tag_values(final_result: Optional[dict]) -> dict:
+    """
+    Collects the skills and technologies of a structured result as tag values
+
+    Args:
+        final_result (Optional[dict]): structured result of mega_job
+
+    Returns:
+        dict: skills and technologies lists and skills_csv, the comma joined
+              union of both which aggregations split back into single tags
+    """
+    values = {field: set() for field in TAG_LABELS.values()}
+    if isinstance(final_result, dict):
+        for entity in final_result.get("entities", []):
+            field = TAG_LABELS.get(entity.get("label"))
+            # commas separate tags in skills_csv
+            text = entity.get("text", "").replace(",", " ").strip().lower()
+            if field and text:
+                values[field].add(text)
+    tags = {field: sorted(texts) for field, texts in values.items()}
+    tags["skills_csv"] = ",".join(sorted(set().union(*values.values())))
+    return tags
+
+
+def to_epoch(time: str) -> float:
+    """
+    Converts an utc isoformat timestamp to seconds since epoch
+
+    Args:
+        time (str): isoformat timestamp, naive ones are taken as utc
+
+    Returns:
+        float: seconds since epoch
+    """
+    ts = datetime.fromisoformat(time)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+async def ensure_jobs_index(db: aioredis.Redis) -> None:
+    """
+    Creates the search index over job documents when it does not exist,
+    checked once per connection pool
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+
+    Returns:
+        None
+    """
+    if id(db) in indexed_dbs:
+        return
+    try:
+        await db.ft(JOBS_INDEX).info()
+    except aioredis.ResponseError as e:
+        print(f"creating index as index not found with error\n{e}")
+        await db.ft(JOBS_INDEX).create_index(
+            JOBS_SCHEMA,
+            definition=IndexDefinition(prefix=["message:"], index_type=IndexType.JSON),
+        )
+    indexed_dbs.add(id(db))
+
+
+class RedisQueue(QueueBackend):
+    """
+    Queue backend over a redis instance, lists with LPUSH and BRPOP
+    """
+
+    def __init__(self, client: aioredis.Redis):
+        self.client = client
+
+    async def push(self, queue_name: str, message_json: str) -> None:
+        await self.client.lpush(queue_name, message_json)
+
+    async def push_front(self, queue_name: str, message_json: str) -> None:
+        await self.client.rpush(queue_name, message_json)
+
+    async def pop(
+        self, queue_names: List[str], timeout: int = 1
+    ) -> Tuple[Optional[str], Optional[str]]:
+        popped = await self.client.brpop(queue_names, timeout=timeout)
+        if not popped:
+            return None, None
+        queue_name, message_json = popped
+        return _decode(queue_name), message_json
+
+    async def depths(self, queue_names: List[str]) -> List[int]:
+        async with self.client.pipeline(transaction=False) as pipe:
+            for queue_name in queue_names:
+                pipe.llen(queue_name)
+            return await pipe.execute()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class RedisJobStore(JobStoreBackend):
+    """
+    Job store backend over a redis stack instance, RedisJSON documents under
+    message:{uid} indexed by RediSearch, and a stream of completed jobs
+    """
+
+    def __init__(self, client: aioredis.Redis):
+        self.client = client
+
+    async def save_job(self, uid: str, message: dict, ttl: int) -> None:
+        # the document and its expiry are written in one round trip
+        key = f"message:{uid}"
+        await ensure_jobs_index(self.client)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.json().set(key, Path.root_path(), message)
+            if ttl:
+                pipe.expire(key, ttl)
+            await pipe.execute()
+
+    async def update_job(self, uid: str, fields: dict, ttl: int) -> None:
+        key = f"message:{uid}"
+        async with self.client.pipeline(transaction=False) as pipe:
+            for field, value in fields.items():
+                pipe.json().set(key, Path(f".message.{field}"), value)
+            if ttl:
+                pipe.expire(key, ttl)
+            else:
+                pipe.persist(key)
+            await pipe.execute()
+
+    async def get_job(self, uid: str, fields: List[str]) -> List:
+        # one JSON.GET with several paths answers a dict keyed by path
+        paths = [f".message.{field}" for field in fields]
+        values = await self.client.json().get(f"message:{uid}", *paths)
+        if values is None:
+            return [None] * len(fields)
+        if len(paths) == 1:
+            return [values]
+        return [values.get(path) for path in paths]
+
+    async def delete_job(self, uid: str) -> None:
+        await self.client.delete(f"message:{uid}")
+
+    async def list_uids(self) -> List[str]:
+        query_str = "*"
+        result = await self.client.ft(JOBS_INDEX).search(
+            Query(query_str).return_fields("uid")
+        )
+        return [doc.uid for doc in result.docs]
+
+    async def publish_completed(self, entry: Dict[str, str], maxlen: int) -> None:
+        await self.client.xadd(COMPLETED_STREAM, entry, maxlen=maxlen, approximate=True)
+
+    async def read_completed(
+        self, last_id: str, count: int, block: Optional[int]
+    ) -> List[Tuple[str, Dict[str, str]]]:
+        response = await self.client.xread(
+            {COMPLETED_STREAM: last_id}, count=count, block=block
+        )
+        entries = []
+        for _, stream_entries in response or []:
+            for entry_id, fields in stream_entries:
+                fields = {_decode(k): _decode(v) for k, v in fields.items()}
+                entries.append((_decode(entry_id), fields))
+        return entries
+
+    async def append_capped(self, key: str, value: str, maxlen: int) -> None:
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, value)
+            pipe.ltrim(key, 0, maxlen - 1)
+            await pipe.execute()
+
+    async def read_capped(self, key: str) -> List[str]:
+        return [_decode(value) for value in await self.client.lrange(key, 0, -1)]
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def as_queue(db: Union[aioredis.Redis, QueueBackend]) -> QueueBackend:
+    """
+    Returns the queue backend of db, redis clients are wrapped in RedisQueue
+
+    Args:
+        db (Union[aioredis.Redis, QueueBackend]): redis client or backend
+
+    Returns:
+        QueueBackend: backend the queue operations run on
+    """
+    if isinstance(db, QueueBackend):
+        return db
+    if isinstance(db, sharding.ShardedJobStore):
+        # messages requeued on the job store land on its first node
+        db = db.primary.client
+    return RedisQueue(db)
+
+
+def as_store(db: Union[aioredis.Redis, JobStoreBackend]) -> JobStoreBackend:
+    """
+    Returns the job store backend of db, redis clients are wrapped in
+    RedisJobStore
+
+    Args:
+        db (Union[aioredis.Redis, JobStoreBackend]): redis client or backend
+
+    Returns:
+        JobStoreBackend: backend the job store operations run on
+    """
+    if isinstance(db, JobStoreBackend):
+        return db
+    return RedisJobStore(db)
 
 
 async def redis_db_async(
@@ -19,7 +343,8 @@ async def redis_db_async(
     password: Optional[str] = None,
 ):
     """
-    Async wrapper function over aioredis to create database instance
+    Async wrapper function over aioredis to create database instance, see
+    connections.ConnectionManager for pool size, timeouts and reconnects
 
     Args:
         host_name (Union[float, str]): name or IP of redis container
@@ -27,26 +352,50 @@ async def redis_db_async(
         password (Optional[str]): optional password for protected db
 
     Returns:
-        Redis: an instance of aioredis.Redis
+        Redis: an instance of aioredis.Redis on the shared pool of the instance
     """
-    if password:
-        redis = await aioredis.Redis.from_url(
-            f"redis://{host_name}:{port}",
-            max_connections=10,
-            password=password,
-        )
-    else:
-        redis = await aioredis.Redis.from_url(
-            f"redis://{host_name}:{port}",
-            max_connections=10,
-        )
-    try:
-        await redis.ping()
-        print("Connected to Redis")
-    except Exception as e:
-        print("Failed to connect to Redis:", e)
+    return await connections.manager.client(host_name, port, password)
+
+
+async def job_store_async(
+    nodes: str = REDIS_DB_NODES, password: Optional[str] = None
+) -> Union[aioredis.Redis, sharding.ShardedJobStore]:
+    """
+    Connects to the job store, sharded when several nodes are configured
+
+    Args:
+        nodes (str): "host:port" of the job store nodes, comma separated,
+                     empty for the single REDIS_DB_HOST:REDIS_DB_PORT
+        password (Optional[str]): optional password for protected db
+
+    Returns:
+        Union[aioredis.Redis, ShardedJobStore]: client of the single node or
+            a store over a RedisJobStore per node
+    """
+    if not nodes.strip():
+        return await redis_db_async(REDIS_DB_HOST, REDIS_DB_PORT, password)
+    shards = {}
+    for node in nodes.split(","):
+        host_name, _, port = node.strip().rpartition(":")
+        client = await redis_db_async(host_name, int(port), password)
+        shards[f"{host_name}:{port}"] = RedisJobStore(client)
+    return sharding.ShardedJobStore(shards)
 
-    return redis
+
+def store_clients(db) -> list:
+    """
+    Returns the clients of every node of a job store, for queries which fan
+    out over the shards
+
+    Args:
+        db: redis_db instance of aioredis or job store backend
+
+    Returns:
+        list: a redis client per shard, [db] when db is not sharded
+    """
+    if isinstance(db, sharding.ShardedJobStore):
+        return [shard.client for shard in db.shards.values()]
+    return [db]
 
 
 async def update_message(
@@ -54,8 +403,9 @@ async def update_message(
     uid: str,
     data: str,
     time: datetime,
-    queue_name: str = "worker_queue",
+    queue_name: str = None,
     task: dc.Task = None,
+    cost: int = None,
 ) -> None:
     """
     Generates a message and pushes it to a Redis queue
@@ -65,26 +415,38 @@ async def update_message(
         uid (str): uuid4
         data (str): either file_path or text_chunk
         time (datetime): datetime of when process was created
-        queue_name (str): Defined name for queue data in Redis
+        queue_name (str): Defined name for queue data in Redis, picked from
+                          the priority lanes by estimated cost when None
         task (dc.Task): name of task, only resume_upload or job_ad_upload
                         allowed
+        cost (int): estimated cost of the job, estimated from data when None
 
     Returns:
         None
+
+    Raises:
+        aioredis.RedisError: when the message could not be queued
     """
     if db:
+        if cost is None:
+            cost = scheduler.estimate_cost(task.task, data)
+        if queue_name is None:
+            queue_name = scheduler.choose_lane(task.task, cost)
         message = {
             "uid": uid,
             "ts": time,
             "task": task.task,
+            "lane": queue_name,
+            "cost": cost,
             "data": {"data_info": data},
         }
         message_json = dumps(message)
         print("message dumping ...")
         try:
-            await db.lpush(queue_name, message_json)
+            await as_queue(db).push(queue_name, message_json)
         except aioredis.RedisError as e:
             print(f"Unable to call redis due to:\n{e}")
+            raise
 
 
 async def redis_queue_pop(db: aioredis.Redis, queue_name: str = "worker_queue") -> dict:
@@ -103,6 +465,29 @@ async def redis_queue_pop(db: aioredis.Redis, queue_name: str = "worker_queue")
     return message_json
 
 
+async def redis_queue_pop_lanes(
+    db: aioredis.Redis, queue_names: List[str], timeout: int = 1
+) -> Tuple[Optional[str], Optional[dict]]:
+    """
+    Pops the bottom message of the first non-empty queue in queue_names
+
+    BRPOP checks keys in the given order, so the order of queue_names is the
+    priority the lanes are served in for this poll.
+
+    Args:
+        db (aioredis.Redis): An instance of Redis database connector
+        queue_names (List[str]): queues in the order they should be tried
+        timeout (int): seconds to block when every queue is empty
+
+    Returns:
+        tuple: (queue_name, message) or (None, None) when the poll timed out
+    """
+    queue_name, message_json = await as_queue(db).pop(queue_names, timeout)
+    if message_json is None:
+        return None, None
+    return queue_name, loads(message_json)
+
+
 async def redis_save_to_db(
     db,
     uid: str,
@@ -111,10 +496,10 @@ async def redis_save_to_db(
     task: dc.Task,
     status_code: int,
     status_name: str,
-    final_result: str = None,
+    final_result: dict = None,
 ) -> None:
     """
-    Generates a message and pushes it to a Redis queue
+    Saves a job document to redis_db with the retention of its state
 
     Args:
         db: An instance of Redis database connector
@@ -130,7 +515,7 @@ async def redis_save_to_db(
                       400 - Bad Request
                       500 - Internal Server Error
         status_name (str): corresponding status description to status
-        final_result (str): final_result placeholder
+        final_result (dict): final_result placeholder
 
     Returns:
         None
@@ -140,61 +525,51 @@ async def redis_save_to_db(
             "message": {
                 "uid": uid,
                 "ts": time,
+                "ts_epoch": to_epoch(time),
                 "task": task.task,
                 "data": {"data_info": data},
                 "status_code": status_code,
                 "status_name": status_name,
-                "final_result": final_result,
+                "final_result": encode_result(final_result),
+                **tag_values(final_result),
             }
         }
-        key = f"message:{uid}"
         # message_json = dumps(message)
-        try:
-            await db.ft().info()
-            print("posting msg on redis_db ...")
-            await db.json().set(key, Path.root_path(), message)
-        except aioredis.RedisError as e:
-            schema = (
-                TagField("$.message.uid", as_name="uid"),
-                TextField("$.message.ts", as_name="ts"),
-                TextField("$.message.task", as_name="task"),
-                TextField("$.message.data_info", as_name="data"),
-                NumericField("$.message.status", as_name="status_code"),
-                TextField("$.message.status_name", as_name="status_name"),
-                TextField("$.message.final_result", as_name="final_result"),
-            )
-            await db.ft().create_index(
-                schema,
-                definition=IndexDefinition(
-                    prefix=["message:"], index_type=IndexType.JSON
-                ),
-            )
-            print(f"creating index as index not found with error\n{e}")
-            print("index created and posting message to db ...")
-            await db.json().set(key, Path.root_path(), message)
+        print("posting msg on redis_db ...")
+        await as_store(db).save_job(uid, message, retention_for(status_code))
 
 
 async def update_status(
-    db: aioredis.Redis, uid: str, status_code: int, status_name: str, final_result: str
+    db: aioredis.Redis,
+    uid: str,
+    status_code: int,
+    status_name: str,
+    final_result: Optional[dict],
 ) -> None:
     """
     Asynchronously updates the status of a job in the Redis database.
 
+    The three fields and the retention of the new state are written in a
+    single pipelined round trip.
+
     Args:
         db (aioredis.Redis): An instance of Redis database connector.
         uid (str): Unique identifier of the job.
         status_code (int): Status code indicating the job's state.
         status_name (str): A descriptive name of the job's current status.
-        final_result (str): The final result of the job, if completed.
+        final_result (Optional[dict]): The structured result of the job, if completed.
 
     Returns:
         None
     """
-    key = f"message:{uid}"
-    print(f"updating {key} with {status_code},{status_name},{final_result}")
-    await db.json().set(key, Path(".message.status_code"), status_code)
-    await db.json().set(key, Path(".message.status_name"), status_name)
-    await db.json().set(key, Path(".message.final_result"), final_result)
+    print(f"updating message:{uid} with {status_code},{status_name}")
+    fields = {
+        "status_code": status_code,
+        "status_name": status_name,
+        "final_result": encode_result(final_result),
+        **tag_values(final_result),
+    }
+    await as_store(db).update_job(uid, fields, retention_for(status_code))
 
 
 async def requeue(db: aioredis.Redis, queue_name: str, message_json: str) -> None:
@@ -210,7 +585,42 @@ async def requeue(db: aioredis.Redis, queue_name: str, message_json: str) -> Non
         None
     """
     print("\tProcessing failed - requeuing...")
-    await db.lpush(queue_name, message_json)
+    await as_queue(db).push(queue_name, message_json)
+
+
+async def park(db: aioredis.Redis, queue_name: str, message_json: str) -> None:
+    """
+    Parks a message which must not be retried on a list of the job store,
+    where no worker pops it but it can still be inspected.
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis or job store backend
+        queue_name (str): The name of the queue the message came from.
+        message_json (str): The message in JSON format.
+
+    Returns:
+        None
+    """
+    print("\tProcessing failed - parking...")
+    await as_queue(db).push(queue_name, message_json)
+
+
+async def return_to_queue(
+    db: aioredis.Redis, queue_name: str, message_json: str
+) -> None:
+    """
+    Puts a message back at the bottom of a Redis queue, so it is the next
+    one popped from it, for jobs a worker took but did not finish
+
+    Args:
+        db (aioredis.Redis): An instance of Redis database connector.
+        queue_name (str): The name of the Redis queue.
+        message_json (str): The message in JSON format.
+
+    Returns:
+        None
+    """
+    await as_queue(db).push_front(queue_name, message_json)
 
 
 async def update_failed_status(
@@ -232,6 +642,20 @@ async def update_failed_status(
     await update_status(redis_db, uid, status_code, status_name, final_result)
 
 
+async def delete_job(db: aioredis.Redis, uid: str) -> None:
+    """
+    Removes the document of a job, e.g. one which could not be queued
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        uid (str): stringify id of jobs
+
+    Returns:
+        None
+    """
+    await as_store(db).delete_job(uid)
+
+
 async def get_job_status(db: aioredis.Redis, uid: str) -> tuple:
     """
     Wrapper function for getting information of uid from rdb
@@ -244,19 +668,19 @@ async def get_job_status(db: aioredis.Redis, uid: str) -> tuple:
         tuple: A tuple containing three elements in the following order:
             - status_name (str): The name of the status of the job.
             - status_code (int or str): status code of job ran internally
-            - final_result (str): The final result or output associated with the job.
+            - final_result (dict): The structured result associated with the job.
     """
 
-    key = f"message:{uid}"
-    status_name = await db.json().get(key, Path(".message.status_name"))
-    status_code = await db.json().get(key, Path(".message.status_code"))
-    final_result = await db.json().get(key, Path(".message.final_result"))
-    return status_name, status_code, final_result
+    status_name, status_code, final_result = await as_store(db).get_job(
+        uid, ["status_name", "status_code", "final_result"]
+    )
+    return status_name, status_code, decode_result(final_result)
 
 
 async def query_all_uids(db: aioredis.Redis) -> list:
     """
-    Wrapper function which uses index of rdb to get uids
+    Wrapper function which uses index of rdb to get uids, of every shard
+    when the job store is sharded
 
     Args:
         db (aioredis.Redis): redis_db instance of aioredis
@@ -265,7 +689,97 @@ async def query_all_uids(db: aioredis.Redis) -> list:
         list: list of uids
     """
 
-    query_str = "*"
-    result = await db.ft().search(Query(query_str).return_fields("uid"))
-    uids = [doc.uid for doc in result.docs]
+    uids = await as_store(db).list_uids()
     return uids
+
+
+async def publish_completed(
+    db: aioredis.Redis, uid: str, task: str, skills: List[str]
+) -> None:
+    """
+    Appends a completed job, its skills and completion time to the completed
+    stream
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        uid (str): stringify id of jobs
+        task (str): resume_upload or job_ad_upload
+        skills (List[str]): normalized skills of the job
+
+    Returns:
+        None
+    """
+    await as_store(db).publish_completed(
+        {
+            "uid": uid,
+            "task": task,
+            "skills": dumps(skills),
+            "ts": str(datetime.now(timezone.utc).timestamp()),
+        },
+        COMPLETED_STREAM_MAXLEN,
+    )
+
+
+async def read_completed(
+    db: aioredis.Redis, last_id: str = "0", count: int = 1000, block: int = None
+) -> Tuple[str, List[dict]]:
+    """
+    Reads completed jobs after last_id from the completed stream
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        last_id (str): stream id to read after, "0" reads from the start
+        count (int): most entries to return
+        block (int): milliseconds to wait for new entries, None to not wait
+
+    Returns:
+        tuple: (last_id, entries) where each entry has uid, task, skills and
+               ts, the epoch seconds the job completed
+    """
+    entries = []
+    for entry_id, fields in await as_store(db).read_completed(last_id, count, block):
+        last_id = entry_id
+        if "ts" in fields:
+            ts = float(fields["ts"])
+        else:
+            # entries published before ts was added, redis stream ids start
+            # with the milliseconds of the append
+            ts = int(entry_id.split("-")[0]) / 1000
+        entries.append(
+            {
+                "uid": fields["uid"],
+                "task": fields["task"],
+                "skills": loads(fields["skills"]),
+                "ts": ts,
+            }
+        )
+    return last_id, entries
+
+
+async def record_shadow_sample(db: aioredis.Redis, sample: dict) -> None:
+    """
+    Keeps a shadow evaluation sample, the newest SHADOW_SAMPLES_MAXLEN are kept
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+        sample (dict): measurements of one variant on one job
+
+    Returns:
+        None
+    """
+    await as_store(db).append_capped(
+        SHADOW_SAMPLES, dumps(sample), SHADOW_SAMPLES_MAXLEN
+    )
+
+
+async def read_shadow_samples(db: aioredis.Redis) -> List[dict]:
+    """
+    Reads the kept shadow evaluation samples
+
+    Args:
+        db (aioredis.Redis): redis_db instance of aioredis
+
+    Returns:
+        List[dict]: samples, newest first
+    """
+    return [loads(sample) for sample in await as_store(db).read_capped(SHADOW_SAMPLES)]
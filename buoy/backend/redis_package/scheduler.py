@@ -0,0 +1,113 @@
+import os
+from typing import Dict, List, Optional
+
+
+# legacy single FIFO, still drained last so messages queued before the
+# lanes existed are not stranded
+LEGACY_QUEUE = "worker_queue"
+
+INTERACTIVE_LANE = "worker_queue:interactive"
+BULK_LANE = "worker_queue:bulk"
+RESUME_LANE = "worker_queue:resume"
+
+LANE_WEIGHTS = {
+    INTERACTIVE_LANE: int(os.getenv("BUOY_WEIGHT_INTERACTIVE", 6)),
+    BULK_LANE: int(os.getenv("BUOY_WEIGHT_BULK", 3)),
+    RESUME_LANE: int(os.getenv("BUOY_WEIGHT_RESUME", 1)),
+}
+
+# text chunks above this many characters are treated as bulk work
+INTERACTIVE_MAX_CHARS = int(os.getenv("BUOY_INTERACTIVE_MAX_CHARS", 4000))
+
+# rough cost units, one unit ~ one character of text through NER + NLI
+# file bytes are discounted as most of a pdf/docx is markup, not text
+FILE_BYTES_PER_UNIT = 8
+
+
+def estimate_cost(task: str, data: str, file_size: Optional[int] = None) -> int:
+    """
+    Estimates the relative processing cost of a job
+
+    Args:
+        task (str): name of task, only resume_upload or job_ad_upload allowed
+        data (str): either file_path or text_chunk
+        file_size (Optional[int]): size of uploaded file in bytes, looked up
+                                   from file_path when not given
+
+    Returns:
+        int: estimated cost units of the job
+    """
+    if task == "resume_upload":
+        if file_size is None:
+            try:
+                file_size = os.path.getsize(data)
+            except OSError:
+                file_size = 0
+        return max(1, file_size // FILE_BYTES_PER_UNIT)
+    return max(1, len(data or ""))
+
+
+def choose_lane(task: str, cost: int) -> str:
+    """
+    Picks the priority lane a job should be queued on
+
+    Args:
+        task (str): name of task, only resume_upload or job_ad_upload allowed
+        cost (int): estimated cost units from estimate_cost
+
+    Returns:
+        str: name of the redis list backing the lane
+    """
+    if task == "resume_upload":
+        return RESUME_LANE
+    if cost <= INTERACTIVE_MAX_CHARS:
+        return INTERACTIVE_LANE
+    return BULK_LANE
+
+
+class WeightedLaneScheduler:
+    """
+    Smooth weighted round robin over the priority lanes.
+
+    Every poll, each lane earns its weight in credit and lanes are tried in
+    order of credit. The lane which actually served a job pays back the total
+    weight, so over time lanes are served in proportion to their weights
+    while an empty lane never blocks the ones behind it.
+    """
+
+    def __init__(self, weights: Dict[str, int] = None):
+        self.weights = dict(weights or LANE_WEIGHTS)
+        self.total = sum(self.weights.values())
+        self.credit = {lane: 0 for lane in self.weights}
+        self._last_order: List[str] = []
+
+    def order(self) -> List[str]:
+        """
+        Credits every lane and returns lanes in the order they should be tried
+
+        Returns:
+            List[str]: lanes sorted by credit, legacy queue last
+        """
+        for lane, weight in self.weights.items():
+            self.credit[lane] += weight
+        self._last_order = sorted(
+            self.weights, key=lambda lane: self.credit[lane], reverse=True
+        )
+        return self._last_order + [LEGACY_QUEUE]
+
+    def charge(self, served_lane: str) -> None:
+        """
+        Charges the lane which served the last job
+
+        Lanes ranked ahead of the served lane were empty, their credit is
+        dropped so an idle lane cannot bank credit and starve the others later.
+
+        Args:
+            served_lane (str): lane the job was popped from, None when the
+                               poll timed out and every lane was empty
+        """
+        for lane in self._last_order:
+            if lane == served_lane:
+                self.credit[lane] -= self.total
+                return
+            self.credit[lane] = 0
@@ -0,0 +1,176 @@
+import os
+import asyncio
+import bisect
+import hashlib
+from itertools import chain
+from typing import Dict, List, Optional, Tuple
+
+from .backends import JobStoreBackend
+
+
+# points per node on the hash ring, more spread keys more evenly
+VNODES = int(os.getenv("BUOY_SHARD_VNODES", 160))
+# keys moved per round trip when rebalancing
+REBALANCE_BATCH = 500
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring over named nodes.
+
+    Every node owns VNODES points on the ring and a key belongs to the node
+    owning the first point at or after the hash of the key. Adding a node
+    only moves the keys its points take over, about 1/N of them, instead of
+    reshuffling every key as hash modulo N would.
+    """
+
+    def __init__(self, nodes: List[str], vnodes: int = VNODES):
+        if not nodes:
+            raise ValueError("a hash ring needs at least one node")
+        self.nodes = list(nodes)
+        points = sorted(
+            (ring_hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node(self, key: str) -> str:
+        """
+        Returns the node a key belongs to
+
+        Args:
+            key (str): key to place, e.g. a job uid
+
+        Returns:
+            str: name of the owning node
+        """
+        index = bisect.bisect_left(self.hashes, ring_hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+class ShardedJobStore(JobStoreBackend):
+    """
+    Job store spread over several backends by uid.
+
+    Job documents live on the shard the hash ring assigns their uid to, so
+    each node holds and writes a share of them. Listings fan out to every
+    shard concurrently and are merged. The completed stream and capped lists
+    are not keyed by job and stay on the first shard, which keeps the stream
+    ids of one sequence.
+    """
+
+    def __init__(self, shards: Dict[str, JobStoreBackend], vnodes: int = VNODES):
+        self.shards = shards
+        self.ring = HashRing(list(shards), vnodes)
+        self.primary = next(iter(shards.values()))
+
+    def shard_for(self, uid: str) -> JobStoreBackend:
+        return self.shards[self.ring.node(uid)]
+
+    async def save_job(self, uid: str, message: dict, ttl: int) -> None:
+        await self.shard_for(uid).save_job(uid, message, ttl)
+
+    async def update_job(self, uid: str, fields: dict, ttl: int) -> None:
+        await self.shard_for(uid).update_job(uid, fields, ttl)
+
+    async def get_job(self, uid: str, fields: List[str]) -> List:
+        return await self.shard_for(uid).get_job(uid, fields)
+
+    async def delete_job(self, uid: str) -> None:
+        await self.shard_for(uid).delete_job(uid)
+
+    async def list_uids(self) -> List[str]:
+        listed = await asyncio.gather(
+            *(shard.list_uids() for shard in self.shards.values())
+        )
+        return list(chain.from_iterable(listed))
+
+    async def publish_completed(self, entry: Dict[str, str], maxlen: int) -> None:
+        await self.primary.publish_completed(entry, maxlen)
+
+    async def read_completed(
+        self, last_id: str, count: int, block: Optional[int]
+    ) -> List[Tuple[str, Dict[str, str]]]:
+        return await self.primary.read_completed(last_id, count, block)
+
+    async def append_capped(self, key: str, value: str, maxlen: int) -> None:
+        await self.primary.append_capped(key, value, maxlen)
+
+    async def read_capped(self, key: str) -> List[str]:
+        return await self.primary.read_capped(key)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(shard.close() for shard in self.shards.values()))
+
+
+async def rebalance(store: ShardedJobStore) -> Dict[str, int]:
+    """
+    Moves job documents to the shard the ring assigns them, run once after
+    nodes were added to BUOY_REDIS_DB_NODES, with their expiry kept
+
+    Args:
+        store (ShardedJobStore): store over RedisJobStore shards
+
+    Returns:
+        Dict[str, int]: node name to number of documents moved off it
+    """
+    moved = {}
+    for name, shard in store.shards.items():
+        moved[name] = 0
+        batch = []
+        async for key in shard.client.scan_iter(match="message:*", count=1000):
+            key = key.decode() if isinstance(key, bytes) else key
+            if store.ring.node(key.removeprefix("message:")) != name:
+                batch.append(key)
+            if len(batch) >= REBALANCE_BATCH:
+                moved[name] += await _move(store, shard, batch)
+                batch = []
+        if batch:
+            moved[name] += await _move(store, shard, batch)
+    return moved
+
+
+async def _move(store: ShardedJobStore, shard: JobStoreBackend, keys: List[str]) -> int:
+    async with shard.client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.json().get(key)
+            pipe.pttl(key)
+        fetched = await pipe.execute()
+    moved = 0
+    for key, document, pttl in zip(keys, fetched[::2], fetched[1::2]):
+        if document is None:
+            # expired since the scan
+            continue
+        target = store.shard_for(key.removeprefix("message:"))
+        async with target.client.pipeline(transaction=False) as pipe:
+            pipe.json().set(key, "$", document)
+            if pttl > 0:
+                pipe.pexpire(key, pttl)
+            await pipe.execute()
+        await shard.client.delete(key)
+        moved += 1
+    return moved
+
+
+async def main() -> None:
+    from . import redis_wrapper as rw
+    from . import connections
+
+    store = await rw.job_store_async()
+    if not isinstance(store, ShardedJobStore):
+        print("BUOY_REDIS_DB_NODES is not set, nothing to rebalance")
+    else:
+        for shard in store.shards.values():
+            await rw.ensure_jobs_index(shard.client)
+        print(f"moved documents per node: {await rebalance(store)}")
+    await connections.manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
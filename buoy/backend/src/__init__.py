@@ -1,4 +1,10 @@
 from . import txt_parse_w_spacy_mnli
 from . import dataclasses
 from . import io
+from . import html_extract
 from . import txt_parse_w_T5
+from . import skill_gazetteer
+from . import sentence_cache
+from . import sentence_filter
+from . import matching
+from . import result_cache
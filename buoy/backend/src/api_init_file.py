@@ -1,4 +1,7 @@
 # from . import txt_parse_w_spacy_mnli
 from . import dataclasses
 from . import io
+from . import html_extract
 # from . import txt_parse_w_T5
+from . import matching
+from . import result_cache
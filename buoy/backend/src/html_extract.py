@@ -0,0 +1,274 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import lxml.html
+from lxml import etree
+
+
+# keep only the block found by find_main_block, e.g. the job description of a
+# portal page, instead of all remaining text of the page
+MAIN_BLOCK_ONLY = os.getenv("BUOY_HTML_MAIN_BLOCK", "1").lower() in ("1", "true")
+# a main block candidate must hold at least this share of the page text
+MAIN_BLOCK_MIN_SHARE = 0.2
+MAIN_BLOCK_MIN_CHARS = 200
+# elements scored as paragraphs of their parent when holding enough text
+PARAGRAPH_TAGS = ["p", "li", "pre", "td", "dd", "blockquote"]
+PARAGRAPH_MIN_CHARS = 25
+
+# elements which never hold content worth parsing
+CODE_TAGS = [
+    "head",
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "svg",
+    "canvas",
+    "iframe",
+    "object",
+]
+# page chrome, dropped unless it contains the content block. Forms are only
+# dropped when small, as ASP.NET pages wrap the whole body in one
+DROP_TAGS = [
+    "nav",
+    "header",
+    "footer",
+    "aside",
+    "button",
+    "select",
+    "input",
+    "textarea",
+    "label",
+    "dialog",
+]
+# id or class names of navigation, cookie banners, share bars and the like
+# matched as whole words of a name split at - or _, e.g. site-footer or
+# related_jobs but not shared-layout
+BOILERPLATE_NAMES = re.compile(
+    r"(?:^|[\s_-])(?:cookie|consent|gdpr|banner|nav|navbar|navigation|menu"
+    r"|breadcrumb|footer|sidebar|share|sharing|social|newsletter|subscribe"
+    r"|signup|login|modal|popup|promo|promotion|related|recommend|recommended"
+    r"|recommendation|similar)s?(?=$|[\s_-])",
+    re.IGNORECASE,
+)
+# ad slots only as whole names, a job ad page may well call its posting job-ad
+AD_NAMES = re.compile(
+    r"(?:^|\s)(?:ad-?slot|ad-?container|ad-?unit|advert|advertisement|adsbygoogle)"
+    r"(?=$|\s)",
+    re.IGNORECASE,
+)
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary", "dialog"}
+# id, class or itemprop names of job description containers on portal pages
+MAIN_BLOCK_NAMES = re.compile(
+    r"job-?description|jobdescription|description__text|job-?details"
+    r"|posting-?body|jobsearch-jobdescriptiontext|vacancy",
+    re.IGNORECASE,
+)
+BLOCK_TAGS = {
+    "p",
+    "div",
+    "section",
+    "article",
+    "main",
+    "li",
+    "ul",
+    "ol",
+    "dl",
+    "dt",
+    "dd",
+    "table",
+    "tr",
+    "td",
+    "th",
+    "br",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "blockquote",
+    "pre",
+    "hr",
+}
+HTML_MARKUP = re.compile(r"<\s*(html|body|div|p|span|li|ul|br|h[1-6]|section)\b", re.I)
+
+
+def looks_like_html(text: str) -> bool:
+    """
+    Checks if a text chunk is html markup rather than plain text
+
+    Args:
+        text (str): submitted text
+
+    Returns:
+        bool: True when text holds common html tags
+    """
+    return bool(HTML_MARKUP.search(text[:4096]))
+
+
+def _names(element: etree._Element) -> str:
+    return " ".join(
+        element.get(attribute, "") for attribute in ("id", "class", "itemprop")
+    )
+
+
+def _is_boilerplate(element: etree._Element) -> bool:
+    if element.tag in CODE_TAGS or element.tag in DROP_TAGS:
+        return True
+    if element.tag == "form":
+        return len(element.text_content().strip()) < MAIN_BLOCK_MIN_CHARS
+    if element.get("role") in BOILERPLATE_ROLES:
+        return True
+    if element.get("aria-hidden") == "true" or element.get("hidden") is not None:
+        return True
+    # body and main may carry a page wide class such as "has-cookie-banner"
+    if element.tag in ("html", "body", "main", "article"):
+        return False
+    names = _names(element)
+    if not names or MAIN_BLOCK_NAMES.search(names):
+        return False
+    return bool(BOILERPLATE_NAMES.search(names) or AD_NAMES.search(names))
+
+
+def strip_boilerplate(root: etree._Element) -> None:
+    """
+    Removes non content elements from a parsed page in place, never the
+    content block find_main_block picks before or the elements containing it
+
+    Args:
+        root (etree._Element): root of a page parsed by lxml.html
+    """
+    # comments and processing instructions are dropped along with scripts and
+    # styles first, their text must not count when picking the content block
+    _drop(
+        [
+            element
+            for element in root.iter()
+            if not isinstance(element.tag, str) or element.tag in CODE_TAGS
+        ],
+    )
+    content = find_main_block(root)
+    protected = set()
+    if content is not None:
+        protected = {content, *content.iterancestors()}
+    _drop(
+        [
+            element
+            for element in root.iter()
+            if element not in protected and _is_boilerplate(element)
+        ],
+    )
+
+
+def _drop(doomed: List[etree._Element]) -> None:
+    for element in doomed:
+        # drop_tree keeps the tail text, which belongs to the parent
+        if element.getparent() is not None:
+            element.drop_tree()
+
+
+def _text_lengths(root: etree._Element) -> Tuple[Dict, Dict]:
+    # text and link text length of every element in one bottom up walk
+    lengths, link_lengths = {}, {}
+    for _, element in etree.iterwalk(root, events=("end",)):
+        length = len((element.text or "").strip())
+        link_length = 0
+        for child in element:
+            length += lengths[child] + len((child.tail or "").strip())
+            link_length += link_lengths[child]
+        lengths[element] = length
+        link_lengths[element] = length if element.tag == "a" else link_length
+    return lengths, link_lengths
+
+
+def find_main_block(root: etree._Element) -> Optional[etree._Element]:
+    """
+    Finds the element holding the main content of a page, a job description
+    container when the page has one, else the element whose children hold
+    the most paragraph text, scored as readability does
+
+    Args:
+        root (etree._Element): root of a page without boilerplate
+
+    Returns:
+        Optional[etree._Element]: main block, None to keep the whole page
+    """
+    lengths, link_lengths = _text_lengths(root)
+    total = lengths[root]
+    if total < MAIN_BLOCK_MIN_CHARS:
+        return None
+    for element in root.iter("div", "section", "article", "main"):
+        if (
+            MAIN_BLOCK_NAMES.search(_names(element))
+            and lengths[element] >= MAIN_BLOCK_MIN_CHARS
+        ):
+            return element
+    scores = {}
+    for element in root.iter(*PARAGRAPH_TAGS):
+        text = element.text_content()
+        if len(text.strip()) < PARAGRAPH_MIN_CHARS:
+            continue
+        score = 1 + text.count(",") + min(len(text) // 100, 3)
+        parent = element.getparent()
+        if parent is None:
+            continue
+        scores[parent] = scores.get(parent, 0) + score
+        grandparent = parent.getparent()
+        if grandparent is not None:
+            scores[grandparent] = scores.get(grandparent, 0) + score / 2
+    best, best_score = None, 0.0
+    for element, score in scores.items():
+        # link heavy blocks are menus and lists of other jobs
+        score *= 1 - link_lengths[element] / max(1, lengths[element])
+        if score > best_score:
+            best, best_score = element, score
+    if best is None or lengths[best] < total * MAIN_BLOCK_MIN_SHARE:
+        return None
+    return best
+
+
+def _block_text(root: etree._Element) -> str:
+    # one walk over the tree, block elements start and end a line
+    parts = []
+    for event, element in etree.iterwalk(root, events=("start", "end")):
+        if element.tag in BLOCK_TAGS:
+            parts.append("\n")
+        if event == "start":
+            if element.text:
+                parts.append(element.text)
+        elif element.tail and element is not root:
+            parts.append(element.tail)
+    lines = (" ".join(line.split()) for line in "".join(parts).split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def html_to_text(html_content: str, main_block_only: bool = MAIN_BLOCK_ONLY) -> str:
+    """
+    Extracts the readable text of an html page, parsed once with lxml
+
+    Args:
+        html_content (str): html markup
+        main_block_only (bool): keep only the main content block when found
+
+    Returns:
+        str: text with one line per block element, empty for empty pages
+    """
+    if not html_content.strip():
+        return ""
+    try:
+        try:
+            root = lxml.html.document_fromstring(html_content)
+        except ValueError:
+            # str with an encoding declaration, parse the bytes instead
+            root = lxml.html.document_fromstring(html_content.encode("utf-8"))
+    except etree.ParserError:
+        # nothing but comments or whitespace
+        return ""
+    strip_boilerplate(root)
+    if main_block_only:
+        main_block = find_main_block(root)
+        if main_block is not None:
+            root = main_block
+    return _block_text(root)
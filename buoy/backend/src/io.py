@@ -1,12 +1,34 @@
 import re
-import mimetypes
+import time
+import shutil
+import zipfile
+import subprocess
+from typing import Callable, Dict, Optional
 
 
 from pdfminer.high_level import extract_text
 from pdfminer.pdfparser import PDFSyntaxError
-from bs4 import BeautifulSoup
-import html2text
-import docx2txt
+from lxml import etree
+
+from . import html_extract
+
+
+PDF_MAGIC = b"%PDF-"
+ZIP_MAGIC = b"PK\x03\x04"
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+SNIFF_BYTES = 2048
+HTML_START = re.compile(
+    rb"^(?:\xef\xbb\xbf)?\s*<(?:!doctype\s+html|html|\?xml|head|body)", re.I
+)
+
+DOCX_BODY = "word/document.xml"
+# inflated size of document.xml above which a docx is refused, guards
+# against zip bombs
+DOCX_MAX_XML_BYTES = 64 * 1024 * 1024
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# converters tried in order for legacy word 97-2003 .doc files
+LEGACY_DOC_CONVERTERS = [["antiword", "-w", "0"], ["catdoc", "-w"]]
+LEGACY_DOC_TIMEOUT_SECONDS = 60
 
 
 def remove_special_characters(input_string: str) -> str:
@@ -25,27 +47,88 @@ def remove_special_characters(input_string: str) -> str:
     return cleaned_string
 
 
-def get_text_from_doc(document_path: str) -> str:
+def get_text_from_docx(document_path: str) -> str:
     """
-    Extracts text from a DOC or DOCX file.
+    Extracts text from a DOCX file, streaming word/document.xml out of the
+    zip with an incremental parser so neither the whole xml tree nor any
+    embedded image is ever held in memory.
 
     Args:
-        document_path (str): The file path of the DOC or DOCX file.
+        document_path (str): The file path of the DOCX file.
 
     Returns:
-        str: Extracted text from the document.
+        str: Extracted text, one line per paragraph.
 
     Raises:
-        ValueError: If the document does not contain any text.
+        ValueError: If the document is not a valid DOCX or has no text.
     """
-    text = docx2txt.process(document_path)
-    text = remove_special_characters(text)
+    paragraphs = []
+    words = []
+    try:
+        with zipfile.ZipFile(document_path) as archive:
+            if archive.getinfo(DOCX_BODY).file_size > DOCX_MAX_XML_BYTES:
+                raise ValueError("Document body is too large")
+            with archive.open(DOCX_BODY) as body:
+                for _, element in etree.iterparse(
+                    body,
+                    events=("end",),
+                    tag=(f"{WORD_NS}t", f"{WORD_NS}tab", f"{WORD_NS}br", f"{WORD_NS}p"),
+                    resolve_entities=False,
+                    no_network=True,
+                ):
+                    if element.tag == f"{WORD_NS}t":
+                        words.append(element.text or "")
+                    elif element.tag == f"{WORD_NS}p":
+                        paragraphs.append("".join(words))
+                        words = []
+                        # drop finished paragraphs, memory stays flat
+                        element.clear()
+                        while element.getprevious() is not None:
+                            del element.getparent()[0]
+                    else:
+                        words.append("\t" if element.tag == f"{WORD_NS}tab" else "\n")
+    except (KeyError, zipfile.BadZipFile, etree.XMLSyntaxError) as e:
+        raise ValueError(f"Make sure your document is a valid docx: {e}")
+    text = remove_special_characters("\n".join(filter(None, paragraphs)))
     if text:
         return text
     else:
         raise ValueError("Make sure your document has text")
 
 
+def get_text_from_legacy_doc(document_path: str) -> str:
+    """
+    Extracts text from a legacy Word 97-2003 DOC file with antiword, or
+    catdoc when antiword is not installed.
+
+    Args:
+        document_path (str): The file path of the DOC file.
+
+    Returns:
+        str: Extracted text from the document.
+
+    Raises:
+        ValueError: If no converter is installed or the document has no text.
+    """
+    for command in LEGACY_DOC_CONVERTERS:
+        if shutil.which(command[0]) is None:
+            continue
+        try:
+            result = subprocess.run(
+                command + [document_path],
+                capture_output=True,
+                timeout=LEGACY_DOC_TIMEOUT_SECONDS,
+                check=True,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            raise ValueError(f"Unable to convert legacy doc with {command[0]}: {e}")
+        text = remove_special_characters(result.stdout.decode("utf-8", "replace"))
+        if text.strip():
+            return text
+        raise ValueError("Make sure your document has text")
+    raise ValueError("Legacy .doc files need antiword or catdoc installed")
+
+
 def get_text_from_pdf(document_path: str) -> str:
     """
     Extracts text from a PDF file.
@@ -83,60 +166,122 @@ def get_text_from_html(document_path: str) -> str:
     with open(document_path, "r", encoding="utf-8") as file:
         html_content = file.read()
 
-    soup = BeautifulSoup(html_content, "html.parser")
-    text = html2text.html2text(soup)
-    text = remove_special_characters(text)
+    text = get_text_from_html_string(html_content)
     if text:
         return text
     else:
         raise ValueError("Make sure your html file has text")
 
 
+def get_text_from_html_string(html_content: str) -> str:
+    """
+    Extracts the main text of HTML markup, without scripts, navigation,
+    cookie banners and footers.
+
+    Args:
+        html_content (str): The HTML markup.
+
+    Returns:
+        str: Extracted text, one line per block element.
+    """
+    start = time.perf_counter()
+    text = html_extract.html_to_text(html_content)
+    text = remove_special_characters(text)
+    print(
+        f"extracted {len(text)} of {len(html_content)} html chars "
+        f"in {(time.perf_counter() - start) * 1000:.1f}ms"
+    )
+    return text
+
+
+def get_text_from_chunk(text_chunk: str) -> str:
+    """
+    Extracts text from a submitted text chunk, which may be a selection of
+    plain text or the HTML of a job portal page.
+
+    Args:
+        text_chunk (str): The submitted text chunk.
+
+    Returns:
+        str: The text chunk, or the text extracted from its HTML.
+    """
+    if html_extract.looks_like_html(text_chunk):
+        return get_text_from_html_string(text_chunk)
+    return text_chunk
+
+
+# file type, as returned by detect_file_type, to the function extracting it
+EXTRACTORS: Dict[str, Callable[[str], str]] = {
+    "html": get_text_from_html,
+    "pdf": get_text_from_pdf,
+    "docx": get_text_from_docx,
+    "doc": get_text_from_legacy_doc,
+}
+
+
 def file_parsing_by_type(file_type: str, file_path: str) -> str:
     """
-    Parses a file and extracts text based on its MIME type.
+    Parses a file and extracts text based on its file type.
 
     Args:
-        file_type (str): The MIME type of the file (e.g., 'html', 'pdf', 'docs').
+        file_type (str): The file type, one of the keys of EXTRACTORS.
         file_path (str): The file path of the file to be parsed.
 
     Returns:
         str: Extracted text from the file.
 
     Raises:
-        ValueError: If the file type is not one of 'html', 'pdf', or 'docs'.
-    """
-    match file_type:
-        case "html":
-            text = get_text_from_html(file_path)
-        case "pdf":
-            text = get_text_from_pdf(file_path)
-        case "docs":
-            text = get_text_from_doc(file_path)
-        case _:
-            raise ValueError(f"{file_type} must either be html, pdf or docs")
-    return text
+        ValueError: If there is no extractor for the file type.
+    """
+    extractor = EXTRACTORS.get(file_type)
+    if extractor is None:
+        raise ValueError(f"{file_type} must be one of {', '.join(EXTRACTORS)}")
+    return extractor(file_path)
+
 
+def sniff_file_type(head: bytes) -> Optional[str]:
+    """
+    Determines the file type from the first bytes of a file.
+
+    Args:
+        head (bytes): The first SNIFF_BYTES bytes of the file.
 
-def get_mime_type(file_path: str) -> str:
+    Returns:
+        Optional[str]: html, pdf, doc or zip, None when not supported.
+                       A zip still needs detect_file_type to tell a docx.
+    """
+    if head.startswith(PDF_MAGIC):
+        return "pdf"
+    if head.startswith(OLE2_MAGIC):
+        return "doc"
+    if head.startswith(ZIP_MAGIC):
+        return "zip"
+    if HTML_START.match(head) or html_extract.looks_like_html(
+        head.decode("utf-8", "ignore")
+    ):
+        return "html"
+    return None
+
+
+def detect_file_type(file_path: str) -> Optional[str]:
     """
-    Determines the MIME type of a file based on its file path.
+    Determines the type of a file from its content rather than its name.
 
     Args:
         file_path (str): The file path of the file.
 
     Returns:
-        str: The MIME type of the file.
-    """
-    allowed_types = {
-        "text/xml": "html",
-        "text/html": "html",
-        "application/pdf": "pdf",
-        "application/msword": "docs",
-        "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docs",
-    }
-    mime_type, _ = mimetypes.guess_type(file_path)
-    file_type = allowed_types.get(mime_type, None)
+        Optional[str]: A key of EXTRACTORS, None when the file is not supported.
+    """
+    with open(file_path, "rb") as file:
+        file_type = sniff_file_type(file.read(SNIFF_BYTES))
+    if file_type == "zip":
+        try:
+            with zipfile.ZipFile(file_path) as archive:
+                archive.getinfo(DOCX_BODY)
+            file_type = "docx"
+        except (KeyError, zipfile.BadZipFile):
+            file_type = None
     return file_type
 
 
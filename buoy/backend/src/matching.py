@@ -0,0 +1,275 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+SKILL_LABELS = ["skillset", "technology"]
+METRICS = ["jaccard", "coverage"]
+# share of dropped rows at which the index is rebuilt without them
+COMPACT_DEAD_SHARE = 0.25
+
+
+def skills_from_result(final_result: Optional[dict]) -> List[str]:
+    """
+    Extracts the normalized skills and technologies of a structured result.
+
+    Args:
+        final_result (Optional[dict]): structured result of mega_job
+
+    Returns:
+        List[str]: sorted unique lower cased skill and technology texts
+    """
+    if not isinstance(final_result, dict):
+        return []
+    return sorted(
+        {
+            entity["text"].strip().lower()
+            for entity in final_result.get("entities", [])
+            if entity.get("label") in SKILL_LABELS and entity.get("text", "").strip()
+        }
+    )
+
+
+class SkillIndex:
+    """
+    In-memory skill index over completed jobs.
+
+    Each skill keeps a posting array of the rows (jobs) mentioning it, i.e. the
+    job x skill matrix stored column wise. A query concatenates the postings of
+    its skills and counts overlaps per row with one bincount, so scoring is
+    vectorized over all stored job ads. Arrays grow by doubling so adding a job
+    is amortized constant time. Removed jobs only mark their row dead until
+    COMPACT_DEAD_SHARE of the rows are dead, then the arrays and postings are
+    rebuilt without them, so memory and query time follow the live jobs.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.skill_ids: Dict[str, int] = {}
+        self.skill_names: List[str] = []
+        self.row_of: Dict[str, int] = {}
+        self.uids: List[str] = []
+        self.row_skills: List[np.ndarray] = []
+        self.sizes = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.is_job_ad = np.zeros(capacity, dtype=bool)
+        self.added_at = np.zeros(capacity, dtype=np.float64)
+        # rows before it are expired, rows are added in completion order
+        self.expired_upto = 0
+        self.postings: List[np.ndarray] = []
+        self.posting_lens: List[int] = []
+        self.dead = 0
+
+    def __len__(self) -> int:
+        return int(self.alive.sum())
+
+    def _grow_rows(self) -> None:
+        capacity = len(self.sizes) * 2
+        for name in ["sizes", "alive", "is_job_ad", "added_at"]:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+    def _skill_id(self, skill: str) -> int:
+        skill_id = self.skill_ids.get(skill)
+        if skill_id is None:
+            skill_id = len(self.postings)
+            self.skill_ids[skill] = skill_id
+            self.skill_names.append(skill)
+            self.postings.append(np.empty(8, dtype=np.int32))
+            self.posting_lens.append(0)
+        return skill_id
+
+    def _append_posting(self, skill_id: int, row: int) -> None:
+        posting = self.postings[skill_id]
+        length = self.posting_lens[skill_id]
+        if length == len(posting):
+            grown = np.empty(len(posting) * 2, dtype=np.int32)
+            grown[:length] = posting
+            self.postings[skill_id] = posting = grown
+        posting[length] = row
+        self.posting_lens[skill_id] = length + 1
+
+    def add(
+        self, uid: str, task: str, skills: List[str], added_at: float = 0.0
+    ) -> None:
+        """
+        Adds a completed job, replacing an earlier entry of the same uid
+
+        Args:
+            uid (str): uid of the job
+            task (str): resume_upload or job_ad_upload
+            skills (List[str]): normalized skills of the job
+            added_at (float): epoch seconds the job completed, used by expire
+        """
+        if uid in self.row_of:
+            self._kill(self.row_of[uid])
+            self._maybe_compact()
+        row = len(self.uids)
+        if row == len(self.sizes):
+            self._grow_rows()
+        skill_ids = np.array(
+            sorted({self._skill_id(skill) for skill in skills}), dtype=np.int32
+        )
+        for skill_id in skill_ids:
+            self._append_posting(int(skill_id), row)
+        self.uids.append(uid)
+        self.row_skills.append(skill_ids)
+        self.row_of[uid] = row
+        self.sizes[row] = len(skill_ids)
+        self.alive[row] = True
+        self.is_job_ad[row] = task == "job_ad_upload"
+        self.added_at[row] = added_at
+
+    def remove(self, uid: str) -> None:
+        """
+        Drops a job from query results
+
+        Args:
+            uid (str): uid of the job
+        """
+        row = self.row_of.pop(uid, None)
+        if row is not None:
+            self._kill(row)
+            self._maybe_compact()
+
+    def _kill(self, row: int) -> None:
+        self.alive[row] = False
+        self.dead += 1
+
+    def expire(self, before: float) -> int:
+        """
+        Drops the jobs completed before a time, e.g. once their documents
+        reached the retention period and were deleted
+
+        Args:
+            before (float): epoch seconds, older jobs are dropped
+
+        Returns:
+            int: number of jobs dropped
+        """
+        dropped = 0
+        n_rows = len(self.uids)
+        while (
+            self.expired_upto < n_rows and self.added_at[self.expired_upto] < before
+        ):
+            row = self.expired_upto
+            # a later row of the same uid replaced this one
+            if self.row_of.get(self.uids[row]) == row:
+                del self.row_of[self.uids[row]]
+                self._kill(row)
+                dropped += 1
+            self.expired_upto += 1
+        self._maybe_compact()
+        return dropped
+
+    def _maybe_compact(self) -> None:
+        if self.dead and self.dead >= COMPACT_DEAD_SHARE * len(self.uids):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Rebuilds the index without its dead rows and without skills no live
+        job mentions any more
+        """
+        n_rows = len(self.uids)
+        rows = np.flatnonzero(self.alive[:n_rows])
+        new_row = np.full(n_rows, -1, dtype=np.int32)
+        new_row[rows] = np.arange(len(rows), dtype=np.int32)
+        postings = []
+        for skill_id, posting in enumerate(self.postings):
+            moved = new_row[posting[: self.posting_lens[skill_id]]]
+            postings.append(moved[moved >= 0])
+        kept = [skill_id for skill_id, posting in enumerate(postings) if len(posting)]
+        new_skill = np.full(max(1, len(postings)), -1, dtype=np.int32)
+        new_skill[kept] = np.arange(len(kept), dtype=np.int32)
+        self.skill_names = [self.skill_names[skill_id] for skill_id in kept]
+        self.skill_ids = {skill: index for index, skill in enumerate(self.skill_names)}
+        self.postings = []
+        self.posting_lens = []
+        for skill_id in kept:
+            posting = np.empty(max(8, len(postings[skill_id]) * 2), dtype=np.int32)
+            posting[: len(postings[skill_id])] = postings[skill_id]
+            self.postings.append(posting)
+            self.posting_lens.append(len(postings[skill_id]))
+        self.uids = [self.uids[row] for row in rows]
+        self.row_skills = [new_skill[self.row_skills[row]] for row in rows]
+        self.row_of = {uid: row for row, uid in enumerate(self.uids)}
+        capacity = max(self.capacity, len(rows) * 2)
+        for name in ["sizes", "alive", "is_job_ad", "added_at"]:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[: len(rows)] = old[rows]
+            setattr(self, name, new)
+        # every row left is alive, so none is expired
+        self.expired_upto = 0
+        self.dead = 0
+
+    def skills_of(self, uid: str) -> Optional[List[str]]:
+        """
+        Returns the indexed skills of a job
+
+        Args:
+            uid (str): uid of the job
+
+        Returns:
+            Optional[List[str]]: skills, None when the job is not indexed
+        """
+        row = self.row_of.get(uid)
+        if row is None:
+            return None
+        return [self.skill_names[skill_id] for skill_id in self.row_skills[row]]
+
+    def query(
+        self, skills: List[str], top_k: int = 10, metric: str = "jaccard"
+    ) -> List[Tuple[str, float, int]]:
+        """
+        Ranks stored job ads against a set of skills
+
+        Args:
+            skills (List[str]): normalized skills, e.g. of a resume
+            top_k (int): number of job ads to return
+            metric (str): jaccard of the two skill sets, or coverage, the
+                          fraction of the job ad's skills found in skills
+
+        Returns:
+            List[Tuple[str, float, int]]: (uid, score, overlap) best first
+        """
+        if metric not in METRICS:
+            raise ValueError(f"metric must be one of {METRICS}")
+        skill_ids = {
+            self.skill_ids[skill] for skill in skills if skill in self.skill_ids
+        }
+        n_rows = len(self.uids)
+        if not skill_ids or not n_rows:
+            return []
+        rows = np.concatenate(
+            [
+                self.postings[skill_id][: self.posting_lens[skill_id]]
+                for skill_id in skill_ids
+            ]
+        )
+        overlap = np.bincount(rows, minlength=n_rows)
+        sizes = self.sizes[:n_rows]
+        if metric == "jaccard":
+            denominator = sizes + len(set(skills)) - overlap
+        else:
+            denominator = sizes
+        scores = np.divide(
+            overlap,
+            denominator,
+            out=np.zeros(n_rows, dtype=np.float64),
+            where=denominator > 0,
+        )
+        candidates = self.alive[:n_rows] & self.is_job_ad[:n_rows] & (overlap > 0)
+        scores[~candidates] = -1.0
+        top_k = min(top_k, int(candidates.sum()))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [
+            (self.uids[row], round(float(scores[row]), 4), int(overlap[row]))
+            for row in best
+        ]
@@ -0,0 +1,159 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+# completed results kept per api process
+RESULT_CACHE_SIZE = int(os.getenv("BUOY_RESULT_CACHE_SIZE", 5000))
+# seconds a cached result is served, bounded so it does not outlive the job
+# document by much once that expires in redis
+RESULT_CACHE_SECONDS = float(os.getenv("BUOY_RESULT_CACHE_SECONDS", 3600))
+# bodies at least this long are sent gzipped to clients accepting it
+GZIP_MIN_BYTES = int(os.getenv("BUOY_GZIP_MIN_BYTES", 1024))
+GZIP_SUFFIX = "-gzip"
+
+
+class EncodedBody:
+    """
+    Serialized response body with its strong ETag and, when long enough, a
+    gzipped copy, so a cached result is never serialized or compressed again
+    """
+
+    def __init__(self, content: dict):
+        # the bytes JSONResponse would send
+        self.body = json.dumps(
+            content,
+            ensure_ascii=False,
+            allow_nan=False,
+            indent=None,
+            separators=(",", ":"),
+        ).encode("utf-8")
+        digest = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        self.etag = f'"{digest}"'
+        self.gzipped: Optional[bytes] = None
+        if len(self.body) >= GZIP_MIN_BYTES:
+            # mtime fixed so the same body always compresses to the same bytes
+            self.gzipped = gzip.compress(self.body, mtime=0)
+
+    def encoded(self, accept_encoding: Optional[str]) -> Tuple[bytes, str, bool]:
+        """
+        Picks the representation to send
+
+        Args:
+            accept_encoding (Optional[str]): Accept-Encoding header
+
+        Returns:
+            Tuple[bytes, str, bool]: body, its ETag and whether it is gzipped
+        """
+        if self.gzipped is not None and accepts_gzip(accept_encoding):
+            # each representation has its own strong ETag
+            return self.gzipped, f'"{self.etag[1:-1]}{GZIP_SUFFIX}"', True
+        return self.body, self.etag, False
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """
+        Checks If-None-Match against the ETags of both representations, with
+        the weak comparison RFC 9110 asks for
+
+        Args:
+            if_none_match (Optional[str]): If-None-Match header
+
+        Returns:
+            bool: True when the client already has this body
+        """
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            tag = tag.removeprefix("W/").strip('"').removesuffix(GZIP_SUFFIX)
+            if f'"{tag}"' == self.etag:
+                return True
+        return False
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    Checks if a client accepts gzip
+
+    Args:
+        accept_encoding (Optional[str]): Accept-Encoding header
+
+    Returns:
+        bool: True unless gzip is missing or has q=0
+    """
+    for coding in (accept_encoding or "").lower().split(","):
+        name, _, params = coding.partition(";")
+        if name.strip() in ("gzip", "*"):
+            try:
+                return float(params.strip().removeprefix("q=") or 1) > 0
+            except ValueError:
+                return True
+    return False
+
+
+class ResultCache:
+    """
+    LRU of the response bodies of jobs in a terminal state.
+
+    A completed job never changes, so extension clients polling it are
+    answered from memory instead of redis, and with 304 once they hold the
+    body. Entries expire after max_age seconds.
+    """
+
+    def __init__(
+        self, max_size: int = RESULT_CACHE_SIZE, max_age: float = RESULT_CACHE_SECONDS
+    ):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: str) -> Optional[EncodedBody]:
+        """
+        Looks up the body of a job
+
+        Args:
+            uid (str): uid of the job
+
+        Returns:
+            Optional[EncodedBody]: cached body, None on a miss
+        """
+        entry = self.entries.get(uid)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[uid]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(uid)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, uid: str, body: EncodedBody) -> None:
+        """
+        Stores the body of a job, evicting the least recently used
+
+        Args:
+            uid (str): uid of the job
+            body (EncodedBody): body of a job in a terminal state
+        """
+        if self.max_size <= 0:
+            return
+        self.entries[uid] = (time.monotonic() + self.max_age, body)
+        self.entries.move_to_end(uid)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
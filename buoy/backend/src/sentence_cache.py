@@ -0,0 +1,155 @@
+import os
+import re
+import bisect
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+# results of this many sentences are kept per worker process
+SENTENCE_CACHE_SIZE = int(os.getenv("BUOY_SENTENCE_CACHE_SIZE", 20000))
+# a sentence ends at a period followed by whitespace or at a line break, the
+# boundaries clean_and_format_text writes
+SENTENCE_PATTERN = re.compile(r"\S[^\n]*?(?:\.(?=\s)|$)", re.MULTILINE)
+WORD_PATTERN = re.compile(r"\S+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Splits text into whitespace normalized sentences
+
+    Args:
+        text (str): text, usually the output of clean_and_format_text
+
+    Returns:
+        List[str]: sentences in order, empty ones dropped
+    """
+    return [
+        " ".join(match.group().split()) for match in SENTENCE_PATTERN.finditer(text)
+    ]
+
+
+def split_sentence_words(text: str) -> List[Tuple[str, List[Tuple[int, int]]]]:
+    """
+    Splits text like split_sentences, keeping where each word of a sentence
+    starts in the sentence and in text
+
+    Args:
+        text (str): text, usually the output of clean_and_format_text
+
+    Returns:
+        List[Tuple[str, List[Tuple[int, int]]]]: (sentence, words) in order,
+            words holding (offset in sentence, offset in text) per word
+    """
+    sentences = []
+    for match in SENTENCE_PATTERN.finditer(text):
+        words, offset = [], 0
+        for word in WORD_PATTERN.finditer(match.group()):
+            words.append((offset, match.start() + word.start()))
+            offset += len(word.group()) + 1
+        sentences.append((" ".join(match.group().split()), words))
+    return sentences
+
+
+def text_offset(words: List[Tuple[int, int]], offset: int) -> int:
+    """
+    Maps a character offset in a normalized sentence to the text it was split
+    from, an end offset maps to the end of its word
+
+    Args:
+        words (List[Tuple[int, int]]): words of the sentence, see
+            split_sentence_words
+        offset (int): offset in the sentence
+
+    Returns:
+        int: offset in the text
+    """
+    index = max(0, bisect.bisect_right(words, (offset, float("inf"))) - 1)
+    sentence_offset, offset_in_text = words[index]
+    return offset_in_text + offset - sentence_offset
+
+
+class SentenceCache:
+    """
+    LRU of the structured result of single sentences.
+
+    Users highlight overlapping parts of the same posting again and again,
+    so most sentences of a submission were already analysed. Entries are
+    keyed by a hash of the sentence. A term added to the skill list changes
+    what the dictionary pass finds, but only in sentences mentioning it, so
+    invalidate drops just those.
+    """
+
+    def __init__(self, max_size: int = SENTENCE_CACHE_SIZE):
+        self.max_size = max_size
+        # digest to (sentence, result), the sentence is kept for invalidate
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(sentence: str) -> bytes:
+        return hashlib.blake2b(sentence.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, sentence: str) -> Optional[dict]:
+        """
+        Looks up the result of a sentence
+
+        Args:
+            sentence (str): normalized sentence
+
+        Returns:
+            Optional[dict]: structured result of the sentence, None on a miss
+        """
+        key = self.key(sentence)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, sentence: str, result: dict) -> None:
+        """
+        Stores the result of a sentence, evicting the least recently used
+
+        Args:
+            sentence (str): normalized sentence
+            result (dict): structured result of the sentence
+        """
+        if self.max_size <= 0:
+            return
+        key = self.key(sentence)
+        self.entries[key] = (sentence, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, terms: List[str]) -> int:
+        """
+        Drops the results of sentences mentioning any of the terms, matched
+        as whole words like SkillGazetteer.mentions
+
+        Args:
+            terms (List[str]): terms added to the skill list
+
+        Returns:
+            int: number of entries dropped
+        """
+        if not terms or not self.entries:
+            return 0
+        pattern = re.compile(
+            r"(?<!\w)(?:"
+            + "|".join(map(re.escape, sorted(terms, key=len, reverse=True)))
+            + r")(?!\w)",
+            re.IGNORECASE,
+        )
+        stale = [
+            key
+            for key, (sentence, _) in self.entries.items()
+            if pattern.search(sentence)
+        ]
+        for key in stale:
+            del self.entries[key]
+        return len(stale)
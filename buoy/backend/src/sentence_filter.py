@@ -0,0 +1,205 @@
+import os
+import re
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+
+SENTENCE_FILTER_ENABLED = os.getenv("BUOY_SENTENCE_FILTER", "0").lower() in (
+    "1",
+    "true",
+)
+# a sentence scoring at least this on BOILERPLATE_PATTERNS is dropped
+BOILERPLATE_THRESHOLD = float(os.getenv("BUOY_BOILERPLATE_THRESHOLD", 2.0))
+# share of letters in the non space characters below which a sentence is
+# taken as numbers, phone numbers, ids or markup leftovers
+MIN_LETTER_SHARE = 0.5
+MIN_LETTERS = 1
+# words longer than this on average are urls, hashes or base64
+MAX_MEAN_WORD_LENGTH = 25
+# the language check needs enough words to be reliable, shorter sentences,
+# e.g. lists of skills, are always taken as english
+LANGUAGE_MIN_WORDS = 6
+MIN_LATIN_SHARE = 0.5
+
+STOPWORDS = {
+    "en": set(
+        "the and of to in for with is are you we our on a an be will as or your "
+        "this that have has from at by it who work experience".split()
+    ),
+    "de": set(
+        "der die das und mit für ist sind sie wir ein eine zu von im auf den dem "
+        "des oder nicht auch bei als ihre unser unsere".split()
+    ),
+    "fr": set(
+        "le la les et des du pour avec est sont vous nous un une de dans sur au "
+        "aux ou votre notre nos vos qui que".split()
+    ),
+    "es": set(
+        "el la los las y de del para con es son un una en por que su sus nuestro "
+        "nuestra usted como más o".split()
+    ),
+    "nl": set(
+        "de het een en van voor met is zijn wij jij je op te naar bij ons onze "
+        "jouw als".split()
+    ),
+}
+
+# pattern to weight, a sentence is boilerplate once its matches add up to
+# BOILERPLATE_THRESHOLD, one strong phrase or two weaker ones
+BOILERPLATE_PATTERNS = [
+    # equal opportunity statements
+    (r"equal (employment )?opportunit", 2.0),
+    (r"without regard to|regardless of", 1.0),
+    (r"\brace\b|\bcolou?r\b|religion|national origin|ancestry", 0.5),
+    (r"sexual orientation|gender identity|gender expression", 1.0),
+    (r"veteran status|protected veteran|disabilit", 1.0),
+    (r"affirmative action|reasonable accommodation", 1.5),
+    (r"\bdiverse\b|\bdiversity\b|\binclusi", 0.5),
+    # privacy and legal notices
+    (r"privacy (policy|notice|statement)|personal (data|information)", 2.0),
+    (r"\bgdpr\b|data protection|\bcookies?\b", 1.0),
+    (r"all rights reserved|copyright|terms of (use|service)", 2.0),
+    # benefits
+    (r"health (insurance|care)|dental|vision (insurance|plan)|life insurance", 1.0),
+    (r"paid time off|\bpto\b|vacation days|annual leave|holiday allowance", 1.0),
+    (r"401 ?k|pension|retirement (plan|savings)|stock options|\brsus?\b", 1.0),
+    (r"parental leave|gym membership|free (lunch|snacks)|wellness", 1.0),
+    (r"competitive (salary|compensation|pay)|\bbenefits?\b|\bperks?\b", 0.5),
+    # addresses and contact details
+    (r"\b\d{1,5} \w+ (street|st|avenue|ave|road|rd|boulevard|blvd|lane|ln)\b", 1.5),
+    (r"\b(suite|floor|p o box|po box)\b \d+", 1.0),
+    (r"\b(tel|phone|fax|email|e mail)\b", 0.5),
+    # reference lists and application instructions
+    (r"references (are )?available (up)?on request", 2.0),
+    (r"\breferees?\b|\breferences?\b", 0.5),
+    (r"(click|press) (the )?apply|apply now|to apply|how to apply", 1.5),
+    (r"recruitment agenc|unsolicited (resumes|cvs)", 1.5),
+]
+BOILERPLATE_REGEX = [
+    (re.compile(pattern, re.IGNORECASE), weight)
+    for pattern, weight in BOILERPLATE_PATTERNS
+]
+WORD = re.compile(r"\w+", re.UNICODE)
+
+# sentences removed per reason since the worker started
+FILTER_COUNTERS = Counter()
+
+
+def detect_language(sentence: str) -> Optional[str]:
+    """
+    Guesses the language of a sentence from its stopwords and script
+
+    Args:
+        sentence (str): sentence to check
+
+    Returns:
+        Optional[str]: language code, "other" for non latin scripts and None
+                       when the sentence is too short to tell
+    """
+    letters = [char for char in sentence if char.isalpha()]
+    if letters:
+        # latin letters end with the latin extended-b block at U+024F
+        latin = sum(char <= "\u024f" for char in letters)
+        if latin / len(letters) < MIN_LATIN_SHARE:
+            return "other"
+    words = [word.lower() for word in WORD.findall(sentence)]
+    if len(words) < LANGUAGE_MIN_WORDS:
+        return None
+    hits = {
+        language: sum(word in stopwords for word in words)
+        for language, stopwords in STOPWORDS.items()
+    }
+    language = max(hits, key=hits.get)
+    # ties, e.g. "de" and "la" shared by several languages, favour english
+    if hits[language] == hits["en"] or hits[language] < 2:
+        return "en"
+    return language
+
+
+def boilerplate_score(sentence: str) -> float:
+    """
+    Scores how much a sentence looks like boilerplate
+
+    Args:
+        sentence (str): sentence to score
+
+    Returns:
+        float: sum of the weights of the matching BOILERPLATE_PATTERNS
+    """
+    return sum(weight for regex, weight in BOILERPLATE_REGEX if regex.search(sentence))
+
+
+def looks_like_noise(sentence: str) -> bool:
+    """
+    Length and character class heuristic for sentences without words
+
+    Args:
+        sentence (str): sentence to check
+
+    Returns:
+        bool: True for numbers, ids, urls and the like
+    """
+    chars = [char for char in sentence if not char.isspace()]
+    letters = sum(char.isalpha() for char in chars)
+    if letters < MIN_LETTERS or letters / len(chars) < MIN_LETTER_SHARE:
+        return True
+    words = sentence.split()
+    return len(chars) / len(words) > MAX_MEAN_WORD_LENGTH
+
+
+def drop_reason(
+    sentence: str,
+    protected: Optional[Callable[[str], bool]] = None,
+    threshold: float = BOILERPLATE_THRESHOLD,
+) -> Optional[str]:
+    """
+    Decides if a sentence can be dropped before it reaches NER
+
+    Args:
+        sentence (str): normalized sentence
+        protected (Optional[Callable[[str], bool]]): sentences it is True for,
+            e.g. ones mentioning a known skill, are only dropped as noise
+        threshold (float): boilerplate score at which a sentence is dropped
+
+    Returns:
+        Optional[str]: noise, language or boilerplate, None to keep it
+    """
+    if looks_like_noise(sentence):
+        return "noise"
+    if protected is not None and protected(sentence):
+        return None
+    if detect_language(sentence) not in (None, "en"):
+        return "language"
+    if boilerplate_score(sentence) >= threshold:
+        return "boilerplate"
+    return None
+
+
+def filter_sentences(
+    sentences: List[str],
+    protected: Optional[Callable[[str], bool]] = None,
+    threshold: float = BOILERPLATE_THRESHOLD,
+) -> Tuple[List[int], Counter]:
+    """
+    Runs drop_reason over the sentences of a document
+
+    Args:
+        sentences (List[str]): normalized sentences of a document
+        protected (Optional[Callable[[str], bool]]): see drop_reason
+        threshold (float): see drop_reason
+
+    Returns:
+        Tuple[List[int], Counter]: indices of the kept sentences and the
+            number of sentences and characters removed per reason
+    """
+    kept = []
+    report = Counter()
+    for index, sentence in enumerate(sentences):
+        reason = drop_reason(sentence, protected, threshold)
+        if reason is None:
+            kept.append(index)
+        else:
+            report[reason] += 1
+            report["chars"] += len(sentence)
+    FILTER_COUNTERS.update(report)
+    return kept, report
@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import fcntl
+from collections import Counter
+from typing import Dict, List, Optional
+
+import spacy
+from spacy.matcher import PhraseMatcher
+from spacy.tokens.doc import Doc
+from spacy.tokens.span import Span
+from spacy.util import filter_spans
+
+
+DEFAULT_SKILL_LIST = os.path.join(
+    os.path.dirname(__file__), "skills", "skill_list.json"
+)
+# every worker child reads and merges its promotions into this file, in docker
+# it lives on a volume so learned terms survive redeploys, the list shipped
+# with the code seeds it
+SKILL_LIST_PATH = os.getenv("BUOY_SKILL_LIST", DEFAULT_SKILL_LIST)
+
+GAZETTEER_LABELS = ["skillset", "technology"]
+# classifier outputs are promoted into the skill list once the same term was
+# labeled with at least PROMOTE_SCORE this many times
+PROMOTE_SCORE = float(os.getenv("BUOY_GAZETTEER_PROMOTE_SCORE", 0.9))
+PROMOTE_MIN_SEEN = int(os.getenv("BUOY_GAZETTEER_PROMOTE_MIN_SEEN", 3))
+PROMOTE_MAX_WORDS = 4
+# distinct terms counted towards promotion, beyond it counts are halved and
+# terms seen once forgotten, so rare one off entities do not pile up
+MAX_CANDIDATES = int(os.getenv("BUOY_GAZETTEER_MAX_CANDIDATES", 10000))
+
+
+class SkillGazetteer:
+    """
+    Dictionary of known skills and technologies matched with a PhraseMatcher.
+
+    Matching is a single linear pass over the tokens of a doc, so known terms
+    are labeled without a classifier call, including ones NER does not tag.
+    """
+
+    def __init__(self, nlp: spacy.language.Language, path: str = SKILL_LIST_PATH):
+        self.nlp = nlp
+        self.path = path
+        self.matcher = PhraseMatcher(nlp.vocab, attr="LOWER")
+        self.terms: Dict[str, str] = {}
+        self.version = 0
+        self.candidates = Counter()
+        self.terms_regex = None
+        # modification time of path when it was last read or written
+        self.mtime_ns = None
+        # terms added since take_new_terms was last called
+        self.new_terms: List[str] = []
+        self.load()
+        # the loaded list is not new to anyone
+        self.new_terms = []
+
+    def _read(self, path: str) -> dict:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _merge(self, skill_list: dict) -> List[str]:
+        # terms other workers promoted, the highest version seen wins
+        added = [
+            term
+            for term, label in skill_list.get("terms", {}).items()
+            if self.add_term(term, label)
+        ]
+        self.version = max(self.version, skill_list.get("version", 0))
+        return added
+
+    def load(self) -> None:
+        """
+        Loads the versioned skill list from path, or the shipped list while
+        path does not exist yet, and builds the matcher
+        """
+        path = self.path if os.path.exists(self.path) else DEFAULT_SKILL_LIST
+        if not os.path.exists(path):
+            print(f"skill list {self.path} not found, starting empty")
+            return
+        self._merge(self._read(path))
+        if path == self.path:
+            self.mtime_ns = os.stat(path).st_mtime_ns
+        print(f"loaded skill list v{self.version} with {len(self.terms)} terms")
+
+    def refresh(self) -> List[str]:
+        """
+        Merges terms other workers saved to path since it was last read, one
+        stat call when nothing changed
+
+        Returns:
+            List[str]: terms which were added
+        """
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return []
+        if mtime_ns == self.mtime_ns:
+            return []
+        self.mtime_ns = mtime_ns
+        try:
+            added = self._merge(self._read(self.path))
+        except (OSError, ValueError) as e:
+            print(f"unable to refresh skill list due to:\n{e}")
+            return []
+        if added:
+            print(f"merged {len(added)} terms of skill list v{self.version}")
+        return added
+
+    def save(self) -> None:
+        """
+        Writes the skill list back to path as a new version, merged with the
+        terms other workers saved, under an exclusive lock so concurrent
+        saves never drop each other's terms or reuse a version
+        """
+        try:
+            with open(f"{self.path}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if os.path.exists(self.path):
+                    self._merge(self._read(self.path))
+                self.version += 1
+                skill_list = {
+                    "version": self.version,
+                    "terms": dict(sorted(self.terms.items())),
+                }
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    json.dump(skill_list, file, indent=2)
+                os.replace(temp_path, self.path)
+                self.mtime_ns = os.stat(self.path).st_mtime_ns
+        except (OSError, ValueError) as e:
+            print(f"unable to save skill list v{self.version} due to:\n{e}")
+
+    def add_term(self, term: str, label: str) -> bool:
+        """
+        Adds a term to the dictionary
+
+        Args:
+            term (str): skill or technology, matched case insensitively
+            label (str): either skillset or technology
+
+        Returns:
+            bool: True when the term was new
+        """
+        term = term.strip().lower()
+        if not term or term in self.terms:
+            return False
+        self.terms[term] = label
+        self.terms_regex = None
+        self.matcher.add(label, [self.nlp.make_doc(term)])
+        self.new_terms.append(term)
+        return True
+
+    def take_new_terms(self) -> List[str]:
+        """
+        Returns the terms promoted or merged since the last call, e.g. to drop
+        results which were built without them
+
+        Returns:
+            List[str]: added terms, lower cased
+        """
+        new_terms, self.new_terms = self.new_terms, []
+        return new_terms
+
+    def match_spans(self, doc: Doc) -> List[Span]:
+        """
+        Finds every occurrence of dictionary terms in a doc, longest match
+        wins on overlaps
+
+        Args:
+            doc (Doc): A SpaCy Doc object.
+
+        Returns:
+            List[Span]: spans labeled with skillset or technology
+        """
+        spans = [
+            Span(doc, start, end, label=match_id)
+            for match_id, start, end in self.matcher(doc)
+        ]
+        return filter_spans(spans)
+
+    def match(self, doc: Doc) -> Dict[str, Span]:
+        """
+        Finds dictionary terms in a doc, longest match wins on overlaps
+
+        Args:
+            doc (Doc): A SpaCy Doc object.
+
+        Returns:
+            Dict[str, Span]: matched text to span labeled with skillset or technology
+        """
+        return {span.text: span for span in self.match_spans(doc)}
+
+    def mentions(self, text: str) -> bool:
+        """
+        Checks if a text contains a dictionary term, without tokenizing it
+
+        Args:
+            text (str): plain text, e.g. a sentence
+
+        Returns:
+            bool: True when a term appears in text as whole words
+        """
+        if self.terms_regex is None:
+            terms = sorted(self.terms, key=len, reverse=True)
+            self.terms_regex = re.compile(
+                r"(?<!\w)(?:" + "|".join(map(re.escape, terms)) + r")(?!\w)",
+                re.IGNORECASE,
+            )
+        return bool(self.terms) and bool(self.terms_regex.search(text))
+
+    def covers(self, entity: Span, spans: List[Span]) -> bool:
+        """
+        Checks if a NER entity is already settled by the dictionary, i.e. lies
+        inside a span the matcher found at its position
+
+        Args:
+            entity (Span): named entity from spacy
+            spans (List[Span]): output of match_spans on the same doc
+
+        Returns:
+            bool: True when entity lies inside a match
+        """
+        return any(
+            span.start <= entity.start and entity.end <= span.end for span in spans
+        )
+
+    def _decay_candidates(self) -> None:
+        while len(self.candidates) > MAX_CANDIDATES:
+            self.candidates = Counter(
+                {
+                    candidate: count // 2
+                    for candidate, count in self.candidates.items()
+                    if count > 1 and candidate[0] not in self.terms
+                }
+            )
+
+    def learn(
+        self, new_label: Dict[str, str], new_score: Dict[str, float]
+    ) -> Optional[int]:
+        """
+        Grows the dictionary from confident classifier outputs
+
+        Args:
+            new_label (Dict[str, str]): entities to their classified labels
+            new_score (Dict[str, float]): entities to the score of their label
+
+        Returns:
+            Optional[int]: new skill list version when terms were promoted
+        """
+        promoted = False
+        for text, label in new_label.items():
+            term = text.strip().lower()
+            if (
+                label not in GAZETTEER_LABELS
+                or new_score.get(text, 0) < PROMOTE_SCORE
+                or term in self.terms
+                or len(term.split()) > PROMOTE_MAX_WORDS
+            ):
+                continue
+            self.candidates[(term, label)] += 1
+            if self.candidates[(term, label)] >= PROMOTE_MIN_SEEN:
+                print(f"promoting {term} as {label} into skill list")
+                self.add_term(term, label)
+                del self.candidates[(term, label)]
+                promoted = True
+        self._decay_candidates()
+        if promoted:
+            self.save()
+            return self.version
+        return None
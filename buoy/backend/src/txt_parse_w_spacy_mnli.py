@@ -1,19 +1,67 @@
+import os
+from collections import Counter, defaultdict
+from functools import lru_cache
+
 import spacy
 from transformers import pipeline
 from datasets import Dataset
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Tuple, Set, Optional
 from spacy.tokens.doc import Doc
 from spacy.tokens.span import Span
 
-
-def initiate_spacy() -> spacy.language.Language:
+from .skill_gazetteer import SkillGazetteer
+from .sentence_cache import SentenceCache, split_sentence_words, text_offset
+from . import sentence_filter
+
+
+SPACY_MODEL = "en_core_web_lg"
+CLASSIFIER_MODEL = "MoritzLaurer/DeBERTa-v3-base-mnli-fever-anli"
+
+AMBIGUOUS = "ambiguous"
+# spacy label -> final label, None drops the entity and AMBIGUOUS sends it to
+# the zero-shot classifier. Labels missing from the table count as AMBIGUOUS.
+CASCADE_RULES = {
+    "PERSON": "person",
+    "GPE": "location",
+    "LOC": "location",
+    "FAC": "location",
+    "DATE": "time",
+    "TIME": "time",
+    "CARDINAL": None,
+    "MONEY": None,
+    "PERCENT": None,
+    "QUANTITY": None,
+    "ORDINAL": None,
+    "ORG": AMBIGUOUS,
+    "PRODUCT": AMBIGUOUS,
+    "NORP": AMBIGUOUS,
+    "WORK_OF_ART": AMBIGUOUS,
+    "LANGUAGE": AMBIGUOUS,
+    "EVENT": AMBIGUOUS,
+    "LAW": AMBIGUOUS,
+}
+# rule labels are only trusted when spacy's beam confidence of the entity is
+# at least this, 0 trusts every rule and skips the beam parse
+NER_CONFIDENCE_THRESHOLD = float(os.getenv("BUOY_NER_CONFIDENCE_THRESHOLD", 0))
+NER_BEAM_WIDTH = 16
+# entities handled by each tier since the worker started
+CASCADE_COUNTERS = Counter()
+# structured results of sentences analysed by this process
+SENTENCE_CACHE = SentenceCache()
+
+
+@lru_cache(maxsize=None)
+def initiate_spacy(model_name: str = SPACY_MODEL) -> spacy.language.Language:
     """
-    Initializes and returns a SpaCy Language model.
+    Initializes and returns a SpaCy Language model, loaded once per process.
+
+    Args:
+        model_name (str): name of an installed spaCy pipeline, "en_core_web_lg" by default.
 
     Returns:
-        spacy.language.Language: A SpaCy Language model instance loaded with "en_core_web_lg".
+        spacy.language.Language: A SpaCy Language model instance.
     """
-    nlp_lg = spacy.load("en_core_web_lg")
+    nlp_lg = spacy.load(model_name)
     return nlp_lg
 
 
@@ -67,16 +115,20 @@ def exclude_ner_tags(
     return information_for_application
 
 
-def gen_pipeline() -> pipeline:
+@lru_cache(maxsize=None)
+def gen_pipeline(model_name: str = CLASSIFIER_MODEL) -> pipeline:
     """
-    Generates and returns a Hugging Face pipeline for zero-shot classification.
+    Generates and returns a Hugging Face pipeline for zero-shot classification, loaded once per process.
+
+    Args:
+        model_name (str): Hugging Face model id of an NLI model.
 
     Returns:
         pipeline: A Hugging Face pipeline for zero-shot classification.
     """
     created_pipe = pipeline(
         "zero-shot-classification",
-        model="MoritzLaurer/DeBERTa-v3-base-mnli-fever-anli",
+        model=model_name,
         use_fast=False,
     )
     return created_pipe
@@ -98,7 +150,7 @@ def dataset_wrapper(ifa_var_values: List[str]) -> Dataset:
 
 def zero_shot_classification(
     information_for_application: Dict[str, Span], classifier
-) -> Tuple[List[str], Dict[str, str]]:
+) -> Tuple[List[str], Dict[str, str], Dict[str, float]]:
     """
     Performs zero-shot classification on named entities.
 
@@ -107,9 +159,11 @@ def zero_shot_classification(
         classifier: A Hugging Face classification pipeline.
 
     Returns:
-        Tuple[List[str], Dict[str, str]]: A tuple containing a list of entity texts and a dictionary mapping entities to their classified labels.
+        Tuple[List[str], Dict[str, str], Dict[str, float]]: A tuple containing a list of entity texts, a dictionary mapping entities to their classified labels and a dictionary mapping entities to the score of that label.
     """
     new_label = {}
+    if not information_for_application:
+        return [], new_label, {}
     ner_text, ner = (
         information_for_application.keys(),
         information_for_application.values(),
@@ -125,8 +179,119 @@ def zero_shot_classification(
         "time",
     ]
     result = classifier(data["to_classify"], candidate_labels, multi_label=False)
+    # the pipeline unwraps the list when there is a single sequence
+    if isinstance(result, dict):
+        result = [result]
     new_label = {res["sequence"]: res["labels"][0] for res in result}
-    return ner_text, new_label
+    new_score = {res["sequence"]: res["scores"][0] for res in result}
+    return ner_text, new_label, new_score
+
+
+@lru_cache(maxsize=None)
+def get_gazetteer(nlp_lg: spacy.language.Language) -> SkillGazetteer:
+    """
+    Returns the skill gazetteer of a SpaCy Language model, built once per process.
+
+    Args:
+        nlp_lg (spacy.language.Language): A SpaCy Language model.
+
+    Returns:
+        SkillGazetteer: dictionary matcher over the versioned skill list.
+    """
+    return SkillGazetteer(nlp_lg)
+
+
+def dictionary_first_pass(
+    doc: Doc,
+    information_for_application: Dict[str, Span],
+    gazetteer: SkillGazetteer,
+) -> Tuple[Dict[str, Span], Dict[str, Span]]:
+    """
+    Labels known skills and technologies straight from the gazetteer.
+
+    Args:
+        doc (Doc): A SpaCy Doc object.
+        information_for_application (Dict[str, Span]): A dictionary of named entities.
+        gazetteer (SkillGazetteer): dictionary matcher over the skill list.
+
+    Returns:
+        Tuple[Dict[str, Span], Dict[str, Span]]: A tuple containing the dictionary matches and the named entities the dictionary did not settle, which still need the classifier.
+    """
+    spans = gazetteer.match_spans(doc)
+    matches = {span.text: span for span in spans}
+    to_classify = {
+        text: span
+        for text, span in information_for_application.items()
+        if not gazetteer.covers(span, spans)
+    }
+    return matches, to_classify
+
+
+def ner_confidences(
+    doc: Doc, nlp_lg: spacy.language.Language, beam_width: int = NER_BEAM_WIDTH
+) -> Dict[Tuple[int, int, str], float]:
+    """
+    Estimates the confidence of spacy's entities with a beam parse.
+
+    Args:
+        doc (Doc): A SpaCy Doc object.
+        nlp_lg (spacy.language.Language): A SpaCy Language model.
+        beam_width (int): number of parses kept by the beam.
+
+    Returns:
+        Dict[Tuple[int, int, str], float]: (start token, end token, label) to the probability mass of the parses containing that entity, empty when the ner component cannot beam parse.
+    """
+    confidences = defaultdict(float)
+    try:
+        ner = nlp_lg.get_pipe("ner")
+        beams = ner.beam_parse([doc], beam_width=beam_width, beam_density=0.0001)
+        for beam in beams:
+            for score, ents in ner.moves.get_beam_parses(beam):
+                for start, end, label in ents:
+                    confidences[(start, end, label)] += score
+    except (AttributeError, KeyError, ValueError) as e:
+        print(f"ner confidences unavailable due to:\n{e}")
+        return {}
+    return dict(confidences)
+
+
+def cascade_entities(
+    information_for_application: Dict[str, Span],
+    confidences: Optional[Dict[Tuple[int, int, str], float]] = None,
+    rules: Dict[str, Optional[str]] = CASCADE_RULES,
+    threshold: float = NER_CONFIDENCE_THRESHOLD,
+) -> Tuple[Dict[str, str], Dict[str, float], Dict[str, Span], Counter]:
+    """
+    Settles entities whose spacy label is unambiguous, leaving the rest for the classifier.
+
+    Args:
+        information_for_application (Dict[str, Span]): A dictionary of named entities.
+        confidences (Optional[Dict[Tuple[int, int, str], float]]): output of ner_confidences, None trusts every rule.
+        rules (Dict[str, Optional[str]]): spacy label to final label, None or AMBIGUOUS.
+        threshold (float): minimum confidence for a rule to be trusted.
+
+    Returns:
+        Tuple[Dict[str, str], Dict[str, float], Dict[str, Span], Counter]: A tuple containing the rule labels, their scores, the named entities left for the classifier and the number of entities each tier handled.
+    """
+    rule_label, rule_score, to_classify = {}, {}, {}
+    counts = Counter()
+    for text, span in information_for_application.items():
+        final_label = rules.get(span.label_, AMBIGUOUS)
+        confidence = 1.0
+        if confidences is not None and final_label != AMBIGUOUS:
+            confidence = confidences.get((span.start, span.end, span.label_), 0.0)
+            if confidence < threshold:
+                final_label = AMBIGUOUS
+        if final_label == AMBIGUOUS:
+            to_classify[text] = span
+            counts["classifier"] += 1
+        elif final_label is None:
+            counts["dropped"] += 1
+        else:
+            rule_label[text] = final_label
+            rule_score[text] = confidence
+            counts["rule"] += 1
+    return rule_label, rule_score, to_classify, counts
 
 
 def visualize_spacy_v_zero(
@@ -194,29 +359,231 @@ def distill_information(
     return di_list
 
 
-def mega_job(text: str):
+def structure_information(
+    doc: Doc,
+    filtered_info: Dict[str, Span],
+    new_label: Dict[str, str],
+    new_score: Dict[str, float],
+) -> Dict[str, list]:
+    """
+    Builds the structured result of a document from filtered named entities.
+
+    Args:
+        doc (Doc): A SpaCy Doc object the entities were found in.
+        filtered_info (Dict[str, Span]): A filtered dictionary of named entities.
+        new_label (Dict[str, str]): A dictionary mapping entities to their classified labels.
+        new_score (Dict[str, float]): A dictionary mapping entities to the score of their label.
+
+    Returns:
+        Dict[str, list]: "sentences" holds every sentence with a kept entity in document order, "entities" holds one record per entity with text, label, score, start and end character offsets and sent, the index of its sentence in "sentences".
+    """
+    sent_index = {}
+    sentences = []
+    for span in sorted(filtered_info.values(), key=lambda span: span.start_char):
+        if span.sent.start_char not in sent_index:
+            sent_index[span.sent.start_char] = len(sentences)
+            sentences.append(span.sent.text.rstrip(".").strip())
+    entities = [
+        {
+            "text": text,
+            "label": new_label[text],
+            "score": round(float(new_score[text]), 4),
+            "start": span.start_char,
+            "end": span.end_char,
+            "sent": sent_index[span.sent.start_char],
+        }
+        for text, span in filtered_info.items()
+    ]
+    entities.sort(key=lambda entity: entity["start"])
+    return {"sentences": sentences, "entities": entities}
+
+
+def assemble_results(
+    parts: List[Tuple[List[Tuple[int, int]], Dict[str, list]]],
+) -> Dict[str, list]:
+    """
+    Builds the structured result of a document from the results of its sentences.
+
+    Args:
+        parts (List[Tuple[List[Tuple[int, int]], Dict[str, list]]]): words of each sentence, see split_sentence_words, and its structured result.
+
+    Returns:
+        Dict[str, list]: The structured result of the whole document, in the form of structure_information, with start and end mapped from the sentences to the document. Like it, an entity text found more than once is kept at its last occurrence.
+    """
+    latest = {}
+    for index, (words, part) in enumerate(parts):
+        for entity in part["entities"]:
+            latest[entity["text"]] = (
+                index,
+                part,
+                entity,
+                text_offset(words, entity["start"]),
+                text_offset(words, entity["end"]),
+            )
+    sent_index = {}
+    sentences, entities = [], []
+    for index, part, entity, start, end in sorted(
+        latest.values(), key=lambda item: item[3]
+    ):
+        sent_key = (index, entity["sent"])
+        if sent_key not in sent_index:
+            sent_index[sent_key] = len(sentences)
+            sentences.append(part["sentences"][entity["sent"]])
+        entities.append(
+            {
+                **entity,
+                "start": start,
+                "end": end,
+                "sent": sent_index[sent_key],
+            }
+        )
+    return {"sentences": sentences, "entities": entities}
+
+
+def analyse_sentences(
+    sentences: List[str],
+    spacy_model: str = SPACY_MODEL,
+    classifier_model: str = CLASSIFIER_MODEL,
+    shadow: bool = False,
+) -> List[Dict[str, list]]:
+    """
+    Runs spaCy, the gazetteer, the cascade and the classifier over sentences, with one classifier call for all of them.
+
+    Args:
+        sentences (List[str]): sentences without a cached result.
+        spacy_model (str): spaCy pipeline to run.
+        classifier_model (str): zero-shot classifier to run.
+        shadow (bool): shadow evaluation run, which neither counts tiers nor teaches the gazetteer.
+
+    Returns:
+        List[Dict[str, list]]: The structured result of each sentence, offsets relative to the sentence.
+    """
+    nlp_lg = initiate_spacy(spacy_model)
+    classifier = gen_pipeline(classifier_model)
+    gazetteer = get_gazetteer(nlp_lg)
+    analysed = []
+    to_classify = {}
+    tier_counts = Counter()
+    for doc in nlp_lg.pipe(sentences):
+        information_for_application = exclude_ner_tags(
+            get_entities(doc), list_exclude=["CARDINAL", "MONEY"]
+        )
+        dictionary_matches, information_for_application = dictionary_first_pass(
+            doc, information_for_application, gazetteer
+        )
+        confidences = None
+        if NER_CONFIDENCE_THRESHOLD > 0:
+            confidences = ner_confidences(doc, nlp_lg)
+        rule_label, rule_score, doc_to_classify, doc_counts = cascade_entities(
+            information_for_application, confidences
+        )
+        doc_counts["gazetteer"] = len(dictionary_matches)
+        tier_counts.update(doc_counts)
+        to_classify.update(doc_to_classify)
+        analysed.append(
+            (
+                doc,
+                information_for_application,
+                dictionary_matches,
+                rule_label,
+                rule_score,
+            )
+        )
+    if not shadow:
+        CASCADE_COUNTERS.update(tier_counts)
+        print(f"entities per tier {dict(tier_counts)}, total {dict(CASCADE_COUNTERS)}")
+    _, class_label, class_score = zero_shot_classification(to_classify, classifier)
+    if not shadow:
+        gazetteer.learn(class_label, class_score)
+    results = []
+    for (
+        doc,
+        information_for_application,
+        dictionary_matches,
+        rule_label,
+        rule_score,
+    ) in analysed:
+        new_label = {
+            text: class_label[text]
+            for text in information_for_application
+            if text in class_label
+        }
+        new_score = {text: class_score[text] for text in new_label}
+        new_label.update(rule_label)
+        new_score.update(rule_score)
+        filtered_info = post_zero_shot_filter(
+            new_label.keys(), new_label, information_for_application
+        )
+        for match_text, span in dictionary_matches.items():
+            filtered_info[match_text] = span
+            new_label[match_text] = span.label_
+            new_score[match_text] = 1.0
+        results.append(structure_information(doc, filtered_info, new_label, new_score))
+    return results
+
+
+def mega_job(
+    text: str,
+    spacy_model: str = SPACY_MODEL,
+    classifier_model: str = CLASSIFIER_MODEL,
+    shadow: bool = False,
+):
     """
     The main function to process a text advertisement and extract relevant information.
 
+    The text is split into sentences. With BUOY_SENTENCE_FILTER set, sentence_filter first drops sentences which cannot yield skills. Only sentences missing from SENTENCE_CACHE are analysed, so a selection overlapping earlier ones costs time in proportion to its new text.
+
     Args:
         text (str): The text of the advertisement to be processed.
+        spacy_model (str): spaCy pipeline to run.
+        classifier_model (str): zero-shot classifier to run.
+        shadow (bool): shadow evaluation run of a candidate engine, which bypasses SENTENCE_CACHE and leaves the gazetteer, including its refresh, and counters untouched.
 
     Returns:
-        List[str]: A list of extracted and processed information from the advertisement.
+        Dict[str, list]: The structured result from structure_information. Entity start and end are character offsets into text as given, so text[start:end] is the entity, with any line break or run of whitespace inside it kept as in text.
     """
-    nlp_lg = initiate_spacy()
-    doc = advert_nlp_doc(text, nlp_lg)
-    entities = get_entities(doc)
-    classifier = gen_pipeline()
-
-    information_for_application = exclude_ner_tags(
-        entities, list_exclude=["CARDINAL", "MONEY"]
-    )
-    ner_text, new_label = zero_shot_classification(
-        information_for_application, classifier
-    )
-    filtered_info = post_zero_shot_filter(
-        ner_text, new_label, information_for_application
+    nlp_lg = initiate_spacy(spacy_model)
+    gazetteer = get_gazetteer(nlp_lg)
+    if not shadow:
+        # terms promoted by other worker processes
+        gazetteer.refresh()
+        SENTENCE_CACHE.invalidate(gazetteer.take_new_terms())
+    positions = [(words, sentence) for sentence, words in split_sentence_words(text)]
+    if sentence_filter.SENTENCE_FILTER_ENABLED and positions:
+        kept, report = sentence_filter.filter_sentences(
+            [sentence for _, sentence in positions], gazetteer.mentions
+        )
+        chars = sum(len(sentence) + 1 for _, sentence in positions) - 1
+        print(
+            f"pre-filter removed {report['chars']} of {chars} chars, "
+            f"{len(positions) - len(kept)} of {len(positions)} sentences "
+            f"{dict(report)}, total {dict(sentence_filter.FILTER_COUNTERS)}"
+        )
+        positions = [positions[index] for index in kept]
+    sentences = [sentence for _, sentence in positions]
+    results = {}
+    for sentence in sentences:
+        if sentence not in results:
+            cached = None
+            if not shadow:
+                cached = SENTENCE_CACHE.get(sentence)
+            results[sentence] = cached
+    fresh = [sentence for sentence, result in results.items() if result is None]
+    if not shadow:
+        print(
+            f"{len(sentences) - len(fresh)} of {len(sentences)} sentences cached, "
+            f"cache hits {SENTENCE_CACHE.hits} misses {SENTENCE_CACHE.misses}"
+        )
+    if fresh:
+        analysed = analyse_sentences(fresh, spacy_model, classifier_model, shadow)
+        for sentence, result in zip(fresh, analysed):
+            results[sentence] = result
+            if not shadow:
+                SENTENCE_CACHE.put(sentence, result)
+        if not shadow:
+            # results mentioning terms learn just promoted, or merged while
+            # saving, were built without them
+            SENTENCE_CACHE.invalidate(gazetteer.take_new_terms())
+    return assemble_results(
+        [(words, results[sentence]) for words, sentence in positions]
     )
-    final_information = distill_information(information_for_application, filtered_info)
-    return final_information
@@ -1,3 +1,8 @@
 from . import txt_parse_w_spacy_mnli
 from . import io
+from . import html_extract
 from . import dataclasses
+from . import skill_gazetteer
+from . import sentence_cache
+from . import sentence_filter
+from . import matching
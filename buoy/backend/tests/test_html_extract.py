@@ -0,0 +1,56 @@
+from src import html_extract
+
+
+DESCRIPTION = (
+    "<p>We are hiring a senior Python engineer to build data pipelines with "
+    "Airflow and Spark. You will own services end to end.</p>"
+    "<p>Experience with Kubernetes, Terraform and PostgreSQL is a plus, as is "
+    "a track record of mentoring other engineers.</p>"
+)
+NAV = (
+    '<nav><a href="/">Home</a> <a href="/jobs">Jobs</a></nav>'
+    '<div class="share-bar">Share on LinkedIn</div>'
+)
+
+
+def page(body: str) -> str:
+    return f"<html><head><title>Job</title></head><body>{body}</body></html>"
+
+
+def test_aspnet_form_wrapping_the_page_is_kept():
+    html = page(
+        f'<form id="aspnetForm" method="post">{NAV}'
+        f'<div class="job-description">{DESCRIPTION}</div></form>'
+    )
+    for main_block_only in (True, False):
+        text = html_extract.html_to_text(html, main_block_only)
+        assert "Airflow and Spark" in text
+        assert "Home" not in text
+
+
+def test_small_forms_are_dropped():
+    html = page(
+        '<form><label>Email</label><input><button>Sign in</button></form>'
+        f"<div>{DESCRIPTION}</div>"
+    )
+    text = html_extract.html_to_text(html, main_block_only=False)
+    assert "Airflow and Spark" in text
+    assert "Sign in" not in text
+
+
+def test_names_only_match_whole_words():
+    for name in ["shared-layout", "job-related-content", "job-ad", "ad-details"]:
+        html = page(f'{NAV}<div class="{name}">{DESCRIPTION}</div>')
+        assert "Airflow and Spark" in html_extract.html_to_text(html), name
+
+
+def test_boilerplate_around_the_content_is_dropped():
+    html = page(
+        f'{NAV}<div class="job-related-content">{DESCRIPTION}</div>'
+        '<div class="related-jobs"><a href="/1">Data engineer</a></div>'
+        '<div class="ad-slot">Buy now</div>'
+    )
+    text = html_extract.html_to_text(html, main_block_only=False)
+    assert "Airflow and Spark" in text
+    for boilerplate in ["Home", "Share on", "Data engineer", "Buy now"]:
+        assert boilerplate not in text
@@ -0,0 +1,40 @@
+from src import matching
+
+
+def test_expire_keeps_the_index_bounded():
+    index = matching.SkillIndex(capacity=8)
+    skills = [["python", "sql"], ["python", "spark"], ["java"], ["go", "sql"]]
+    for day in range(1000):
+        for job in range(4):
+            index.add(f"{day}-{job}", "job_ad_upload", skills[job], added_at=day)
+        # a retention of 7 days
+        index.expire(day - 7)
+        assert len(index.uids) <= 2 * len(index)
+    assert len(index) == 8 * 4
+    assert len(index.sizes) <= 128
+    assert all(length <= 64 for length in index.posting_lens)
+    matches = index.query(["python", "sql"], top_k=50)
+    assert {uid.split("-")[0] for uid, _, _ in matches} == {
+        str(day) for day in range(992, 1000)
+    }
+    assert matches[0][1] == 1.0
+
+
+def test_compaction_drops_unused_skills():
+    index = matching.SkillIndex(capacity=4)
+    index.add("old", "job_ad_upload", ["cobol"], added_at=1)
+    index.add("new", "job_ad_upload", ["python"], added_at=2)
+    index.expire(2)
+    assert index.skill_names == ["python"]
+    assert index.query(["cobol"]) == []
+    assert index.skills_of("new") == ["python"]
+    assert index.query(["python"]) == [("new", 1.0, 1)]
+
+
+def test_replacing_a_job_keeps_one_row():
+    index = matching.SkillIndex(capacity=4)
+    for version in range(100):
+        index.add("same", "job_ad_upload", ["python", f"v{version}"])
+    assert len(index) == 1
+    assert len(index.uids) <= 4
+    assert index.skills_of("same") == ["python", "v99"]
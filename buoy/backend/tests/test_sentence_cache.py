@@ -0,0 +1,19 @@
+from src import sentence_cache
+
+
+def test_offsets_map_back_to_the_text():
+    text = "Knows   Python\tand\n Machine  learning.\n\n  Uses AWS   Lambda."
+    parts = sentence_cache.split_sentence_words(text)
+    assert [sentence for sentence, _ in parts] == sentence_cache.split_sentences(text)
+    for sentence, words in parts:
+        for phrase in ["Python", "Machine", "AWS Lambda"]:
+            start = sentence.find(phrase)
+            if start < 0:
+                continue
+            end = start + len(phrase)
+            span = text[
+                sentence_cache.text_offset(words, start) : sentence_cache.text_offset(
+                    words, end
+                )
+            ]
+            assert span.split() == phrase.split()
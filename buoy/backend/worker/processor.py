@@ -1,104 +1,380 @@
+import os
 import asyncio
+import argparse
+import signal
+import threading
 from json import dumps
-import gc
 import tracemalloc
+from typing import Set
 
 from src import txt_parse_w_spacy_mnli as tpt_spacy
 from redis_package import redis_wrapper as rw
+from redis_package import scheduler
+from redis_package import connections
+from redis import asyncio as aioredis
 from src import io
+from src import matching
+from worker import supervisor
+from worker import shadow
+
+
+# messages popped ahead of the job in hand, so the next job starts without a
+# queue round trip. 0 pops only once the worker is free: a message held here
+# cannot be taken by an idle worker, nor be overtaken by one arriving on a
+# higher priority lane
+PREFETCH_SIZE = max(0, int(os.getenv("BUOY_WORKER_PREFETCH", 0)))
+# runs of a failing job, after the last one it is parked on redis_db with its
+# failed status, so bad input cannot loop through inference forever
+MAX_ATTEMPTS = max(1, int(os.getenv("BUOY_MAX_ATTEMPTS", 3)))
+# result writes in flight before the loop waits for one to finish
+MAX_PENDING_WRITES = int(os.getenv("BUOY_WORKER_MAX_PENDING_WRITES", 8))
+# tracemalloc slows down every allocation, only trace when debugging memory
+TRACE_MEMORY = os.getenv("BUOY_WORKER_TRACEMALLOC", "0").lower() in ("1", "true")
+
+# set from the SIGTERM handler, threading.Event as it is created before the loop
+stop_requested = threading.Event()
+# result writes running behind the loop
+pending_writes: Set[asyncio.Task] = set()
+
+
+def parse_resume(file_path):
+    resume = io.file_parsing_by_type(
+        io.detect_file_type(file_path),
+        file_path,
+    )
+    return io.clean_and_format_text(resume)
+
+
+async def in_executor(func, *args):
+    # inference runs off the event loop, so in embedded mode the api keeps
+    # serving requests while a job is processed
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
 
 
 async def job_ad_process_text(message_json):
     text_chunk = message_json["data"]["data_info"]
+    text_chunk = io.get_text_from_chunk(text_chunk)
     text_chunk = io.clean_and_format_text(text_chunk)
-    list_of_info = tpt_spacy.mega_job(text_chunk)
-    final_result = "<sep>".join(list_of_info)
+    final_result = await in_executor(tpt_spacy.mega_job, text_chunk)
     status_name = "job_ad processed"
-    return final_result, status_name, message_json["uid"]
+    return final_result, status_name, message_json["uid"], text_chunk
 
 
 async def resume_process_text(message_json):
     file_path = message_json["data"]["data_info"]
-    resume = io.file_parsing_by_type(
-        io.get_mime_type(file_path),
-        file_path,
-    )
-    resume = io.clean_and_format_text(resume)
-    list_of_info = tpt_spacy.mega_job(resume)
-    final_result = "<sep>".join(list_of_info)
+    resume = await in_executor(parse_resume, file_path)
+    final_result = await in_executor(tpt_spacy.mega_job, resume)
     status_name = "resume processed"
-    return final_result, status_name, message_json["uid"]
+    return final_result, status_name, message_json["uid"], resume
 
 
-async def update_task_if_sucess(message_json, redis_db, async_func):
-    final_result, status_name, uid = await async_func(message_json)
-    if final_result:
-        print(final_result, status_name, uid)
-        await rw.update_status(
-            redis_db,
-            uid,
-            200,
-            status_name,
-            final_result,
+def _write_done(task: asyncio.Task) -> None:
+    pending_writes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"result write failed due to:\n{task.exception()}")
+
+
+async def write_behind(coro) -> None:
+    """
+    Runs a result write in the background, so the next job does not wait
+    for redis, blocks only while MAX_PENDING_WRITES writes are in flight
+
+    Args:
+        coro (Coroutine): write to run
+    """
+    while len(pending_writes) >= MAX_PENDING_WRITES:
+        await asyncio.wait(pending_writes, return_when=asyncio.FIRST_COMPLETED)
+    task = asyncio.create_task(coro)
+    pending_writes.add(task)
+    task.add_done_callback(_write_done)
+
+
+async def flush_writes() -> None:
+    """
+    Waits for every result write in flight
+    """
+    if pending_writes:
+        await asyncio.gather(*pending_writes, return_exceptions=True)
+
+
+async def store_result(
+    message_json, redis_conn, redis_db, queue_name, final_result, status_name
+):
+    uid = message_json["uid"]
+    try:
+        await rw.update_status(redis_db, uid, 200, status_name, final_result)
+    except Exception as e:
+        # retried like a job whose processing failed
+        await error_handling(e, message_json, redis_conn, redis_db, queue_name)
+        if isinstance(e, (aioredis.ConnectionError, aioredis.TimeoutError)):
+            # held as a pending write, so the loop stops taking jobs once
+            # MAX_PENDING_WRITES wait for redis_db to come back
+            for client in rw.store_clients(redis_db):
+                await connections.manager.wait_until_healthy(client)
+        return
+    await publish_completed(message_json, redis_db, final_result)
+
+
+async def publish_completed(message_json, redis_db, final_result) -> None:
+    """
+    Appends a job already stored as completed to the completed stream, only
+    this write is retried when it fails, the job is not run again
+
+    Args:
+        message_json (dict): message of the job
+        redis_db: redis_db instance of aioredis or job store backend
+        final_result (dict): structured result of the job
+    """
+    skills = matching.skills_from_result(final_result)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            await rw.publish_completed(
+                redis_db, message_json["uid"], message_json["task"], skills
+            )
+            return
+        except Exception as e:
+            print(f"unable to publish {message_json['uid']} due to:\n{e}")
+            if attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(connections.backoff_delay(attempt))
+    print(f"{message_json['uid']} completed but left out of the completed stream")
+
+
+async def update_task_if_sucess(
+    message_json, redis_conn, redis_db, async_func, queue_name
+):
+    final_result, status_name, uid, text = await async_func(message_json)
+    # a document without any skills is still a finished job
+    if final_result is not None:
+        print(f"{uid} {status_name} with {len(final_result['entities'])} entities")
+        await write_behind(
+            store_result(
+                message_json,
+                redis_conn,
+                redis_db,
+                queue_name,
+                final_result,
+                status_name,
+            )
+        )
+        await shadow.maybe_shadow(
+            redis_conn, redis_db, message_json, text, final_result
         )
     else:
-        await rw.requeue(redis_db, "worker_queue", message_json)
-    del final_result, status_name, uid
-    gc.collect()
+        await error_handling(
+            ValueError("no result"),
+            message_json,
+            redis_conn,
+            redis_db,
+            message_json.get("lane", scheduler.LEGACY_QUEUE),
+        )
 
 
-async def error_handling(e, message_json, redis_db, queue_name):
+async def error_handling(e, message_json, redis_conn, redis_db, queue_name):
+    message_json["attempts"] = message_json.get("attempts", 0) + 1
     status_name = f"resume_parsing failed due to {e}"
-    await rw.update_failed_status(redis_db, status_name, message_json["uid"])
-    message_json = dumps(message_json)
-    await rw.requeue(redis_db, queue_name, message_json)
-    del message_json
-    gc.collect()
+    try:
+        await rw.update_failed_status(redis_db, status_name, message_json["uid"])
+    except Exception as status_error:
+        # e.g. the write that failed was to this redis_db, the job is
+        # retried regardless
+        print(f"unable to mark {message_json['uid']} failed due to:\n{status_error}")
+    if message_json["attempts"] >= MAX_ATTEMPTS:
+        print(f"{message_json['uid']} failed {message_json['attempts']} times")
+        await rw.park(redis_db, queue_name, dumps(message_json))
+    else:
+        await rw.requeue(redis_conn, queue_name, dumps(message_json))
 
 
 async def corrupt_data_handling(redis_db, queue_name, message_json):
     status_name = "failed job due to missing data field, data is corrupt"
     await rw.update_failed_status(redis_db, status_name, message_json["uid"])
-    message_json = dumps(message_json)
-    await rw.requeue(redis_db, queue_name, message_json)
-    del message_json
-    gc.collect()
+    # a retry cannot fix the data
+    await rw.park(redis_db, queue_name, dumps(message_json))
 
 
-async def process_info(redis_conn, redis_db, queue_name="worker_queue"):
-    message_json = await rw.redis_queue_pop(redis_conn, queue_name)
-    if not message_json:
-        await asyncio.sleep(1)
+async def process_info(redis_conn, redis_db, queue_name, message_json):
+    print(f"popped {message_json['uid']} from {queue_name}")
     task = message_json["task"]
     match task:
         case "job_ad_upload":
             print("hit joh_ad_routine")
             try:
-                await update_task_if_sucess(message_json, redis_db, job_ad_process_text)
+                await update_task_if_sucess(
+                    message_json, redis_conn, redis_db, job_ad_process_text, queue_name
+                )
             except Exception as e:
-                await error_handling(e, message_json, redis_db, queue_name)
+                await error_handling(e, message_json, redis_conn, redis_db, queue_name)
         case "resume_upload":
             print("hit resume_routine")
             try:
-                await update_task_if_sucess(message_json, redis_db, resume_process_text)
+                await update_task_if_sucess(
+                    message_json, redis_conn, redis_db, resume_process_text, queue_name
+                )
             except Exception as e:
-                await error_handling(e, message_json, redis_db, queue_name)
+                await error_handling(e, message_json, redis_conn, redis_db, queue_name)
         case _:
             print("hit corrupt_ad_routine")
             if task is None:
                 await corrupt_data_handling(redis_db, queue_name, message_json)
 
 
-async def main():
-    tracemalloc.start()
-    queue_name = "worker_queue"
-    redis_conn = await rw.redis_db_async("redis", 6379)
-    redis_db = await rw.redis_db_async("redis_db", 6380)
+async def prefetch(redis_conn, lane_scheduler, buffer, credits, done):
+    """
+    Pops messages into buffer, one per credit. The loop gives a credit each
+    time it waits for a job, on top of PREFETCH_SIZE to start with, so at
+    most PREFETCH_SIZE popped messages wait while a job is processed
 
+    Args:
+        redis_conn: redis_conn instance of aioredis or queue backend
+        lane_scheduler (WeightedLaneScheduler): lane order of every pop
+        buffer (asyncio.Queue): (queue_name, message) of popped jobs
+        credits (asyncio.Semaphore): pops the loop allows
+        done (asyncio.Event): set when the loop stops taking jobs
+    """
     try:
         while True:
-            await process_info(redis_conn, redis_db, queue_name)
-            await asyncio.sleep(0.1)
+            await credits.acquire()
+            if done.is_set() or stop_requested.is_set():
+                break
+            try:
+                queue_name, message_json = await rw.redis_queue_pop_lanes(
+                    redis_conn, lane_scheduler.order()
+                )
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                # redis went away for longer than the command retries, wait
+                # for it rather than crash, the pools reconnect once it is back
+                print(f"lost connection to redis: {e}")
+                await connections.manager.wait_until_healthy(redis_conn)
+                credits.release()
+                continue
+            lane_scheduler.charge(queue_name)
+            if message_json:
+                buffer.put_nowait((queue_name, message_json))
+            else:
+                credits.release()
+    finally:
+        # wakes the loop up when it waits for a job
+        if buffer.empty():
+            buffer.put_nowait(None)
+
+
+async def return_job(redis_conn, queue_name, message_json) -> None:
+    """
+    Puts a job the worker did not finish back in front of its lane, waiting
+    for the queue to come back when it is down
+
+    Args:
+        redis_conn: redis_conn instance of aioredis or queue backend
+        queue_name (str): lane the job was popped from
+        message_json (dict): message of the job
+    """
+    while True:
+        try:
+            await rw.return_to_queue(redis_conn, queue_name, dumps(message_json))
+            print(f"returned {message_json['uid']} to {queue_name}")
+            return
+        except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+            print(f"lost connection to redis: {e}")
+            await connections.manager.wait_until_healthy(redis_conn)
+
+
+async def return_prefetched(redis_conn, buffer) -> None:
+    # jobs popped but never started go back to the front of their lane, the
+    # last popped first so they are popped again in their original order
+    returned = []
+    while not buffer.empty():
+        popped = buffer.get_nowait()
+        if popped is not None:
+            returned.append(popped)
+    for queue_name, message_json in reversed(returned):
+        await return_job(redis_conn, queue_name, message_json)
+
+
+def request_stop():
+    # finish the job in hand, then leave the loop
+    print("stop requested, finishing current job ...")
+    stop_requested.set()
+
+
+async def worker_loop(redis_conn, redis_db, max_jobs=None):
+    """
+    Processes jobs until a stop is requested or max_jobs are done, writing
+    results, and with PREFETCH_SIZE popping the next jobs, while the current
+    job is processed
+
+    Args:
+        redis_conn: redis_conn instance of aioredis or queue backend
+        redis_db: redis_db instance of aioredis or job store backend
+        max_jobs (int): jobs before the loop exits, None for no limit
+    """
+    lane_scheduler = scheduler.WeightedLaneScheduler()
+    # bounded by the credits
+    buffer = asyncio.Queue()
+    credits = asyncio.Semaphore(PREFETCH_SIZE)
+    done = asyncio.Event()
+    fetcher = asyncio.create_task(
+        prefetch(redis_conn, lane_scheduler, buffer, credits, done)
+    )
+    jobs_done = 0
+    try:
+        while not stop_requested.is_set():
+            if fetcher.done() and buffer.empty():
+                break
+            credits.release()
+            popped = await buffer.get()
+            if popped is None:
+                break
+            queue_name, message_json = popped
+            try:
+                await process_info(redis_conn, redis_db, queue_name, message_json)
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                print(f"lost connection to redis: {e}")
+                for client in rw.store_clients(redis_db):
+                    await connections.manager.wait_until_healthy(client)
+                # the job did not finish, it is retried once redis is back
+                await return_job(redis_conn, queue_name, message_json)
+                continue
+            jobs_done += 1
+            if max_jobs and jobs_done >= max_jobs:
+                print(f"processed {jobs_done} jobs, exiting to be recycled")
+                break
+    finally:
+        done.set()
+        # wakes the fetcher up when it waits for a credit
+        credits.release()
+        # a pop in flight is awaited rather than cancelled, as cancelling it
+        # could lose a message redis already handed out
+        await return_prefetched(redis_conn, buffer)
+        await fetcher
+        await return_prefetched(redis_conn, buffer)
+        await flush_writes()
+        await shadow.drain()
+
+
+async def run_embedded(queue, store):
+    """
+    Runs the worker inside the api process on in-process backends, the
+    embedded mode. Stops when the task running it is cancelled.
+
+    Args:
+        queue (QueueBackend): queue the api pushes jobs to
+        store (JobStoreBackend): job store shared with the api
+    """
+    print("embedded worker started")
+    await worker_loop(queue, store)
+
+
+async def main(max_jobs=None):
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    redis_conn = await rw.redis_db_async(rw.REDIS_QUEUE_HOST, rw.REDIS_QUEUE_PORT)
+    redis_db = await rw.job_store_async()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_stop)
+
+    try:
+        await worker_loop(redis_conn, redis_db, max_jobs)
+        print(f"redis pools: {connections.manager.metrics()}")
+        await connections.manager.close()
     except KeyboardInterrupt:
         # Cancel all running tasks
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
@@ -111,18 +387,33 @@ async def main():
         await asyncio.gather(*tasks, return_exceptions=True)
 
         # Close Redis connections
-        await redis_db.close()
-        await redis_conn.close()
+        await connections.manager.close()
 
         # Memory snapshot and print top stats
-        snapshot = tracemalloc.take_snapshot()
-        top_stats = snapshot.statistics("lineno")
-        print("[Top 10]")
-        for stat in top_stats[:10]:
-            print(stat)
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            top_stats = snapshot.statistics("lineno")
+            print("[Top 10]")
+            for stat in top_stats[:10]:
+                print(stat)
 
         print("Shutting down gracefully...")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="buoy queue worker")
+    parser.add_argument(
+        "--supervise",
+        action="store_true",
+        help="run worker child processes under a supervisor",
+    )
+    parser.add_argument("--workers", type=int, default=supervisor.WORKERS)
+    parser.add_argument("--max-jobs", type=int, default=supervisor.MAX_JOBS_PER_CHILD)
+    parser.add_argument("--max-rss-mb", type=int, default=supervisor.MAX_RSS_MB)
+    args = parser.parse_args()
+    if args.supervise:
+        supervisor.Supervisor(
+            workers=args.workers, max_jobs=args.max_jobs, max_rss_mb=args.max_rss_mb
+        ).run()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,344 @@
+import os
+import json
+import time
+import random
+import asyncio
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from src import txt_parse_w_spacy_mnli as tpt_spacy
+from src import matching
+from redis_package import redis_wrapper as rw
+from redis_package import connections
+from redis_package import scheduler
+from worker import supervisor
+
+
+# share of completed jobs also run through the candidate engines, 0 disables
+SHADOW_SAMPLE_RATE = float(os.getenv("BUOY_SHADOW_SAMPLE_RATE", 0))
+# candidate name to engine config, e.g.
+# {"spacy_md": {"spacy_model": "en_core_web_md"},
+#  "t5": {"engine": "t5", "model": "google/flan-t5-base"}}
+SHADOW_VARIANTS: Dict[str, dict] = json.loads(os.getenv("BUOY_SHADOW_VARIANTS", "{}"))
+# shadow evaluations running per worker, jobs sampled beyond it are skipped
+SHADOW_MAX_IN_FLIGHT = max(1, int(os.getenv("BUOY_SHADOW_MAX_IN_FLIGHT", 1)))
+# queued jobs above which sampled jobs are skipped, shadow runs only use
+# capacity the queue does not need
+SHADOW_MAX_QUEUE_DEPTH = int(os.getenv("BUOY_SHADOW_MAX_QUEUE_DEPTH", 5))
+# the primary engine rerun like the candidates, so latencies compare without
+# the sentence cache
+BASELINE = "baseline"
+T5_PROMPT = (
+    "Extract words or combination of words which might suggest either a soft "
+    "or technical skills. You are only allowed to use vocabulary found in the "
+    "given sentence. The sentence: "
+)
+
+# shadow runs get processes of their own, created on first use. They load
+# their own models and gazetteer, so nothing is shared with the primary job
+# running meanwhile, and their memory readings are theirs alone
+executor: Optional[ProcessPoolExecutor] = None
+# shadow evaluations running behind the worker loop
+in_flight: Set[asyncio.Task] = set()
+
+
+@lru_cache(maxsize=None)
+def get_t5(model_id: str):
+    from src import txt_parse_w_T5
+
+    return txt_parse_w_T5.instantiate_T5_model_pipeline(model_id)
+
+
+def t5_skills(text: str, model_id: str) -> List[str]:
+    """
+    Skills generated by the T5 path of txt_parse_w_T5
+
+    Args:
+        text (str): cleaned text of the job
+        model_id (str): Hugging Face id of a text2text model
+
+    Returns:
+        List[str]: sorted unique lower cased skills
+    """
+    from src import txt_parse_w_T5
+
+    t5_reader, tokenizer = get_t5(model_id)
+    sentences, _ = txt_parse_w_T5.sentences_cleaner(
+        txt_parse_w_T5.resume_to_sents(text), tokenizer
+    )
+    data = txt_parse_w_T5.create_dataset(sentences, T5_PROMPT)
+    skills = set()
+    for output in txt_parse_w_T5.skills_from_sent(data, t5_reader, "sents"):
+        for generated in output if isinstance(output, list) else [output]:
+            for skill in generated["generated_text"].split(","):
+                if skill.strip():
+                    skills.add(skill.strip().lower())
+    return sorted(skills)
+
+
+def run_engine(config: dict, text: str) -> List[str]:
+    """
+    Runs an engine configuration without touching caches or the gazetteer
+
+    Args:
+        config (dict): "engine" mega_job (default) with optional
+            "spacy_model" and "classifier_model", or t5 with "model"
+        text (str): cleaned text of the job
+
+    Returns:
+        List[str]: skills found by the engine
+    """
+    if config.get("engine", "mega_job") == "t5":
+        return t5_skills(text, config["model"])
+    result = tpt_spacy.mega_job(
+        text,
+        spacy_model=config.get("spacy_model", tpt_spacy.SPACY_MODEL),
+        classifier_model=config.get("classifier_model", tpt_spacy.CLASSIFIER_MODEL),
+        shadow=True,
+    )
+    return matching.skills_from_result(result)
+
+
+def agreement(primary: List[str], candidate: List[str]) -> Dict[str, float]:
+    """
+    Set overlap of the skills of a candidate with the primary result
+
+    Args:
+        primary (List[str]): skills returned to the user
+        candidate (List[str]): skills found by the candidate
+
+    Returns:
+        Dict[str, float]: jaccard, precision and recall of candidate
+    """
+    primary, candidate = set(primary), set(candidate)
+    overlap = len(primary & candidate)
+    return {
+        "jaccard": overlap / len(primary | candidate) if primary | candidate else 1.0,
+        "precision": overlap / len(candidate) if candidate else float(not primary),
+        "recall": overlap / len(primary) if primary else 1.0,
+    }
+
+
+def measure(name: str, config: dict, text: str, primary: List[str]) -> dict:
+    """
+    Runs one engine configuration and measures it, in a shadow process so
+    the memory readings are those of the shadow run alone
+
+    Args:
+        name (str): variant name
+        config (dict): engine configuration, see run_engine
+        text (str): cleaned text of the job
+        primary (List[str]): skills of the primary result
+
+    Returns:
+        dict: latency, memory and agreement of the run
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    rss_before = supervisor.rss_mb(os.getpid())
+    start = time.perf_counter()
+    sample = {"variant": name, "chars": len(text), "ts": time.time()}
+    try:
+        skills = run_engine(config, text)
+        sample.update(agreement(primary, skills))
+        sample["skills"] = len(skills)
+    except Exception as e:
+        # a broken candidate must never affect the primary path
+        sample["error"] = repr(e)
+    sample["seconds"] = round(time.perf_counter() - start, 4)
+    # the first run of a candidate includes loading its models
+    sample["rss_delta_mb"] = round(supervisor.rss_mb(os.getpid()) - rss_before, 1)
+    if tracing:
+        sample["py_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+    return sample
+
+
+def evaluate(text: str, final_result: dict) -> List[dict]:
+    """
+    Runs the baseline and every candidate on a job
+
+    Args:
+        text (str): cleaned text of the job
+        final_result (dict): structured result returned to the user
+
+    Returns:
+        List[dict]: one sample per variant
+    """
+    primary = matching.skills_from_result(final_result)
+    variants = {BASELINE: {}, **SHADOW_VARIANTS}
+    return [measure(name, config, text, primary) for name, config in variants.items()]
+
+
+async def maybe_shadow(
+    redis_conn, redis_db, message_json: dict, text: str, final_result: dict
+) -> None:
+    """
+    Starts the shadow evaluation of a sampled share of completed jobs in the
+    background, so the worker takes its next job right away. Skipped while
+    SHADOW_MAX_IN_FLIGHT evaluations run or more than SHADOW_MAX_QUEUE_DEPTH
+    jobs wait in the lanes.
+
+    Args:
+        redis_conn: redis_conn instance of aioredis or queue backend
+        redis_db: redis_db instance of aioredis or job store backend
+        message_json (dict): message of the job
+        text (str): cleaned text the primary engine ran on
+        final_result (dict): structured result returned to the user
+    """
+    if not SHADOW_VARIANTS or random.random() >= SHADOW_SAMPLE_RATE:
+        return
+    if len(in_flight) >= SHADOW_MAX_IN_FLIGHT:
+        return
+    lanes = [*scheduler.LANE_WEIGHTS, scheduler.LEGACY_QUEUE]
+    try:
+        depth = sum(await rw.as_queue(redis_conn).depths(lanes))
+    except Exception as e:
+        print(f"shadow evaluation skipped, unable to read queue depth:\n{e}")
+        return
+    if depth > SHADOW_MAX_QUEUE_DEPTH:
+        print(f"shadow evaluation of {message_json['uid']} skipped, {depth} queued")
+        return
+    task = asyncio.create_task(shadow_job(redis_db, message_json, text, final_result))
+    in_flight.add(task)
+    task.add_done_callback(in_flight.discard)
+
+
+def _init_process(trace_memory: bool) -> None:
+    if trace_memory:
+        tracemalloc.start()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            max_workers=SHADOW_MAX_IN_FLIGHT,
+            # spawn, forking a process which already imported torch is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+            initargs=(tracemalloc.is_tracing(),),
+        )
+    return executor
+
+
+def shutdown() -> None:
+    """
+    Stops the shadow processes, they are started again on next use
+    """
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+        executor = None
+
+
+async def shadow_job(redis_db, message_json: dict, text: str, final_result: dict):
+    """
+    Runs the shadow evaluation of a completed job in a shadow process, the
+    candidate outputs are only kept as measurements
+
+    Args:
+        redis_db: redis_db instance of aioredis or job store backend
+        message_json (dict): message of the job
+        text (str): cleaned text the primary engine ran on
+        final_result (dict): structured result returned to the user
+    """
+    try:
+        samples = await asyncio.get_running_loop().run_in_executor(
+            get_executor(), evaluate, text, final_result
+        )
+        for sample in samples:
+            sample["uid"] = message_json["uid"]
+            sample["task"] = message_json["task"]
+            await rw.record_shadow_sample(redis_db, sample)
+        print(
+            "shadow "
+            + ", ".join(
+                f"{sample['variant']} {sample['seconds']}s "
+                f"jaccard {sample.get('jaccard')}"
+                for sample in samples
+            )
+        )
+    except BrokenProcessPool as e:
+        # e.g. a candidate ran out of memory, the pool is started again
+        print(f"shadow process of {message_json['uid']} died:\n{e}")
+        shutdown()
+    except Exception as e:
+        print(f"shadow evaluation of {message_json['uid']} failed due to:\n{e}")
+
+
+async def drain() -> None:
+    """
+    Waits for the shadow evaluations still running and stops the shadow
+    processes, e.g. before exiting
+    """
+    if in_flight:
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    await asyncio.get_running_loop().run_in_executor(None, shutdown)
+
+
+def _stats(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    values = np.asarray(values, dtype=float)
+    return {
+        "mean": round(float(values.mean()), 4),
+        "p50": round(float(np.percentile(values, 50)), 4),
+        "p95": round(float(np.percentile(values, 95)), 4),
+        "max": round(float(values.max()), 4),
+    }
+
+
+def build_report(samples: List[dict]) -> Dict[str, dict]:
+    """
+    Aggregates shadow samples per variant
+
+    Args:
+        samples (List[dict]): output of rw.read_shadow_samples
+
+    Returns:
+        Dict[str, dict]: variant to sample and error counts, latency, memory
+                         and agreement statistics and p50 speedup over the
+                         baseline
+    """
+    by_variant: Dict[str, List[dict]] = {}
+    for sample in samples:
+        by_variant.setdefault(sample["variant"], []).append(sample)
+    report = {}
+    for variant, variant_samples in by_variant.items():
+        ok = [sample for sample in variant_samples if "error" not in sample]
+        report[variant] = {
+            "samples": len(variant_samples),
+            "errors": len(variant_samples) - len(ok),
+            "latency_s": _stats([sample["seconds"] for sample in ok]),
+            "rss_delta_mb": _stats([sample["rss_delta_mb"] for sample in ok]),
+            "py_peak_mb": _stats(
+                [sample["py_peak_mb"] for sample in ok if "py_peak_mb" in sample]
+            ),
+        }
+        for metric in ["jaccard", "precision", "recall"]:
+            report[variant][metric] = _stats([sample[metric] for sample in ok])
+    baseline = (report.get(BASELINE) or {}).get("latency_s")
+    for variant in report.values():
+        if baseline and variant["latency_s"] and variant["latency_s"]["p50"]:
+            variant["speedup_p50"] = round(
+                baseline["p50"] / variant["latency_s"]["p50"], 3
+            )
+    return report
+
+
+async def print_report() -> None:
+    redis_db = await rw.job_store_async()
+    samples = await rw.read_shadow_samples(redis_db)
+    print(json.dumps(build_report(samples), indent=2))
+    await connections.manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(print_report())
@@ -0,0 +1,177 @@
+import os
+import time
+import signal
+import random
+import asyncio
+import multiprocessing
+
+
+WORKERS = int(os.getenv("BUOY_WORKERS", 1))
+# a child is recycled after this many jobs, 0 never recycles on job count
+MAX_JOBS_PER_CHILD = int(os.getenv("BUOY_MAX_JOBS_PER_CHILD", 200))
+# a child is recycled once its resident memory is above this, 0 disables
+MAX_RSS_MB = int(os.getenv("BUOY_MAX_RSS_MB", 6144))
+# time a child asked to stop gets to finish its job before it is killed
+RECYCLE_GRACE_SECONDS = int(os.getenv("BUOY_RECYCLE_GRACE_SECONDS", 600))
+CHECK_INTERVAL_SECONDS = 2.0
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# a child running this long has recovered, its crash backoff is reset
+STABLE_SECONDS = 120.0
+
+
+def run_child(max_jobs: int) -> None:
+    """
+    Entry point of a worker child process
+
+    Args:
+        max_jobs (int): jobs to process before exiting to be recycled
+    """
+    from worker import processor
+
+    # the supervisor forwards ctrl-c as SIGTERM, so a child finishes its job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(processor.main(max_jobs=max_jobs))
+
+
+def rss_mb(pid: int) -> float:
+    """
+    Reads the resident set size of a process from /proc
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        float: resident memory in MiB, 0 when it cannot be read
+    """
+    try:
+        with open(f"/proc/{pid}/status", "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class ChildSlot:
+    """
+    Book keeping of one worker child and its restarts
+    """
+
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.process = None
+        self.started_at = 0.0
+        self.stop_sent_at = None
+        self.failures = 0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    """
+    Keeps a fixed number of worker children running.
+
+    Children are recycled gracefully, i.e. asked with SIGTERM to finish the
+    job in hand and exit, once they processed max_jobs jobs or grew above the
+    memory watermark, and a fresh child with a clean heap takes their place.
+    Crashed children are restarted with exponential backoff and jitter.
+    """
+
+    def __init__(
+        self,
+        workers: int = WORKERS,
+        max_jobs: int = MAX_JOBS_PER_CHILD,
+        max_rss_mb: int = MAX_RSS_MB,
+        grace_seconds: int = RECYCLE_GRACE_SECONDS,
+    ):
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.grace_seconds = grace_seconds
+        self.slots = [ChildSlot(slot) for slot in range(workers)]
+        # spawn, forking a process which already imported torch is unsafe
+        self.context = multiprocessing.get_context("spawn")
+        self.stopping = False
+
+    def start_child(self, child: ChildSlot) -> None:
+        child.process = self.context.Process(
+            target=run_child,
+            args=(self.max_jobs,),
+            name=f"buoy-worker-{child.slot}",
+        )
+        child.process.start()
+        child.started_at = time.monotonic()
+        child.stop_sent_at = None
+        print(f"started worker {child.slot} as pid {child.process.pid}")
+
+    def stop_child(self, child: ChildSlot, reason: str) -> None:
+        if child.stop_sent_at is None and child.process.is_alive():
+            print(f"recycling worker {child.slot} pid {child.process.pid}: {reason}")
+            child.process.terminate()
+            child.stop_sent_at = time.monotonic()
+
+    def backoff(self, failures: int) -> float:
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    def check(self, child: ChildSlot) -> None:
+        """
+        Restarts, recycles or kills a child as needed
+
+        Args:
+            child (ChildSlot): child to check
+        """
+        now = time.monotonic()
+        if child.process is None:
+            if not self.stopping and now >= child.restart_at:
+                self.start_child(child)
+            return
+        if not child.process.is_alive():
+            exitcode = child.process.exitcode
+            child.process.close()
+            child.process = None
+            if exitcode == 0 or child.stop_sent_at is not None:
+                # recycled, replace right away
+                child.failures = 0
+                child.restart_at = now
+            else:
+                if now - child.started_at > STABLE_SECONDS:
+                    child.failures = 0
+                child.failures += 1
+                delay = self.backoff(child.failures)
+                child.restart_at = now + delay
+                print(
+                    f"worker {child.slot} crashed with exit code {exitcode}, "
+                    f"restarting in {delay:.1f}s"
+                )
+            self.check(child)
+            return
+        if child.stop_sent_at is not None:
+            if now - child.stop_sent_at > self.grace_seconds:
+                print(f"worker {child.slot} did not stop in time, killing")
+                child.process.kill()
+            return
+        memory = rss_mb(child.process.pid)
+        if self.max_rss_mb and memory > self.max_rss_mb:
+            self.stop_child(child, f"rss {memory:.0f}MiB above {self.max_rss_mb}MiB")
+
+    def request_stop(self, signum, frame) -> None:
+        print("supervisor stopping, waiting for workers to finish their jobs ...")
+        self.stopping = True
+        for child in self.slots:
+            if child.process is not None:
+                self.stop_child(child, "supervisor stopping")
+
+    def run(self) -> None:
+        """
+        Supervises children until SIGTERM or SIGINT
+        """
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        while True:
+            for child in self.slots:
+                self.check(child)
+            if self.stopping and all(child.process is None for child in self.slots):
+                print("Shutting down gracefully...")
+                return
+            time.sleep(CHECK_INTERVAL_SECONDS)